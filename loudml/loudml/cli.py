@@ -14,6 +14,7 @@ import json
 
 import loudml.config
 import loudml.datasource
+import loudml.donut
 import loudml.model
 
 from . import (
@@ -37,6 +38,9 @@ from .misc import (
 from .filestorage import (
     FileStorage,
 )
+from .storage import (
+    load_storage,
+)
 
 
 def get_datasource(config, src_name):
@@ -125,7 +129,7 @@ class LoadCheckpointCommand(Command):
             raise LoudMLException(
                 "'checkpoint' argument is required")
 
-        storage = FileStorage(self.config.storage['path'])
+        storage = load_storage(self.config.storage)
         storage.set_current_ckpt(args.model_name, args.checkpoint)
 
 class SaveCheckpointCommand(Command):
@@ -150,7 +154,7 @@ class SaveCheckpointCommand(Command):
             raise LoudMLException(
                 "'checkpoint' argument is required")
 
-        storage = FileStorage(self.config.storage['path'])
+        storage = load_storage(self.config.storage)
         model = storage.load_model(args.model_name)
         storage.save_state(model, args.checkpoint)
 
@@ -172,12 +176,12 @@ class ListCheckpointsCommand(Command):
         )
 
     def exec(self, args):
-        storage = FileStorage(self.config.storage['path'])
+        storage = load_storage(self.config.storage)
         if args.info:
             print("checkpoint             loss   ")
             print("==============================")
             for ckpt_name in storage.list_checkpoints(args.model_name):
-                data = storage.get_model_data(args.model_name, ckpt_name)
+                data = storage.get_model_meta(args.model_name, ckpt_name)
                 print("{:22} {:.5f}".format(
                     ckpt_name,
                     data['state'].get('loss'),
@@ -186,6 +190,25 @@ class ListCheckpointsCommand(Command):
             for ckpt_name in storage.list_checkpoints(args.model_name):
                 print(ckpt_name)
 
+class PruneCheckpointsCommand(Command):
+    """
+    Delete the checkpoints that the retention policy does not keep
+    """
+
+    def add_args(self, parser):
+        parser.add_argument(
+            'model_name',
+            help="Model name, all models by default",
+            type=str,
+            nargs='*',
+        )
+
+    def exec(self, args):
+        storage = load_storage(self.config.storage)
+        for name in args.model_name or storage.list_models():
+            for ckpt_name in storage.prune_checkpoints(name):
+                print("{} {}".format(name, ckpt_name))
+
 class CreateModelCommand(Command):
     """
     Create model
@@ -241,7 +264,7 @@ class CreateModelCommand(Command):
         return settings
 
     def exec(self, args):
-        storage = FileStorage(self.config.storage['path'])
+        storage = load_storage(self.config.storage)
         if args.template is not None:
             params = self._load_model_json(args.model_file)
             model = storage.load_template(args.template, config=self.config, **params)
@@ -265,7 +288,7 @@ class ListTemplatesCommand(Command):
     """
 
     def exec(self, args):
-        storage = FileStorage(self.config.storage['path'])
+        storage = load_storage(self.config.storage)
 
         for tmpl in storage.list_templates():
             print(tmpl)
@@ -284,18 +307,16 @@ class ListModelsCommand(Command):
         )
 
     def exec(self, args):
-        storage = FileStorage(self.config.storage['path'])
+        storage = load_storage(self.config.storage)
 
         if args.info:
             print("MODEL                            type             trained")
             print("=========================================================")
-            for name in storage.list_models():
-                model = storage.load_model(name)
-
+            for entry in storage.find_models():
                 print("{:32} {:16} {:3}".format(
-                    name,
-                    model.type,
-                    'yes' if model.is_trained else 'no',
+                    entry['name'],
+                    entry['type'] or '-',
+                    'yes' if entry['trained'] else 'no',
                 ))
         else:
             for model in storage.list_models():
@@ -315,7 +336,7 @@ class DeleteModelCommand(Command):
         )
 
     def exec(self, args):
-        storage = FileStorage(self.config.storage['path'])
+        storage = load_storage(self.config.storage)
         storage.delete_model(args.model_name)
         send_metrics(self.config.metrics, storage, user_agent="loudml")
         logging.info("model '%s' deleted", args.model_name)
@@ -351,8 +372,8 @@ class ShowModelCommand(Command):
         )
 
     def exec(self, args):
-        storage = FileStorage(self.config.storage['path'])
-        model = storage.load_model(args.model_name)
+        storage = load_storage(self.config.storage)
+        model = storage.load_model(args.model_name, lazy=True)
         if args.show_all:
             if args.yaml:
                 print(yaml.dump(model.show(), default_flow_style=False))
@@ -418,7 +439,7 @@ class PlotCommand(Command):
         if args.model_name == '*':
             return self.exec_all(args)
 
-        storage = FileStorage(self.config.storage['path'])
+        storage = load_storage(self.config.storage)
         model = storage.load_model(args.model_name)
         source = get_datasource(self.config, args.datasource or
                                 model.default_datasource)
@@ -499,7 +520,7 @@ class TrainCommand(Command):
         )
 
     def exec_all(self, args):
-        storage = FileStorage(self.config.storage['path'])
+        storage = load_storage(self.config.storage)
         for name in storage.list_models():
             args.model_name = name
             self.exec(args)
@@ -508,7 +529,7 @@ class TrainCommand(Command):
         if args.model_name == '*':
             return self.exec_all(args)
 
-        storage = FileStorage(self.config.storage['path'])
+        storage = load_storage(self.config.storage)
         model = storage.load_model(args.model_name)
         source = get_datasource(self.config, args.datasource or
                                 model.default_datasource)
@@ -527,6 +548,20 @@ class TrainCommand(Command):
                 args.to_date,
                 tags={'model': args.model_name },
             )
+
+            def trials_cb(trials):
+                storage.set_model_object(args.model_name, 'trials', trials)
+
+            try:
+                trials = storage.get_model_object(args.model_name, 'trials')
+            except KeyError:
+                trials = None
+
+            # Only hyperparameter searches start from similar models
+            priors = None
+            if model.type == 'donut' and not args.incremental:
+                priors = loudml.donut.find_priors(storage, model)
+
             result = model.train(
                 source,
                 args.from_date,
@@ -534,8 +569,13 @@ class TrainCommand(Command):
                 max_evals=args.max_evals,
                 num_cpus=self.config.training['num_cpus'],
                 num_gpus=self.config.training['num_gpus'],
+                parallel_trials=self.config.training['parallel_trials'],
+                window_cache_memory=self.config.training['window_cache_memory'],
                 incremental=args.incremental,
                 windows=windows,
+                trials=trials,
+                trials_cb=trials_cb,
+                priors=priors,
             )
             print("loss: %f" % result['loss'])
         else:
@@ -642,7 +682,7 @@ class ForecastCommand(Command):
         print(json.dumps(data, indent=4))
 
     def exec(self, args):
-        storage = FileStorage(self.config.storage['path'])
+        storage = load_storage(self.config.storage)
         model = storage.load_model(args.model_name)
         source = get_datasource(
             self.config,
@@ -671,6 +711,8 @@ class ForecastCommand(Command):
                 percent_noise=args.noise_val,
                 num_cpus=self.config.inference['num_cpus'],
                 num_gpus=self.config.inference['num_gpus'],
+                mc_memory_limit=self.config.inference['mc_memory_limit'],
+                backend=self.config.inference['backend'],
             )
             if constraint:
                 model.test_constraint(
@@ -763,7 +805,7 @@ class PredictCommand(Command):
 
 
     def exec(self, args):
-        storage = FileStorage(self.config.storage['path'])
+        storage = load_storage(self.config.storage)
         model = storage.load_model(args.model_name)
         source = get_datasource(
             self.config,
@@ -789,6 +831,8 @@ class PredictCommand(Command):
                     mse_rtol=self.config.server['mse_rtol'],
                     num_cpus=self.config.inference['num_cpus'],
                     num_gpus=self.config.inference['num_gpus'],
+                    mc_memory_limit=self.config.inference['mc_memory_limit'],
+                    backend=self.config.inference['backend'],
                 )
                 prediction.stat()
                 model.detect_anomalies(prediction)
@@ -799,6 +843,8 @@ class PredictCommand(Command):
                     args.to_date,
                     num_cpus=self.config.inference['num_cpus'],
                     num_gpus=self.config.inference['num_gpus'],
+                    mc_memory_limit=self.config.inference['mc_memory_limit'],
+                    backend=self.config.inference['backend'],
                 )
 
             if args.save:
@@ -819,6 +865,37 @@ class PredictCommand(Command):
         send_metrics(self.config.metrics, storage, user_agent="loudml")
 
 
+class MigrateStorageCommand(Command):
+    """
+    Import the models of a file storage into the configured storage
+    """
+
+    def add_args(self, parser):
+        parser.add_argument(
+            'path',
+            help="File storage directory",
+            type=str,
+        )
+
+    def exec(self, args):
+        storage = load_storage(self.config.storage)
+        if isinstance(storage, FileStorage) \
+           and os.path.realpath(storage.path) == os.path.realpath(args.path):
+            raise LoudMLException("cannot migrate a storage to itself")
+
+        src = FileStorage(args.path)
+        for name in src.list_models():
+            if storage.model_exists(name):
+                logging.warning("model '%s' already exists, skipping", name)
+                continue
+
+            logging.info("migrating model '%s'", name)
+            try:
+                storage.import_model(src, name)
+            except LoudMLException as exn:
+                logging.error("cannot migrate model '%s': %s", name, str(exn))
+
+
 def get_commands():
     """
     Get Loud ML CLI commands
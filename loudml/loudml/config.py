@@ -36,6 +36,8 @@ class Config:
         self._storage = data.get('storage', {})
         if 'path' not in self._storage:
             self._storage['path'] = "/var/lib/loudml"
+        if 'type' not in self._storage:
+            self._storage['type'] = 'file'
 
         self._training = data.get('training', {})
         if 'num_cpus' not in self._training:
@@ -48,6 +50,10 @@ class Config:
             self._training['batch_size'] = 64
         if 'epochs' not in self._training:
             self._training['epochs'] = 100
+        if 'parallel_trials' not in self._training:
+            self._training['parallel_trials'] = 1
+        if 'window_cache_memory' not in self._training:
+            self._training['window_cache_memory'] = 512
 
         if 'incremental' not in self._training:
             self._training['incremental'] = {
@@ -60,6 +66,14 @@ class Config:
             self._inference['num_cpus'] = 1
         if 'num_gpus' not in self._inference:
             self._inference['num_gpus'] = 0
+        if 'mc_memory_limit' not in self._inference:
+            self._inference['mc_memory_limit'] = 256
+        if 'backend' not in self._inference:
+            self._inference['backend'] = 'keras'
+        if 'model_cache_size' not in self._inference:
+            self._inference['model_cache_size'] = 16
+        if 'model_cache_memory' not in self._inference:
+            self._inference['model_cache_memory'] = 1024
 
         self._server = data.get('server', {})
         if 'listen' not in self._server:
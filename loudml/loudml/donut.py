@@ -10,33 +10,32 @@ the encoder can be used to  generate latent vectors.
 """
 
 
+import collections
+import contextlib
+import copy
 import datetime
+import hashlib
 import json
 import logging
 import os
+import pickle
+import socket
+import subprocess
 import sys
-import random
+import tempfile
+import time
 import numpy as np
 import itertools
 from scipy.stats import norm
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
-import tensorflow as tf
-tf.logging.set_verbosity(tf.logging.ERROR)
-from tensorflow.contrib.keras.api.keras import backend as K
-from tensorflow.contrib.keras.api.keras.models import load_model
-from tensorflow.contrib.keras.api.keras.callbacks import EarlyStopping
-from tensorflow.contrib.keras.api.keras.layers import Lambda, Input, Dense
-from tensorflow.contrib.keras.api.keras.models import Model as _Model
-from tensorflow.contrib.keras.api.keras.losses import mean_squared_error
-from tensorflow.contrib.keras.api.keras import regularizers
 
 import h5py  # Read training_config.optimizer_config
 
+from hyperopt import base
 from hyperopt import hp
 from hyperopt import space_eval
 from hyperopt import (
-    fmin,
     STATUS_OK,
     STATUS_FAIL,
     tpe,
@@ -57,6 +56,9 @@ from . import (
 )
 from .misc import (
     datetime_to_str,
+    get_memory_usage,
+    gunzip_file,
+    hash_dict,
     list_from_np,
     make_datetime,
     make_ts,
@@ -67,6 +69,7 @@ from .misc import (
 from .model import (
     Model,
     DateRange,
+    is_trained_state,
 )
 
 DEFAULT_SEASONALITY = {
@@ -85,9 +88,56 @@ _hp_span_max = 100
 # Constants derived from https://arxiv.org/abs/1802.03903
 g_mcmc_count = 10
 g_mc_count = 1000
+g_mc_min_count = 100
 g_mc_batch_size = 256
 g_lambda = 0.01
 
+# Memory budget (MB) of one MC integration chunk
+g_mc_memory_limit = 256
+# Memory budget (MB) of the windows memoized by a training job
+g_window_cache_memory = 512
+# Resolution of scaled values below which training windows are merged
+g_window_resolution = 0.01
+# Number of past windows replayed by incremental trainings
+g_replay_size = 512
+g_max_prior_trials = 100
+g_max_warm_start = 5
+g_max_span_candidates = 3
+g_span_min_acf = 0.2
+# Suggestions drawn to avoid evaluating the same parameters twice in a batch
+g_max_suggest_tries = 10
+
+g_latent_dims = [3, 5, 8]
+g_intermediate_dims = [21, 34, 55, 89, 144, 233, 377]
+g_optimizers = ['adam']
+
+# TensorFlow & Keras are imported on first use, see _import_keras()
+tf = None
+K = None
+
+
+def _import_keras():
+    """
+    Import TensorFlow and Keras. Processes that only run NumPy inference
+    never call it and save the TensorFlow start-up time and memory.
+    """
+    global tf, K, load_model, EarlyStopping, LambdaCallback
+    global Lambda, Input, Dense, _Model, mean_squared_error, regularizers
+
+    if tf is not None:
+        return
+
+    import tensorflow as tf
+    tf.logging.set_verbosity(tf.logging.ERROR)
+    from tensorflow.contrib.keras.api.keras import backend as K
+    from tensorflow.contrib.keras.api.keras.models import load_model
+    from tensorflow.contrib.keras.api.keras.callbacks import EarlyStopping
+    from tensorflow.contrib.keras.api.keras.callbacks import LambdaCallback
+    from tensorflow.contrib.keras.api.keras.layers import Lambda, Input, Dense
+    from tensorflow.contrib.keras.api.keras.models import Model as _Model
+    from tensorflow.contrib.keras.api.keras.losses import mean_squared_error
+    from tensorflow.contrib.keras.api.keras import regularizers
+
 
 # reparameterization trick
 # instead of sampling from Q(z|X), sample eps = N(0,I)
@@ -151,6 +201,32 @@ def _get_decoder(_keras_model):
     return new_model
 
 
+def _get_imputer(encoder, decoder, mcmc_count, sample=False):
+    """
+    Build a function running `mcmc_count` MCMC missing data imputation
+    iterations in a single session call
+
+    Missing points are reconstructed from sampled latent vectors if
+    `sample` is set, from their mean otherwise.
+    """
+    _, W = encoder.inputs[0].get_shape()
+    x = K.placeholder(shape=(None, int(W)))
+    missing = K.placeholder(shape=(None, int(W)), dtype='bool')
+    aux = K.cast(missing, K.floatx())
+
+    def body(i, x_):
+        z_mean, _, z = encoder.call([x_, aux])
+        x_decoded = decoder.call(z if sample else z_mean)
+        return i + 1, tf.where(missing, x_decoded, x_)
+
+    _, x_imputed = tf.while_loop(
+        lambda i, _: i < mcmc_count,
+        body,
+        [tf.constant(0), x],
+    )
+    return K.function([x, missing], [x_imputed])
+
+
 def _get_index(d, from_date, step):
     return int((make_ts(d) - make_ts(from_date)) / step)
 
@@ -166,6 +242,62 @@ def _format_windows(from_date, to_date, step, windows):
     return abnormal
 
 
+def _moments(x):
+    """
+    Return the count, mean and sum of squared deviations of the values
+    of `x` that are not NaN
+    """
+    x = x[~np.isnan(x)]
+    if len(x) == 0:
+        return [0, 0.0, 0.0]
+    mean = x.mean()
+    return [len(x), float(mean), float(((x - mean) ** 2).sum())]
+
+
+def _merge_moments(a, b):
+    """
+    Merge the _moments() of two datasets
+
+    # Reference:
+    - Chan, Golub, LeVeque, "Updating Formulae and a Pairwise Algorithm
+      for Computing Sample Variances", 1979
+    """
+    count_a, mean_a, m2_a = a
+    count_b, mean_b, m2_b = b
+    count = count_a + count_b
+    if count == 0:
+        return [0, 0.0, 0.0]
+    delta = mean_b - mean_a
+    return [
+        count,
+        mean_a + delta * count_b / count,
+        m2_a + m2_b + delta ** 2 * count_a * count_b / count,
+    ]
+
+
+def _reservoir_sample(reservoir, seen, windows, size=g_replay_size):
+    """
+    Add `windows` to a uniform sample of at most `size` windows out of the
+    `seen` ones so far (reservoir sampling)
+
+    Return the new sample and number of windows seen.
+    """
+    nb_fill = max(0, min(size - len(reservoir), len(windows)))
+    reservoir = np.concatenate([reservoir, windows[:nb_fill]])
+    seen += nb_fill
+
+    others = windows[nb_fill:]
+    if len(others):
+        # The i-th window replaces a random one with probability size/(i+1)
+        slots = np.random.random_sample(len(others))
+        slots = (slots * (seen + 1 + np.arange(len(others)))).astype(int)
+        keep = slots < size
+        reservoir[slots[keep]] = others[keep]
+        seen += len(others)
+
+    return reservoir, seen
+
+
 def _get_scores(y, _mean, _std):
     y = (y - _mean) / _std
     return y
@@ -176,6 +308,143 @@ def _revert_scores(y, _mean, _std):
     return y
 
 
+def _get_mc_chunk_size(mc_count, row_size, memory_limit, itemsize=4):
+    """
+    Compute how many windows can be integrated at once without exceeding
+    `memory_limit` MB, given the number of values computed per MC sample
+    """
+    sample_size = mc_count * row_size * itemsize
+    return max(1, int(memory_limit * 1024 * 1024 / sample_size))
+
+
+_PRIMES = [2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37]
+
+_mc_epsilon_cache = {}
+
+
+def _halton(count, dim):
+    """
+    First `count` points of the Halton low-discrepancy sequence in ]0, 1[^dim
+    """
+    if dim > len(_PRIMES):
+        raise errors.Invalid("latent dimension is too large for Halton sampling")
+
+    seq = np.empty((count, dim), dtype=float)
+    for d, base in enumerate(_PRIMES[:dim]):
+        i = np.arange(1, count + 1)
+        f = 1.0
+        r = np.zeros((count,), dtype=float)
+        while np.any(i > 0):
+            f /= base
+            r += f * (i % base)
+            i //= base
+        seq[:, d] = r
+    return seq
+
+
+def _get_mc_epsilon(sampling, count, latent_dim):
+    """
+    Return a (count, latent_dim) matrix of N(0, I) samples for the MC
+    integration, shared by all windows. Return None for plain random
+    sampling, fresh samples are then drawn for every window.
+    """
+    if sampling == 'random':
+        return None
+
+    key = (sampling, count, latent_dim)
+    epsilon = _mc_epsilon_cache.get(key)
+    if epsilon is not None:
+        return epsilon
+
+    if sampling == 'antithetic':
+        # Interleave (e, -e) pairs so that every even prefix is balanced
+        half = np.random.normal(size=((count + 1) // 2, latent_dim))
+        epsilon = np.empty((2 * len(half), latent_dim), dtype=float)
+        epsilon[0::2] = half
+        epsilon[1::2] = -half
+        epsilon = epsilon[:count]
+    elif sampling == 'halton':
+        epsilon = norm.ppf(_halton(count, latent_dim))
+    else:
+        raise errors.Invalid("unknown sampling mode '{}'".format(sampling))
+
+    _mc_epsilon_cache[key] = epsilon
+    return epsilon
+
+
+def _mc_integrate(
+    decode,
+    z_mean,
+    z_std,
+    batch_count,
+    max_count,
+    tolerance=None,
+    epsilon=None,
+    min_count=None,
+):
+    """
+    Estimate the std of the last reconstructed bucket of each window using
+    Monte Carlo integration over Q(z|X) ~ N(z_mean, z_std^2).
+
+    Samples are drawn `batch_count` at a time. With a `tolerance`, the
+    integration of a window stops as soon as `min_count` samples (by
+    default `batch_count`) are drawn and the relative change of its std
+    estimate over the second half of the last batch falls below it,
+    otherwise `max_count` samples are always drawn.
+
+    If `epsilon` is given, its rows are used as N(0, I) samples for every
+    window instead of random draws.
+    """
+    nb_windows, latent_dim = z_mean.shape
+    total = np.zeros((nb_windows,), dtype=float)
+    total_sq = np.zeros((nb_windows,), dtype=float)
+    std = np.zeros((nb_windows,), dtype=float)
+    count = 0
+    active = np.arange(nb_windows)
+    if min_count is None:
+        min_count = batch_count
+
+    while len(active) > 0:
+        size = min(batch_count, max_count - count)
+        # reparameterization trick, see sampling()
+        if epsilon is None:
+            eps = np.random.normal(size=(len(active), size, latent_dim))
+        else:
+            eps = epsilon[np.newaxis, count:count + size]
+        Z = z_mean[active, np.newaxis] + z_std[active, np.newaxis] * eps
+        x_decoded = decode(Z.reshape(-1, latent_dim))
+        y = x_decoded[:, -1].reshape(len(active), size).astype(float)
+
+        # Previous estimate, without the second half of the batch
+        half = size // 2
+        prev_count = count + half
+        prev_total = total[active] + y[:, :half].sum(axis=1)
+        prev_total_sq = total_sq[active] + (y[:, :half] ** 2).sum(axis=1)
+
+        total[active] += y.sum(axis=1)
+        total_sq[active] += (y ** 2).sum(axis=1)
+        count += size
+
+        mean = total[active] / count
+        std[active] = np.sqrt(np.maximum(total_sq[active] / count - mean ** 2, 0))
+
+        if count >= max_count:
+            converged = np.full((len(active),), True, dtype=bool)
+        elif tolerance and count >= min_count and prev_count > 0:
+            prev_mean = prev_total / prev_count
+            prev_std = np.sqrt(np.maximum(
+                prev_total_sq / prev_count - prev_mean ** 2,
+                0,
+            ))
+            converged = np.abs(std[active] - prev_std) <= tolerance * std[active]
+        else:
+            converged = np.full((len(active),), False, dtype=bool)
+
+        active = active[~converged]
+
+    return std
+
+
 class HyperParameters:
     """Hyperparameters"""
 
@@ -226,33 +495,154 @@ def _load_keras_model(model_b64):
     try:
         with os.fdopen(fd, 'wb') as tmp:
             tmp.write(base64.b64decode(model_b64.encode('utf-8')))
-            tmp.close()
+        return _load_keras_model_file(path)
     finally:
-        keras_model = load_model(path, compile=False)
-        opened_new_file = not isinstance(path, h5py.File)
-        if opened_new_file:
-            f = h5py.File(path, mode='r')
-        else:
-            f = path
+        os.remove(path)
+
+
+def _load_keras_model_file(path):
+    """
+    Load a Keras model saved in a HDF5 file
+    """
+    keras_model = load_model(path, compile=False)
+    with h5py.File(path, mode='r') as f:
         training_config = f.attrs.get('training_config')
-        optimizer_cls = None
-        if training_config is None:
-            optimizer_cls = tf.keras.optimizers.Adam()
-        else:
-            training_config = json.loads(training_config.decode('utf-8'))
-            optimizer_config = training_config['optimizer_config']
-            optimizer_cls = tf.keras.optimizers.deserialize(optimizer_config)
+    optimizer_cls = None
+    if training_config is None:
+        optimizer_cls = tf.keras.optimizers.Adam()
+    else:
+        training_config = json.loads(training_config.decode('utf-8'))
+        optimizer_config = training_config['optimizer_config']
+        optimizer_cls = tf.keras.optimizers.deserialize(optimizer_config)
+
+    _, W = keras_model.inputs[0].get_shape()
+    add_loss(keras_model, int(W))
+    keras_model.compile(
+        optimizer=optimizer_cls,
+    )
+
+    return keras_model
+
+
+def _export_weights(model_b64):
+    """
+    Extract the Donut layer weights from a serialized Keras model.
 
-        if opened_new_file:
-            f.close()
+    Only h5py is required, TensorFlow is not imported.
+    """
+    import tempfile
+    import base64
+
+    fd, path = tempfile.mkstemp()
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            tmp.write(base64.b64decode(model_b64.encode('utf-8')))
+        return _export_weights_file(path, mmap=False)
+    finally:
         os.remove(path)
-        _, W = keras_model.inputs[0].get_shape()
-        add_loss(keras_model, int(W))
-        keras_model.compile(
-            optimizer=optimizer_cls,
-        )
 
-    return keras_model
+
+def _read_weight(path, dataset, mmap):
+    """
+    Read a HDF5 dataset, memory-mapped if possible
+    """
+    offset = dataset.id.get_offset()
+    if not mmap or offset is None or dataset.chunks is not None:
+        return np.array(dataset)
+    return np.memmap(
+        path,
+        dtype=dataset.dtype,
+        mode='r',
+        offset=offset,
+        shape=dataset.shape,
+    )
+
+
+def _export_weights_file(path, mmap=True):
+    """
+    Extract the Donut layer weights from a Keras model HDF5 file.
+
+    Weights are memory-mapped, if `mmap`, so that the processes using
+    the same file share them.
+    """
+    weights = {}
+    with h5py.File(path, mode='r') as f:
+        model_weights = f['model_weights']
+        for layer_name in model_weights.attrs['layer_names']:
+            group = model_weights[layer_name]
+            weight_names = group.attrs['weight_names']
+            if len(weight_names) == 0:
+                continue
+            if isinstance(layer_name, bytes):
+                layer_name = layer_name.decode('utf-8')
+            # [kernel, bias]
+            weights[layer_name] = [
+                _read_weight(path, group[weight_name], mmap)
+                for weight_name in weight_names
+            ]
+
+    # The first Dense layer of the encoder is the only unnamed one
+    named = ['z_mean', 'z_log_var', 'dense_1', 'dense_2']
+    hidden = [name for name in weights.keys() if name not in named]
+    if len(hidden) != 1 or any(name not in weights for name in named):
+        raise errors.Invalid("unexpected layers in Donut model")
+    weights['hidden'] = weights.pop(hidden[0])
+
+    return weights
+
+
+def _relu(x):
+    return np.maximum(x, 0)
+
+
+class NumpyNetwork:
+    """
+    Donut encoder and decoder implemented with NumPy, for inference only
+    """
+
+    def __init__(self, weights):
+        self.hidden = weights['hidden']
+        self.z_mean = weights['z_mean']
+        self.z_log_var = weights['z_log_var']
+        self.dense_1 = weights['dense_1']
+        self.dense_2 = weights['dense_2']
+        self.dtype = self.hidden[0].dtype
+
+    @property
+    def latent_dim(self):
+        return self.z_mean[0].shape[1]
+
+    @property
+    def intermediate_dim(self):
+        return self.dense_1[0].shape[1]
+
+    def encode(self, x):
+        """
+        Return mean and log of variance of Q(z|X)
+        """
+        x = np.asarray(x, dtype=self.dtype)
+        h = _relu(np.dot(x, self.hidden[0]) + self.hidden[1])
+        z_mean = np.dot(h, self.z_mean[0]) + self.z_mean[1]
+        z_log_var = np.dot(h, self.z_log_var[0]) + self.z_log_var[1]
+        return z_mean, z_log_var
+
+    def decode(self, z):
+        """
+        Reconstruct windows from latent vectors
+        """
+        z = np.asarray(z, dtype=self.dtype)
+        h = _relu(np.dot(z, self.dense_1[0]) + self.dense_1[1])
+        return np.dot(h, self.dense_2[0]) + self.dense_2[1]
+
+    def impute(self, x, missing, mcmc_count):
+        """
+        Replace missing points by their MCMC reconstruction
+        """
+        x_ = np.array(x, dtype=self.dtype)
+        for _ in range(mcmc_count):
+            z_mean, _ = self.encode(x_)
+            x_ = np.where(missing, self.decode(z_mean), x_)
+        return x_
 
 
 class TimeSeriesPrediction:
@@ -399,24 +789,645 @@ class TimeSeriesPrediction:
         plt.show()
 
 
-def generator(x, missing, batch_size, model):
-    batch_x = np.zeros((batch_size, x.shape[1]))
-    batch_missing = np.zeros((batch_size, x.shape[1]))
+def _sliding_window(x, W):
+    """
+    Return a read-only view of all the `W` long windows of 1-D array `x`
+    """
+    x = np.ascontiguousarray(x)
+    count = max(0, len(x) - W + 1)
+    windows = np.lib.stride_tricks.as_strided(
+        x,
+        shape=(count, W),
+        strides=(x.strides[0], x.strides[0]),
+    )
+    windows.flags.writeable = False
+    return windows
+
+
+def _window_hashes(x, missing, strata, resolution, chunk_size=4096):
+    """
+    Hash windows rounded to `resolution`, with their missing points and
+    stratum
+
+    Digests are SHA-1 ones, collisions are not a concern.
+    """
+    W = x.shape[1]
+    hashes = np.empty(len(x), dtype='S20')
+
+    for start in range(0, len(x), chunk_size):
+        end = start + chunk_size
+        keys = np.empty((len(x[start:end]), 2 * W + 1), dtype=np.int64)
+        keys[:, 0] = strata[start:end]
+        keys[:, 1:W + 1] = np.rint(x[start:end] / resolution)
+        keys[:, W + 1:] = missing[start:end]
+        hashes[start:end] = [
+            hashlib.sha1(key.tobytes()).digest()
+            for key in keys
+        ]
+    return hashes
+
+
+def _reduce_windows(
+    x,
+    missing,
+    strata,
+    max_windows,
+    resolution=g_window_resolution,
+):
+    """
+    Select at most `max_windows` windows representing all of them
+
+    Windows that are identical once rounded to `resolution`, such as
+    flatlines, are merged. If there are too many windows left, they are
+    sampled in each stratum in proportion to the stratum size.
+
+    Return the indices of the selected windows and the probabilities to
+    sample them so that the training set distribution is preserved.
+    """
+    _, index, counts = np.unique(
+        _window_hashes(x, missing, strata, resolution),
+        return_index=True,
+        return_counts=True,
+    )
+    weights = counts.astype(float)
+
+    if len(index) > max_windows:
+        index_strata = strata[index]
+        labels, sizes = np.unique(index_strata, return_counts=True)
+
+        # Largest remainder allocation of the windows to the strata
+        quotas = sizes * max_windows / len(index)
+        allocs = np.floor(quotas).astype(int)
+        extra = max_windows - allocs.sum()
+        allocs[np.argsort(allocs - quotas)[:extra]] += 1
+
+        selected = []
+        for label, alloc in zip(labels, allocs):
+            if alloc == 0:
+                continue
+            members = np.flatnonzero(index_strata == label)
+            chosen = np.random.choice(members, alloc, replace=False)
+            # Chosen windows stand for the whole stratum
+            weights[chosen] *= weights[members].sum() / weights[chosen].sum()
+            selected.append(chosen)
+
+        selected = np.concatenate(selected)
+        index, weights = index[selected], weights[selected]
+
+    order = np.argsort(index)
+    return index[order], weights[order] / weights.sum()
+
+
+def generator(x, missing, batch_size, imputer, weights=None):
+    """
+    Generate training batches of random windows
+
+    Windows are drawn with probabilities `weights`, if any, uniformly
+    otherwise. Points are randomly flagged as missing with ratio
+    `g_lambda`, then all the missing points of the batch are filled in a
+    single `imputer` call.
+    """
+    if weights is not None:
+        cdf = np.cumsum(weights)
+        cdf /= cdf[-1]
+
     while True:
-        abnormal = np.random.binomial(1, g_lambda, x.shape[1])
-        for i in range(batch_size):
-            index = random.randint(0, len(x)-1)
-            batch_x[i] = x[index]
-            batch_missing[i] = np.maximum(
-                abnormal,
-                missing[index],
+        if weights is None:
+            index = np.random.randint(0, len(x), size=batch_size)
+        else:
+            index = np.searchsorted(
+                cdf,
+                np.random.random_sample(batch_size),
+                side='right',
             )
+        abnormal = np.random.binomial(1, g_lambda, (batch_size, x.shape[1]))
+        batch_missing = np.logical_or(abnormal, missing[index])
+        batch_x, = imputer([x[index], batch_missing])
+        yield ([batch_x, batch_missing.astype(float)], None)
+
+
+def _fmin(
+    evaluate,
+    space,
+    max_evals,
+    trials,
+    batch_size=1,
+    checkpoint=None,
+    points=None,
+):
+    """
+    Minimize over `space` with TPE, like hyperopt.fmin() but suggesting
+    `batch_size` parameter sets at a time.
+
+    `evaluate` takes a list of parameter sets and yields hyperopt results.
+    `checkpoint` is called with all the completed trials after each one.
+    `points` are hyperopt values to evaluate first.
+
+    Suggestions of a batch are drawn again if another one of the batch has
+    the same parameters. Those still duplicated are evaluated once and
+    share the result.
+    """
+    domain = base.Domain(lambda params: None, space)
+    rstate = np.random.RandomState()
+    points = list(points or [])
+
+    def params_key(doc):
+        params = space_eval(space, base.spec_from_misc(doc['misc']))
+        return repr(sorted(params.items())), params
+
+    while len(trials) < max_evals:
+        docs = []
+        batch = collections.OrderedDict()
+        for tid in trials.new_trial_ids(min(batch_size, max_evals - len(trials))):
+            if points:
+                doc = _new_trial_doc(
+                    trials,
+                    tid,
+                    points.pop(0),
+                    domain.new_result(),
+                )
+            else:
+                for _ in range(g_max_suggest_tries):
+                    doc, = tpe.suggest(
+                        [tid],
+                        domain,
+                        trials,
+                        rstate.randint(2 ** 31 - 1),
+                    )
+                    if params_key(doc)[0] not in batch:
+                        break
+
+            key, params = params_key(doc)
+            batch.setdefault(key, (params, []))[1].append(doc)
+            docs.append(doc)
+
+        done = []
+        results = evaluate([params for params, _ in batch.values()])
+        for (_, same_docs), result in zip(batch.values(), results):
+            for doc in same_docs:
+                doc['state'] = base.JOB_STATE_DONE
+                doc['result'] = copy.deepcopy(result)
+                done.append(doc)
+            if checkpoint is not None:
+                checkpoint(trials.trials + done)
+
+        trials.insert_trial_docs(docs)
+        trials.refresh()
+
+    return _best_trial(trials)
+
+
+def _best_trial(trials):
+    """
+    Return the successful trial with the lowest loss, pruned trials and
+    trials of previous trainings excepted
+    """
+    candidates = [
+        trial for trial in trials.trials
+        if trial['result']['status'] == STATUS_OK
+        and not trial['result'].get('pruned')
+        and not trial['result'].get('prior')
+    ]
+    if not candidates:
+        raise ValueError("no successful trial")
+    return min(candidates, key=lambda trial: trial['result']['loss'])
+
+
+def _json_scalar(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
 
-        for _ in range(g_mcmc_count):
-            x_decoded, _ = model.predict([batch_x, batch_missing], batch_size=g_mc_batch_size)
-            batch_x[batch_missing > 0] = x_decoded[batch_missing > 0]
 
-        yield ([batch_x, batch_missing], None)
+def _find_spans(dataset, min_span, max_span, count=g_max_span_candidates):
+    """
+    Return up to `count` span candidates in [min_span, max_span): the lags
+    of the highest autocorrelation peaks of `dataset`, or None if it shows
+    no periodicity in this range
+    """
+    x = np.asarray(dataset, dtype=float)
+    valid = ~np.isnan(x)
+    nb_valid = valid.sum()
+    if nb_valid < 2:
+        return None
+
+    # Remove the linear trend, it would correlate all lags
+    t = np.arange(len(x))
+    trend = np.polyval(np.polyfit(t[valid], x[valid], 1), t)
+    x = np.where(valid, x - trend, 0.0)
+
+    # Wiener-Khinchin theorem, the zero-padding avoids circular correlation
+    size = 1 << (2 * len(x) - 1).bit_length()
+    spectrum = np.fft.rfft(x, size)
+    acf = np.fft.irfft(spectrum * np.conj(spectrum), size)[:len(x)]
+    if acf[0] <= 1e-12 * nb_valid:
+        # Constant data
+        return None
+    acf /= acf[0]
+
+    # Only lags up to half the data length have enough support
+    lags = np.arange(max(1, min_span), min(max_span, len(x) // 2))
+    if len(lags) == 0:
+        return None
+
+    # Significant local maxima, well above the white noise level
+    is_peak = (acf[lags] > acf[lags - 1]) \
+        & (acf[lags] >= acf[lags + 1]) \
+        & (acf[lags] > max(g_span_min_acf, 4 / np.sqrt(nb_valid)))
+    peaks = lags[is_peak]
+    if len(peaks) == 0:
+        return None
+
+    best = peaks[np.argsort(-acf[peaks], kind='stable')[:count]]
+    return sorted(int(lag) for lag in best)
+
+
+def _new_trial_doc(trials, tid, vals, result):
+    """
+    Build a trial document from hyperopt values
+    """
+    misc = {
+        'tid': tid,
+        'cmd': None,
+        'workdir': None,
+        'idxs': {
+            label: [tid] * len(values)
+            for label, values in vals.items()
+        },
+        'vals': vals,
+    }
+    doc, = trials.new_trial_docs([tid], [None], [result], [misc])
+    return doc
+
+
+def find_priors(storage, model, limit=g_max_warm_start):
+    """
+    Return the best parameters of the trained models that look like `model`,
+    those created from the same template first, then those with the same
+    bucket interval
+
+    Candidates are selected from the storage catalog, only their metadata
+    is read.
+    """
+    template = model.settings.get('template')
+    candidates = []
+
+    for entry in storage.find_models(model_type=model.type, trained=True):
+        name = entry['name']
+        if name == model.name:
+            continue
+        try:
+            data = storage.get_model_meta(name)
+            settings = data['settings']
+            best_params = (data.get('state') or {}).get('best_params')
+            if not best_params:
+                continue
+
+            rank = 0
+            if template is not None and settings.get('template') == template:
+                rank += 2
+            bucket_interval = parse_timedelta(settings['bucket_interval'])
+        except (errors.LoudMLException, KeyError, TypeError) as exn:
+            logging.warning("cannot read model '%s': %s", name, exn)
+            continue
+
+        if bucket_interval.total_seconds() == model.bucket_interval:
+            rank += 1
+        if rank > 0:
+            candidates.append((rank, best_params))
+
+    priors = []
+    for _, params in sorted(candidates, key=lambda item: -item[0]):
+        if params not in priors:
+            priors.append(params)
+        if len(priors) == limit:
+            break
+    return priors
+
+
+def _dump_trials(docs, space, key, span_candidates=None):
+    """
+    Serialize completed trials, `space` and `key` identify the search
+    space and the training job. The `span_candidates` of the job are
+    saved with them.
+    """
+    trials = []
+    for doc in docs:
+        result = {
+            name: _json_scalar(value)
+            for name, value in doc['result'].items()
+            if name != 'model_path'
+        }
+        if 'rung_losses' in result:
+            result['rung_losses'] = [
+                _json_scalar(loss) for loss in result['rung_losses']
+            ]
+        trials.append({
+            'vals': {
+                label: [_json_scalar(value) for value in values]
+                for label, values in doc['misc']['vals'].items()
+            },
+            'result': result,
+        })
+
+    return {
+        'space': space,
+        'key': key,
+        'span_candidates': span_candidates,
+        'trials': trials,
+    }
+
+
+def _load_trials(data, space, key, model=None):
+    """
+    Rebuild the trials saved by _dump_trials() for the same search space.
+
+    Trials of another training job are flagged as prior ones: they guide
+    the search but their loss was computed on other data. Their values are
+    converted to the span candidates of `model`, if any.
+    """
+    trials = Trials()
+    if not data or data.get('space') != space:
+        return trials
+
+    items = []
+    for item in data.get('trials', []):
+        vals = item['vals']
+        result = dict(item['result'])
+        if data.get('key') != key:
+            result['prior'] = True
+            if model is not None:
+                try:
+                    vals = model.convert_hp_vals(
+                        vals,
+                        data.get('span_candidates'),
+                    )
+                except (IndexError, ValueError):
+                    continue
+        items.append((vals, result))
+
+    prior = [item for item in items if item[1].get('prior')]
+    current = [item for item in items if not item[1].get('prior')]
+    items = prior[-g_max_prior_trials:] + current
+
+    docs = []
+    for tid, (vals, result) in zip(trials.new_trial_ids(len(items)), items):
+        doc = _new_trial_doc(trials, tid, vals, result)
+        doc['state'] = base.JOB_STATE_DONE
+        docs.append(doc)
+
+    trials.insert_trial_docs(docs)
+    trials.refresh()
+    return trials
+
+
+def _nbytes(x):
+    """
+    Return the size of the memory referenced by an array or a strided view
+    """
+    if x.size == 0:
+        return 0
+    return x.itemsize + sum(
+        (dim - 1) * abs(stride)
+        for dim, stride in zip(x.shape, x.strides)
+    )
+
+
+class WindowCache:
+    """
+    Training and validation windows of a scaled dataset, memoized per span
+    (see DonutModel.split_windows())
+
+    Trials that sample the same span share the same windows. The least
+    recently used spans are evicted once the cached arrays exceed
+    `memory_limit` MB.
+    """
+
+    def __init__(
+        self,
+        dataset,
+        train_size=0.67,
+        abnormal=None,
+        from_ts=None,
+        memory_limit=g_window_cache_memory,
+    ):
+        self.dataset = dataset
+        self.train_size = train_size
+        self.abnormal = abnormal
+        self.from_ts = from_ts
+        self.memory_limit = memory_limit * 2**20
+        self.size = 0
+        self._splits = collections.OrderedDict()
+
+    def split(self, model):
+        """
+        Return the windows of model.split_windows() for the model span
+        """
+        span = model.W
+        split = self._splits.get(span)
+        if split is not None:
+            self._splits.move_to_end(span)
+            return split
+
+        train, (X_miss_val, X_test) = model.split_windows(
+            self.dataset,
+            train_size=self.train_size,
+            abnormal=self.abnormal,
+            from_ts=self.from_ts,
+        )
+        # Training windows are consumed batch per batch, validation
+        # windows are used as a whole by every epoch
+        split = (
+            train,
+            (np.ascontiguousarray(X_miss_val), np.ascontiguousarray(X_test)),
+        )
+        size = self._split_size(split)
+        if size > self.memory_limit:
+            return split
+
+        while self.size + size > self.memory_limit:
+            _, evicted = self._splits.popitem(last=False)
+            self.size -= self._split_size(evicted)
+
+        self._splits[span] = split
+        self.size += size
+        return split
+
+    @staticmethod
+    def _split_size(split):
+        return sum(
+            _nbytes(x)
+            for part in split
+            for x in part
+            if x is not None
+        )
+
+
+class SuccessiveHalving:
+    """
+    Successive halving scheduler
+
+    Trials are trained by increasing epoch budgets, and stopped at each
+    budget (rung) unless their loss is among the best 1/`reduction_factor`
+    losses of the trials that reached the same rung.
+    """
+
+    def __init__(self, min_epochs, reduction_factor=3, rungs=None):
+        self.min_epochs = min_epochs
+        self.reduction_factor = reduction_factor
+        # Losses of the other trials, by rung
+        self.rungs = rungs or {}
+        # Losses of this trial, by rung
+        self.losses = []
+        self.pruned = False
+        # Inference cost of the network of this trial, if measured
+        self.inference_cost = None
+
+    def budgets(self, max_epochs):
+        """
+        Cumulative number of epochs of each rung
+        """
+        budgets = []
+        epochs = self.min_epochs
+        while epochs < max_epochs:
+            budgets.append(epochs)
+            epochs *= self.reduction_factor
+        budgets.append(max_epochs)
+        return budgets
+
+    def promote(self, loss):
+        """
+        Record the loss of the current rung, return True if the trial
+        should go on to the next one
+        """
+        rung = len(self.losses)
+        self.losses.append(loss)
+
+        losses = sorted(self.rungs.get(rung, []) + [loss])
+        if len(losses) < self.reduction_factor:
+            # Not enough trials to compare with
+            return True
+        if loss <= losses[len(losses) // self.reduction_factor - 1]:
+            return True
+
+        self.pruned = True
+        return False
+
+
+g_trial = None
+
+
+def _init_trial_process(settings, dataset, kwargs):
+    global g_trial
+    g_trial = (DonutModel(settings), dataset, kwargs)
+
+
+def _evaluate_trial(args):
+    params, rungs = args
+    model, dataset, kwargs = g_trial
+    return model._evaluate_params(dataset, params, rungs=rungs, **kwargs)
+
+
+def _trial_process_main(fd):
+    """
+    Entry point of the trial processes started by TrialPool
+    """
+    with socket.socket(fileno=fd) as sock, sock.makefile('rwb') as stream:
+        _init_trial_process(*pickle.load(stream))
+        while True:
+            try:
+                args = pickle.load(stream)
+            except EOFError:
+                break
+            pickle.dump(_evaluate_trial(args), stream)
+            stream.flush()
+
+
+@contextlib.contextmanager
+def _no_trial_pool():
+    """
+    Stand for a TrialPool when trials run in the training process
+    """
+    yield None
+
+
+class TrialPool:
+    """
+    Pool of processes to evaluate hyperparameter sets concurrently
+
+    Training jobs may run in daemonic pool workers, which multiprocessing
+    does not allow to have children: trial processes are new interpreters
+    started with subprocess. They do not inherit the TensorFlow state of
+    the parent either.
+    """
+
+    def __init__(self, processes, settings, dataset, kwargs):
+        self._procs = []
+        self._streams = []
+
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        try:
+            for _ in range(processes):
+                parent, child = socket.socketpair()
+                with parent, child:
+                    self._procs.append(subprocess.Popen(
+                        [
+                            sys.executable,
+                            '-c',
+                            'import loudml.donut; '
+                            'loudml.donut._trial_process_main({})'.format(
+                                child.fileno(),
+                            ),
+                        ],
+                        pass_fds=[child.fileno()],
+                        env=env,
+                    ))
+                    self._streams.append(parent.makefile('rwb'))
+
+                pickle.dump((settings, dataset, kwargs), self._streams[-1])
+                self._streams[-1].flush()
+        except Exception:
+            self.close()
+            raise
+
+    def imap(self, args_list):
+        """
+        Evaluate the (params, rungs) tuples of `args_list`, yield the
+        results in order
+        """
+        args_list = list(args_list)
+        count = len(self._streams)
+        for i in range(0, len(args_list), count):
+            chunk = args_list[i:i + count]
+            for stream, args in zip(self._streams, chunk):
+                pickle.dump(args, stream)
+                stream.flush()
+            for stream, _ in zip(self._streams, chunk):
+                try:
+                    yield pickle.load(stream)
+                except EOFError:
+                    raise errors.LoudMLException("trial process exited")
+
+    def close(self):
+        for stream in self._streams:
+            try:
+                stream.close()
+            except OSError:
+                pass
+        for proc in self._procs:
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+        self._streams = []
+        self._procs = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
 
 class DonutModel(Model):
@@ -438,6 +1449,15 @@ class DonutModel(Model):
         Optional('forecast'): Any(None, "auto", All(int, Range(min=1))),
         Optional('grace_period', default=0): schemas.TimeDelta(min=0, min_included=True),
         'default_datasink': schemas.key,
+        Optional('inference_backend'): Any('keras', 'numpy'),
+        Optional('mc_min_count'): All(int, Range(min=1)),
+        Optional('mc_max_count'): All(int, Range(min=1)),
+        Optional('mc_tolerance'): Any(None, All(Any(int, float), Range(min=0))),
+        Optional('mc_sampling', default='random'): Any('random', 'antithetic', 'halton'),
+        Optional('trial_epochs'): Any(None, All(int, Range(min=1))),
+        Optional('trial_reduction_factor', default=3): All(int, Range(min=2)),
+        Optional('latency_weight', default=0): All(Any(int, float), Range(min=0)),
+        Optional('max_train_windows'): Any(None, All(int, Range(min=1))),
     })
 
     def __init__(self, settings, state=None):
@@ -457,6 +1477,13 @@ class DonutModel(Model):
         self._keras_model = None
         self._encoder_model = None
         self._decoder_model = None
+        self._imputer = None
+        self._network = None
+        self._graph = None
+        self._session = None
+        # Memory taken by loading the Keras model in its session, in bytes
+        self._session_size = 0
+        self.inference_backend = settings.get('inference_backend')
 
         if self.span is None or self.span == "auto":
             self.min_span = settings.get('min_span') or _hp_span_min
@@ -464,9 +1491,32 @@ class DonutModel(Model):
         else:
             self.min_span = self.span
             self.max_span = self.span
+        # Span values to search, if narrowed down by train()
+        self.span_candidates = None
 
         self.grace_period = parse_timedelta(settings['grace_period']).total_seconds()
 
+        self.mc_max_count = settings.get('mc_max_count', g_mc_count)
+        self.mc_min_count = settings.get(
+            'mc_min_count',
+            min(g_mc_min_count, self.mc_max_count),
+        )
+        if self.mc_min_count > self.mc_max_count:
+            raise errors.Invalid(
+                "mc_min_count must be lower than or equal to mc_max_count",
+                name="model settings",
+            )
+        self.mc_tolerance = settings.get('mc_tolerance')
+        self.mc_sampling = settings['mc_sampling']
+        self.trial_epochs = settings.get('trial_epochs')
+        self.trial_reduction_factor = settings['trial_reduction_factor']
+        self.latency_weight = settings['latency_weight']
+        self.max_train_windows = settings.get('max_train_windows')
+        # Inference time per bucket of the trained network, in ms
+        self.inference_cost = None
+        # Training job of the last hyperparameter search
+        self.job_key = None
+
         self.current_eval = None
         if len(self.features) > 1:
             raise errors.LoudMLException("This model type supports one unique feature")
@@ -487,12 +1537,79 @@ class DonutModel(Model):
         return self.span
 
     def get_hp_span(self, label):
+        if self.span_candidates:
+            return hp.choice(label, self.span_candidates)
         if (self.max_span - self.min_span) <= 0:
             space = self.span
         else:
             space = self.min_span + hp.randint(label, (self.max_span - self.min_span))
         return space
 
+    def get_hp_space(self):
+        """
+        Return the hyperparameter search space
+        """
+        return hp.choice('case', [
+            {
+              'span': self.get_hp_span('span'),
+              'latent_dim': hp.choice('latent_dim', g_latent_dims),
+              'intermediate_dim': hp.choice('i1', g_intermediate_dims),
+              'optimizer': hp.choice('optimizer', g_optimizers),
+            }
+        ])
+
+    def get_hp_vals(self, params):
+        """
+        Convert hyperparameters into the hyperopt values of the search space.
+
+        Raise ValueError if they are out of the search space.
+        """
+        vals = {
+            'case': [0],
+            'latent_dim': [g_latent_dims.index(params['latent_dim'])],
+            'i1': [g_intermediate_dims.index(params['intermediate_dim'])],
+            'optimizer': [g_optimizers.index(params['optimizer'])],
+        }
+        vals.update(self.get_hp_span_vals(params['span']))
+        return vals
+
+    def get_hp_span_vals(self, span):
+        """
+        Convert a span into the hyperopt values of the search space, spans
+        that are not candidates map to the nearest candidate.
+
+        Raise ValueError if it is out of the search space.
+        """
+        if self.span_candidates:
+            span = min(
+                self.span_candidates,
+                key=lambda candidate: abs(candidate - span),
+            )
+            return {'span': [self.span_candidates.index(span)]}
+        if (self.max_span - self.min_span) > 0:
+            span = span - self.min_span
+            if not 0 <= span < (self.max_span - self.min_span):
+                raise ValueError("span out of range")
+            return {'span': [span]}
+        return {}
+
+    def convert_hp_vals(self, vals, span_candidates=None):
+        """
+        Convert hyperopt values of a search with other `span_candidates`
+        into values of the search space
+        """
+        vals = dict(vals)
+        span_vals = vals.pop('span', None)
+        if not span_vals:
+            return vals
+
+        if span_candidates:
+            span = span_candidates[span_vals[0]]
+        else:
+            span = self.min_span + span_vals[0]
+        vals.update(self.get_hp_span_vals(span))
+        return vals
+
     def set_run_params(self, params=None):
         """
         Set running parameters to make them persistent
@@ -526,12 +1643,10 @@ class DonutModel(Model):
         """
         feature = self.features[0]
         if feature.default == "previous":
-            previous = None
-            for j, value in enumerate(x):
-                if np.isnan(value):
-                    x[j] = previous
-                else:
-                    previous = x[j]
+            # index of the last valid value seen at each position
+            index = np.where(np.isnan(x), 0, np.arange(len(x)))
+            np.maximum.accumulate(index, out=index)
+            x[:] = x[index]
         elif not np.isnan(feature.default):
             x[np.isnan(x)] = feature.default
 
@@ -575,26 +1690,293 @@ class DonutModel(Model):
         self.stds = np.array([np.nanstd(dataset, axis=0)])
         self.stds[self.stds == 0] = 1.0
 
-    def set_auto_threshold(self):
+    def stat_moments(self, moments):
+        """
+        Keep the statistics of _moments() as reference
+        """
+        count, mean, m2 = moments
+        self.means = np.array([mean])
+        self.stds = np.array([np.sqrt(m2 / count) if count else 0.0])
+        self.stds[self.stds == 0] = 1.0
+
+    def set_auto_threshold(self):
+        """
+        Compute best threshold values automatically
+        """
+        # 68–95–99.7 three-sigma rule
+        self.min_threshold = 68
+        self.max_threshold = 99.7
+
+    def _set_xpu_config(self, num_cpus, num_gpus, graph=None, num_threads=None):
+        _import_keras()
+        config = tf.ConfigProto(
+            allow_soft_placement=True,
+            device_count={'CPU': num_cpus, 'GPU': num_gpus},
+        )
+        config.gpu_options.allow_growth = True
+#        config.log_device_placement = True
+        if num_threads is not None:
+            config.intra_op_parallelism_threads = num_threads
+            config.inter_op_parallelism_threads = num_threads
+
+        sess = tf.Session(config=config, graph=graph)
+        K.set_session(sess)
+        return sess
+
+    @contextlib.contextmanager
+    def _keras_session(self):
+        """
+        Make the model graph and session the default ones, when the model
+        was loaded into its own graph
+        """
+        if self._graph is None:
+            yield
+            return
+
+        with self._graph.as_default(), self._session.as_default():
+            yield
+
+    def _cross_val_model(
+        self,
+        dataset,
+        params,
+        train_size=0.67,
+        batch_size=64,
+        num_epochs=100,
+        num_cpus=1,
+        num_gpus=0,
+        abnormal=None,
+        num_threads=None,
+        scheduler=None,
+        window_cache=None,
+        from_ts=None,
+    ):
+        """
+        Train and evaluate one hyperparameter set on a scaled dataset
+
+        If a successive halving `scheduler` is given, training stops as
+        soon as it prunes the trial. Windows are taken from `window_cache`,
+        if any.
+        """
+        _import_keras()
+
+        keras_model = None
+        # Destroys the current TF graph and creates a new one.
+        # Useful to avoid clutter from old models / layers.
+        K.clear_session()
+        self._set_xpu_config(num_cpus, num_gpus, num_threads=num_threads)
+
+        self.span = W = params.span
+        if window_cache is None:
+            split = self.split_windows(
+                dataset,
+                train_size=train_size,
+                abnormal=abnormal,
+                from_ts=from_ts,
+            )
+        else:
+            split = window_cache.split(self)
+        (X_miss, X_train, weights), (X_miss_val, X_test) = split
+        if len(X_train) == 0:
+            raise errors.NoData("insufficient training data")
+        if len(X_test) == 0:
+            raise errors.NoData("insufficient validation data")
+
+        # expected input data shape: (batch_size, timesteps,)
+        # network parameters
+        input_shape = (W, )
+        intermediate_dim = params.intermediate_dim
+        latent_dim = params.latent_dim
+
+        # VAE model = encoder + decoder
+        # build encoder model
+        main_input = Input(shape=input_shape)
+        aux_input = Input(shape=input_shape)  # bool vector to flag missing data points
+        aux_output = Lambda(lambda x: x)(aux_input)
+        x = Dense(intermediate_dim,
+                  kernel_regularizer=regularizers.l2(0.01),
+                  activation='relu')(main_input)
+        z_mean = Dense(latent_dim, name='z_mean')(x)
+        z_log_var = Dense(latent_dim, name='z_log_var')(x)
+
+        # use reparameterization trick to push the sampling out as input
+        # note that "output_shape" isn't necessary with the TensorFlow backend
+        z = Lambda(sampling, output_shape=(latent_dim,), name='z')([z_mean, z_log_var])
+        
+        # build decoder model
+        x = Dense(intermediate_dim,
+                  kernel_regularizer=regularizers.l2(0.01),
+                  activation='relu', name='dense_1')(z)
+        main_output = Dense(W, activation='linear', name='dense_2')(x)
+         
+        # instantiate Donut model
+        keras_model = _Model([main_input, aux_input], [main_output, aux_output], name='donut')
+        add_loss(keras_model, W)
+        optimizer_cls = None
+        if params.optimizer == 'adam':
+            optimizer_cls = tf.keras.optimizers.Adam()
+
+        keras_model.compile(
+            optimizer=optimizer_cls,
+        )
+
+        imputer = _get_imputer(
+            _get_encoder(keras_model),
+            _get_decoder(keras_model),
+            g_mcmc_count,
+            sample=True,
+        )
+        if scheduler is None:
+            budgets = [num_epochs]
+        else:
+            budgets = scheduler.budgets(num_epochs)
+
+        initial_epoch = 0
+        for epochs in budgets:
+            # Each rung has its own early stopping state
+            _stop = EarlyStopping(
+                monitor='val_loss',
+                patience=5,
+                verbose=_verbose,
+                mode='auto',
+            )
+            keras_model.fit_generator(
+                generator(X_train, X_miss, batch_size, imputer, weights),
+                epochs=epochs,
+                initial_epoch=initial_epoch,
+                steps_per_epoch=len(X_train) / batch_size,
+                verbose=_verbose,
+                validation_data=([X_test, X_miss_val], None),
+                callbacks=[_stop],
+                workers=0,  # https://github.com/keras-team/keras/issues/5511
+            )
+            initial_epoch = epochs
+
+            # How well did it do?
+            score = keras_model.evaluate(
+                [X_test, X_miss_val],
+                batch_size=batch_size,
+                verbose=_verbose,
+            )
+
+            if epochs == budgets[-1]:
+                break
+
+            # Rungs compare the objective of the search
+            loss = score
+            if self.latency_weight > 0:
+                if scheduler.inference_cost is None:
+                    scheduler.inference_cost = self._measure_inference_cost(
+                        keras_model,
+                        dataset,
+                    )
+                loss += self.latency_weight * scheduler.inference_cost
+
+            if not scheduler.promote(loss):
+                break
+            if _stop.stopped_epoch > 0:
+                # Converged before the end of the rung
+                break
+
+        return score, keras_model
+
+    def _evaluate_params(
+        self,
+        dataset,
+        params,
+        spill_dir=None,
+        rungs=None,
+        **kwargs
+    ):
+        """
+        Hyperopt objective, never raises
+
+        The trained network is saved into `spill_dir`, if any. Trials are
+        pruned by successive halving against the losses in `rungs` if the
+        model has `trial_epochs`. Pruned trials report the loss of their
+        last rung, so that TPE learns from them, and are never selected as
+        the best one.
+        """
+        scheduler = None
+        if self.trial_epochs is not None:
+            scheduler = SuccessiveHalving(
+                self.trial_epochs,
+                self.trial_reduction_factor,
+                rungs,
+            )
+
+        try:
+            score, keras_model = self._cross_val_model(
+                dataset,
+                HyperParameters(params),
+                scheduler=scheduler,
+                **kwargs
+            )
+            result = {'loss': score, 'status': STATUS_OK}
+            if scheduler is not None:
+                result['rung_losses'] = scheduler.losses
+                result['pruned'] = scheduler.pruned
+                if scheduler.pruned:
+                    result['loss'] = scheduler.losses[-1]
+                    return result
+            if self.latency_weight > 0:
+                cost = None if scheduler is None else scheduler.inference_cost
+                if cost is None:
+                    cost = self._measure_inference_cost(keras_model, dataset)
+                result['val_loss'] = score
+                result['inference_cost'] = cost
+                result['loss'] = score + self.latency_weight * cost
+            if spill_dir is not None:
+                fd, path = tempfile.mkstemp(suffix='.h5', dir=spill_dir)
+                os.close(fd)
+                keras_model.save(path)
+                result['model_path'] = path
+            return result
+        except Exception as exn:
+            logging.warning("iteration failed: %s", exn)
+            return {'loss': None, 'status': STATUS_FAIL}
+
+    def _measure_inference_cost(self, keras_model, dataset, count=32, repeat=3):
+        """
+        Measure the inference CPU time per bucket of `keras_model`, in ms
+
+        The last `count` windows of `dataset` are encoded and
+        `mc_max_count` latent samples are decoded for each of them, as done
+        by predict(). The CPU time of the process is measured rather than
+        the wall time, so that trials running in parallel do not slow down
+        each other's measures. The best of `repeat` runs is kept to reduce
+        noise.
+        """
+        _, X = self._format_dataset(dataset[-(self.W + count - 1):])
+        missing = np.zeros(X.shape)
+        encoder = _get_encoder(keras_model)
+        decoder = _get_decoder(keras_model)
+
+        best = None
+        for _ in range(repeat):
+            start = time.process_time()
+            z_mean, _, _ = encoder.predict(
+                [X, missing],
+                batch_size=g_mc_batch_size,
+            )
+            decoder.predict(
+                np.repeat(z_mean, self.mc_max_count, axis=0),
+                batch_size=g_mc_batch_size,
+            )
+            elapsed = time.process_time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+
+        return 1000 * best / len(X)
+
+    def _read_keras_model(self, path, num_cpus, num_gpus):
         """
-        Compute best threshold values automatically
+        Load a network saved by _evaluate_params() in a new session
         """
-        # 68–95–99.7 three-sigma rule
-        self.min_threshold = 68
-        self.max_threshold = 99.7
-
-    def _set_xpu_config(self, num_cpus, num_gpus):
-        config = tf.ConfigProto(
-            allow_soft_placement=True,
-            device_count={'CPU': num_cpus, 'GPU': num_gpus},
-        )
-        config.gpu_options.allow_growth = True
-#        config.log_device_placement = True
-#        config.intra_op_parallelism_threads=num_cores
-#        config.inter_op_parallelism_threads=num_cores
-
-        sess = tf.Session(config=config)
-        K.set_session(sess)
+        _import_keras()
+        K.clear_session()
+        self._set_xpu_config(num_cpus, num_gpus)
+        return _load_keras_model_file(path)
 
     def _train_on_dataset(
         self,
@@ -607,142 +1989,241 @@ class DonutModel(Model):
         max_evals=None,
         progress_cb=None,
         abnormal=None,
+        parallel_trials=1,
+        trials=None,
+        trials_cb=None,
+        priors=None,
+        window_cache_memory=None,
+        from_ts=None,
+        moments=None,
     ):
+        """
+        Search the best hyperparameters
+
+        `trials` are the ones saved by `trials_cb` by a previous training.
+        If it was interrupted, the search is resumed with the same span
+        candidates, otherwise they are used as prior knowledge. If it was
+        complete, the search is skipped and the network of the current
+        state is kept if it was trained by the same job.
+
+        `priors` are hyperparameters of similar models, they are evaluated
+        first by new searches.
+
+        If the model has a `latency_weight`, the inference CPU time per
+        bucket of each candidate is added to its validation loss with this
+        weight, including when successive halving compares them.
+        The cost of the selected network is kept in `inference_cost`.
+
+        Windows are memoized per span within `window_cache_memory` MB.
+        `from_ts` is the timestamp of the first bucket of `dataset`.
+        `moments` are the statistics to scale it with, see _moments(),
+        those of the whole `dataset` by default.
+        """
         if max_evals is None:
             max_evals = self.settings.get('max_evals', 21)  # latent_dim*intermediate_dim
 
         self.current_eval = 0
-
-        self.stat_dataset(dataset)
+        self.inference_cost = None
+
+        # Identify the training job to resume it if interrupted
+        job_key = hash_dict({
+            'dataset': hashlib.sha1(dataset.tobytes()).hexdigest(),
+            'abnormal': None if abnormal is None else \
+                hashlib.sha1(abnormal.tobytes()).hexdigest(),
+            'train_size': train_size,
+            'batch_size': batch_size,
+            'num_epochs': num_epochs,
+            'trial_epochs': self.trial_epochs,
+            'trial_reduction_factor': self.trial_reduction_factor,
+            'latency_weight': self.latency_weight,
+            'max_train_windows': self.max_train_windows,
+        })
+        self.job_key = job_key
+
+        # Identify the search space, whatever the span candidates
+        space_key = hash_dict({
+            'min_span': self.min_span,
+            'max_span': self.max_span,
+            'latent_dims': g_latent_dims,
+            'intermediate_dims': g_intermediate_dims,
+            'optimizers': g_optimizers,
+        })
+        if trials and trials.get('space') == space_key \
+           and trials.get('key') == job_key:
+            # Resume with the span candidates of the interrupted search
+            self.span_candidates = trials.get('span_candidates')
+
+        if moments is None:
+            self.stat_dataset(dataset)
+        else:
+            self.stat_moments(moments)
         dataset = self.scale_dataset(dataset)
 
-        def cross_val_model(params):
-            keras_model = None
-            # Destroys the current TF graph and creates a new one.
-            # Useful to avoid clutter from old models / layers.
-            K.clear_session()
-            self._set_xpu_config(num_cpus, num_gpus)
-
-            self.span = W = params.span
-            (X_miss, X_train), (X_miss_val, X_test) = self.train_test_split(
-                dataset,
-                train_size=train_size,
-                abnormal=abnormal,
-            )
-            if len(X_train) == 0:
-                raise errors.NoData("insufficient training data")
-            if len(X_test) == 0:
-                raise errors.NoData("insufficient validation data")
-
-            # expected input data shape: (batch_size, timesteps,)
-            # network parameters
-            input_shape = (W, )
-            intermediate_dim = params.intermediate_dim
-            latent_dim = params.latent_dim
-
-            # VAE model = encoder + decoder
-            # build encoder model
-            main_input = Input(shape=input_shape)
-            aux_input = Input(shape=input_shape)  # bool vector to flag missing data points
-            aux_output = Lambda(lambda x: x)(aux_input)
-            x = Dense(intermediate_dim,
-                      kernel_regularizer=regularizers.l2(0.01),
-                      activation='relu')(main_input)
-            z_mean = Dense(latent_dim, name='z_mean')(x)
-            z_log_var = Dense(latent_dim, name='z_log_var')(x)
-
-            # use reparameterization trick to push the sampling out as input
-            # note that "output_shape" isn't necessary with the TensorFlow backend
-            z = Lambda(sampling, output_shape=(latent_dim,), name='z')([z_mean, z_log_var])
-            
-            # build decoder model
-            x = Dense(intermediate_dim,
-                      kernel_regularizer=regularizers.l2(0.01),
-                      activation='relu', name='dense_1')(z)
-            main_output = Dense(W, activation='linear', name='dense_2')(x)
-             
-            # instantiate Donut model
-            keras_model = _Model([main_input, aux_input], [main_output, aux_output], name='donut')
-            add_loss(keras_model, W)
-            optimizer_cls = None
-            if params.optimizer == 'adam':
-                optimizer_cls = tf.keras.optimizers.Adam()
-
-            keras_model.compile(
-                optimizer=optimizer_cls,
-            )
-
-            _stop = EarlyStopping(
-                monitor='val_loss',
-                patience=5,
-                verbose=_verbose,
-                mode='auto',
-            )
-            keras_model.fit_generator(
-                generator(X_train, X_miss, batch_size, keras_model),
-                epochs=num_epochs,
-                steps_per_epoch=len(X_train) / batch_size,
-                verbose=_verbose,
-                validation_data=([X_test, X_miss_val], None),
-                callbacks=[_stop],
-                workers=0,  # https://github.com/keras-team/keras/issues/5511
-            )
-
-            # How well did it do?
-            score = keras_model.evaluate(
-                [X_test, X_miss_val],
-                batch_size=batch_size,
-                verbose=_verbose,
-            )
+        kwargs = {
+            'train_size': train_size,
+            'batch_size': batch_size,
+            'num_epochs': num_epochs,
+            'num_cpus': num_cpus,
+            'num_gpus': num_gpus,
+            'abnormal': abnormal,
+            'from_ts': from_ts,
+        }
 
+        def report_progress():
             self.current_eval += 1
             if progress_cb is not None:
                 progress_cb(self.current_eval, max_evals)
 
-            return score, keras_model
-
-        hyperparameters = HyperParameters()
-
         # Parameter search space
-        def objective(args):
-            hyperparameters.assign(args)
-
-            try:
-                score, _ = cross_val_model(hyperparameters)
-                return {'loss': score, 'status': STATUS_OK}
-            except Exception as exn:
-                logging.warning("iteration failed: %s", exn)
-                return {'loss': None, 'status': STATUS_FAIL}
+        space = self.get_hp_space()
 
-        space = hp.choice('case', [
-            {
-              'span': self.get_hp_span('span'),
-              'latent_dim': hp.choice('latent_dim', [3, 5, 8]),
-              'intermediate_dim': hp.choice('i1', [21, 34, 55, 89, 144, 233, 377]),
-              'optimizer': hp.choice('optimizer', ['adam']),
-            }
+        # The Trials object will store details of each iteration
+        trials = _load_trials(trials, space_key, job_key, self)
+        nb_prior = len([
+            trial for trial in trials.trials
+            if trial['result'].get('prior')
         ])
+        self.current_eval = len(trials) - nb_prior
+
+        points = []
+        if self.current_eval == 0:
+            for params in priors or []:
+                try:
+                    vals = self.get_hp_vals(params)
+                except (KeyError, ValueError):
+                    continue
+                if vals not in points:
+                    points.append(vals)
+
+        checkpoint = None
+        if trials_cb is not None:
+            def checkpoint(docs):
+                trials_cb(_dump_trials(
+                    docs,
+                    space_key,
+                    job_key,
+                    self.span_candidates,
+                ))
+
+        parallel_trials = max(1, min(parallel_trials, max_evals))
+
+        if window_cache_memory is None:
+            window_cache_memory = g_window_cache_memory
+        # Every trial process has its own cache
+        window_cache = WindowCache(
+            dataset,
+            train_size,
+            abnormal,
+            from_ts,
+            memory_limit=window_cache_memory / parallel_trials,
+        )
 
-        # The Trials object will store details of each iteration
-        trials = Trials()
+        # Trained networks are spilled to disk until the best one is known
+        with tempfile.TemporaryDirectory(prefix='loudml-') as spill_dir:
+            trial_kwargs = dict(
+                kwargs,
+                spill_dir=spill_dir,
+                window_cache=window_cache,
+            )
+            if parallel_trials > 1:
+                # Trial processes share the CPU budget
+                trial_kwargs['num_threads'] = max(1, num_cpus // parallel_trials)
+                pool = TrialPool(
+                    parallel_trials,
+                    self.settings,
+                    dataset,
+                    trial_kwargs,
+                )
+            else:
+                pool = _no_trial_pool()
+
+            # Losses reached by the trials at each successive halving rung
+            rungs = {}
+            for trial in trials.trials:
+                if trial['result'].get('prior'):
+                    continue
+                for rung, loss in enumerate(trial['result'].get('rung_losses', [])):
+                    rungs.setdefault(rung, []).append(loss)
+
+            with pool as trial_pool:
+                def evaluate(params_list):
+                    if parallel_trials > 1:
+                        snapshot = {
+                            rung: list(losses)
+                            for rung, losses in rungs.items()
+                        }
+                        results = trial_pool.imap(
+                            [(params, snapshot) for params in params_list],
+                        )
+                    else:
+                        results = (
+                            self._evaluate_params(
+                                dataset,
+                                params,
+                                rungs=rungs,
+                                **trial_kwargs
+                            )
+                            for params in params_list
+                        )
+                    for result in results:
+                        for rung, loss in enumerate(result.get('rung_losses', [])):
+                            rungs.setdefault(rung, []).append(loss)
+                        report_progress()
+                        yield result
+
+                # Run the hyperparameter search using the tpe algorithm,
+                # unless this job already completed it
+                try:
+                    if self.current_eval >= max_evals:
+                        best_trial = _best_trial(trials)
+                    else:
+                        best_trial = _fmin(
+                            evaluate,
+                            space,
+                            max_evals=nb_prior + max_evals,
+                            trials=trials,
+                            batch_size=parallel_trials,
+                            checkpoint=checkpoint,
+                            points=points,
+                        )
+                except ValueError:
+                    raise errors.NoData("training failed, try to increase the time range")
 
-        # Run the hyperparameter search using the tpe algorithm
-        try:
-            best = fmin(
-                objective,
+            # Get the values of the optimal parameters
+            best_params = space_eval(
                 space,
-                algo=tpe.suggest,
-                max_evals=max_evals,
-                trials=trials,
+                base.spec_from_misc(best_trial['misc']),
             )
-        except ValueError:
-            raise errors.NoData("training failed, try to increase the time range")
+            result = best_trial['result']
+            state = self._state or {}
+            if result.get('model_path') is None and \
+               state.get('job_key') == job_key and self.is_trained:
+                # The network of the current state was trained by this job
+                self._load_keras(num_cpus, num_gpus)
+                score = state['loss']
+                self.inference_cost = state.get('inference_cost')
+            elif result.get('model_path') is None:
+                score, self._keras_model = self._cross_val_model(
+                    dataset,
+                    HyperParameters(best_params),
+                    window_cache=window_cache,
+                    **kwargs
+                )
+                if self.latency_weight > 0:
+                    self.inference_cost = self._measure_inference_cost(
+                        self._keras_model,
+                        dataset,
+                    )
+            else:
+                # Adopt the network trained by the best trial
+                score = result.get('val_loss', result['loss'])
+                self.inference_cost = result.get('inference_cost')
+                self._keras_model = self._read_keras_model(
+                    result['model_path'],
+                    num_cpus,
+                    num_gpus,
+                )
 
-        # Get the values of the optimal parameters
-        best_params = space_eval(space, best)
-        score, self._keras_model = cross_val_model(
-            HyperParameters(best_params)
-        )
         self.span = best_params['span']
         return (best_params, score)
 
@@ -754,16 +2235,41 @@ class DonutModel(Model):
         num_epochs=100,
         progress_cb=None,
         abnormal=None,
+        first_new=0,
+        replay=None,
     ):
-        self.current_eval = 0
-        self.stat_dataset(dataset)
+        """
+        Fine-tune the current network on the windows ending at index
+        `first_new` or later of `dataset` and on past `replay` windows
 
-        dataset = self.scale_dataset(dataset)
+        Both are scaled with the current statistics and shuffled before
+        being split in training and validation parts. `progress_cb` is
+        called after each epoch.
+        """
+        _import_keras()
+        self.current_eval = 0
 
-        (X_miss, X_train), (X_miss_val, X_test) = self.train_test_split(
-            dataset,
-            train_size=train_size,
+        X_miss, X = self._format_dataset(
+            self.scale_dataset(dataset),
+            abnormal=abnormal,
         )
+        start = max(0, first_new - self.W + 1)
+        X_miss, X = X_miss[start:], X[start:]
+
+        if replay is not None and len(replay):
+            replay = self.scale_dataset(replay)
+            replay_miss = np.isnan(replay)
+            X_miss = np.concatenate([replay_miss, X_miss])
+            X = np.concatenate([np.where(replay_miss, 0.0, replay), X])
+
+        index = np.random.permutation(len(X))
+        ntrn = round(len(X) * train_size)
+        X_miss, X_train = X_miss[index[:ntrn]], X[index[:ntrn]]
+        X_miss_val, X_test = X_miss[index[ntrn:]], X[index[ntrn:]]
+        if len(X_train) == 0:
+            raise errors.NoData("insufficient training data")
+        if len(X_test) == 0:
+            raise errors.NoData("insufficient validation data")
 
         _stop = EarlyStopping(
             monitor='val_loss',
@@ -771,67 +2277,75 @@ class DonutModel(Model):
             verbose=_verbose,
             mode='auto',
         )
-        self._keras_model.fit(
-            [X_train, X_miss],
-            epochs=num_epochs,
-            batch_size=batch_size,
-            verbose=_verbose,
-            validation_data=([X_test, X_miss_val], None),
-            callbacks=[_stop],
-        )
+        callbacks = [_stop]
 
-        # How well did it do?
-        score = self._keras_model.evaluate(
-            [X_test, X_miss_val],
-            batch_size=batch_size,
-            verbose=_verbose,
-        )
+        if progress_cb is not None:
+            def report_progress(epoch, logs):
+                self.current_eval = epoch + 1
+                progress_cb(self.current_eval, num_epochs)
+
+            callbacks.append(LambdaCallback(on_epoch_end=report_progress))
+
+        with self._keras_session():
+            self._keras_model.fit(
+                [X_train, X_miss],
+                epochs=num_epochs,
+                batch_size=batch_size,
+                verbose=_verbose,
+                validation_data=([X_test, X_miss_val], None),
+                callbacks=callbacks,
+            )
+
+            # How well did it do?
+            score = self._keras_model.evaluate(
+                [X_test, X_miss_val],
+                batch_size=batch_size,
+                verbose=_verbose,
+            )
         return score
 
     def compute_bucket_scores(self, y_true, y_pred, y_low, y_high):
         """
         Compute scores and mean squared error
         """
+        scores, mses = self.compute_scores(
+            np.array([y_true], dtype=float),
+            np.array([y_pred], dtype=float),
+            np.array([y_low], dtype=float),
+            np.array([y_high], dtype=float),
+        )
+        return scores[0], mses[0]
+
+    def compute_scores(self, observed, predicted, low, high):
+        """
+        Compute timeseries scores and MSE
+        """
         feature = self.features[0]
 
-        diff = y_true - y_pred
+        observed = np.asarray(observed, dtype=float)
+        predicted = np.asarray(predicted, dtype=float)
+        low = np.asarray(low, dtype=float)
+        high = np.asarray(high, dtype=float)
+
+        diff = observed - predicted
         ano_type = feature.anomaly_type
-        mu = (y_low + y_high) / 2.0
-        std = (y_high - mu) / 3.0
-        score = 2 * norm.cdf(abs(y_true - mu), loc=0, scale=std) - 1
+        mu = (low + high) / 2.0
+        std = (high - mu) / 3.0
+        scores = 2 * norm.cdf(np.abs(observed - mu), loc=0, scale=std) - 1
         # Required to handle the 'low' condition
-        if diff < 0:
-            score *= -1
+        scores = np.where(diff < 0, -scores, scores)
 
         if ano_type == 'low':
-            score = -min(score, 0)
+            scores = -np.minimum(scores, 0)
         elif ano_type == 'high':
-            score = max(score, 0)
+            scores = np.maximum(scores, 0)
         else:
-            score = abs(score)
-
-        score = 100 * max(0, min(1, score))
+            scores = np.abs(scores)
 
-        mse = np.nanmean((diff ** 2), axis=None)
-        return score, mse
-
-    def compute_scores(self, observed, predicted, low, high):
-        """
-        Compute timeseries scores and MSE
-        """
-
-        nb_buckets = len(observed)
-        scores = np.empty((nb_buckets,), dtype=float)
-        mses = np.empty((nb_buckets), dtype=float)
-
-        for i in range(nb_buckets):
-            scores[i], mses[i] = self.compute_bucket_scores(
-                observed[i],
-                predicted[i],
-                low[i],
-                high[i],
-            )
+        # Undefined scores (missing observation, null std) are saturated
+        scores = 100 * np.where(np.isnan(scores), 1, np.clip(scores, 0, 1))
 
+        mses = diff ** 2
         return scores, mses
 
     def _format_dataset(self, x, accept_missing=True, abnormal=None):
@@ -854,29 +2368,29 @@ class DonutModel(Model):
         ]
 
         Buckets with missing values are flagged in the missing array.
+
+        Both arrays are read-only strided views over a single copy of `x`,
+        windows are only materialized when batches are consumed.
         """
-        missing = []
-        data_x = []
-        for i in range(len(x) - self.W + 1):
-            j = i + self.W
-            if accept_missing or not np.isnan(x[i:j]).any():
-                # arxiv.org/abs/1802.03903
-                # set user defined abnormal data points to zero
-                if abnormal is None:
-                    is_nan = np.isnan(x[i:j])
-                else:
-                    is_nan = np.logical_or(
-                        np.isnan(x[i:j]),
-                        abnormal[i:j],
-                        )
+        is_nan = np.isnan(x)
+        if abnormal is None:
+            missing = is_nan
+        else:
+            # arxiv.org/abs/1802.03903
+            # set user defined abnormal data points to zero
+            missing = np.logical_or(is_nan, abnormal[:len(x)])
+
+        # set missing points to zero
+        data = np.where(missing, 0.0, x)
 
-                missing.append(is_nan)
-                _x = np.copy(x[i:j])
-                # set missing points to zero
-                _x[is_nan] = 0.0
-                data_x.append(_x)
+        missing = _sliding_window(missing, self.W)
+        data_x = _sliding_window(data, self.W)
 
-        return np.array(missing), np.array(data_x)
+        if not accept_missing:
+            keep = ~_sliding_window(is_nan, self.W).any(axis=1)
+            missing, data_x = missing[keep], data_x[keep]
+
+        return missing, data_x
 
     def train_test_split(self, dataset, abnormal=None, train_size=0.67):
         """
@@ -887,6 +2401,49 @@ class DonutModel(Model):
         X_test_missing, X_test = self._format_dataset(dataset[ntrn:])
         return (X_train_missing, X_train), (X_test_missing, X_test)
 
+    def split_windows(
+        self,
+        dataset,
+        train_size=0.67,
+        abnormal=None,
+        from_ts=None,
+    ):
+        """
+        Like train_test_split() but training windows come with their
+        sampling probabilities
+
+        If the model has `max_train_windows`, the training windows are
+        reduced to at most this number, stratified by hour of the week
+        starting from `from_ts`. Otherwise the probabilities are None.
+        """
+        (X_miss, X_train), test = self.train_test_split(
+            dataset,
+            train_size=train_size,
+            abnormal=abnormal,
+        )
+        if self.max_train_windows is None or len(X_train) == 0:
+            return (X_miss, X_train, None), test
+
+        if from_ts is None:
+            strata = np.zeros(len(X_train), dtype=int)
+        else:
+            # Timestamp of the last bucket of each window
+            ts = from_ts + (np.arange(len(X_train)) + self.W - 1) * self.bucket_interval
+            strata = (ts // 3600).astype(int) % (7 * 24)
+
+        index, weights = _reduce_windows(
+            X_train,
+            X_miss,
+            strata,
+            self.max_train_windows,
+        )
+        logging.info(
+            "training windows reduced from %d to %d",
+            len(X_train),
+            len(index),
+        )
+        return (X_miss[index], X_train[index], weights), test
+
     def train(
         self,
         datasource,
@@ -901,15 +2458,46 @@ class DonutModel(Model):
         progress_cb=None,
         incremental=False,
         windows=[],
+        parallel_trials=1,
+        trials=None,
+        trials_cb=None,
+        priors=None,
+        window_cache_memory=None,
     ):
         """
         Train model
+
+        Incremental trainings only fetch the buckets following the last
+        trained one. The network is fine-tuned on their windows and on a
+        sample of past windows, and the normalization statistics are
+        updated with the new buckets. Without new complete buckets, the
+        model is left unchanged.
+
+        The last trained bucket is the last complete one with data, the
+        following ones are fetched again by the next incremental training.
         """
 
         self.means, self.stds = None, None
         self.scores = None
+        self.job_key = None
 
         period = self.build_date_range(from_date, to_date)
+
+        last_ts = None
+        if incremental and self._state and 'last_ts' in self._state:
+            last_ts = self._state['last_ts']
+            self.span = self._span
+            # Only fetch new buckets and the history of their windows
+            period = DateRange(
+                max(
+                    period.from_ts,
+                    last_ts - (self.W - 2) * self.bucket_interval,
+                ),
+                period.to_ts,
+            )
+            if period.to_ts < last_ts + 2 * self.bucket_interval:
+                return self._no_new_data()
+
         logging.info(
             "train(%s) range=%s train_size=%f batch_size=%d epochs=%d)",
             self.name,
@@ -940,19 +2528,45 @@ class DonutModel(Model):
         if i is None:
             raise errors.NoData("no data found for time range {}".format(period))
 
-        self.apply_defaults(dataset)
-
         nb_buckets_found = i + 1
         if nb_buckets_found < nb_buckets:
             dataset = np.resize(dataset, (nb_buckets_found,))
 
         logging.info("found %d time periods", nb_buckets_found)
 
+        # Index of the last complete bucket with data
+        nb_complete = int((period.to_ts - period.from_ts) // self.bucket_interval)
+        found = np.flatnonzero(~np.isnan(dataset[:nb_complete]))
+        last_index = found[-1] if len(found) else -1
+
+        self.apply_defaults(dataset)
+
+        # Index of the first bucket not trained yet
+        first_new = 0
+        if last_ts is not None:
+            first_new = max(0, int((last_ts - period.from_ts) / self.bucket_interval) + 1)
+            if first_new > last_index:
+                return self._no_new_data()
+
+        moments = _merge_moments(
+            [0, 0.0, 0.0] if last_ts is None else self._state['moments'],
+            _moments(dataset[first_new:last_index + 1]),
+        )
+
         if incremental:
             best_params = self._state.get('best_params', dict())
+            # The network architecture, hence its cost, is unchanged
+            self.inference_cost = self._state.get('inference_cost')
+            replay = self._state.get('replay') or {}
+            replay, seen = (
+                np.array(replay.get('windows', []), dtype=float),
+                replay.get('seen', 0),
+            )
             # Destroys the current TF graph and creates a new one.
             # Useful to avoid clutter from old models / layers.
             self.load(num_cpus, num_gpus)
+            self.span = self._span
+            self.stat_moments(moments)
             score = self._train_ckpt_on_dataset(
                 dataset,
                 train_size,
@@ -960,8 +2574,22 @@ class DonutModel(Model):
                 num_epochs,
                 progress_cb=progress_cb,
                 abnormal=abnormal,
+                first_new=first_new,
+                replay=replay,
             )
         else:
+            replay, seen = None, 0
+            self.span_candidates = None
+            if self.settings.get('span') in [None, "auto"]:
+                self.span_candidates = _find_spans(
+                    dataset,
+                    self.min_span,
+                    self.max_span,
+                )
+                logging.info("span candidates: %s", self.span_candidates)
+
+            # Train in the default graph
+            self.unload()
             best_params, score = self._train_on_dataset(
                 dataset,
                 train_size,
@@ -972,6 +2600,13 @@ class DonutModel(Model):
                 max_evals,
                 progress_cb=progress_cb,
                 abnormal=abnormal,
+                parallel_trials=parallel_trials,
+                trials=trials,
+                trials_cb=trials_cb,
+                priors=priors,
+                window_cache_memory=window_cache_memory,
+                from_ts=period.from_ts,
+                moments=moments,
             )
         self.current_eval = None
 
@@ -981,7 +2616,21 @@ class DonutModel(Model):
                not isinstance(val, float):
                 best_params[key] = np.asscalar(val)
 
-        model_b64 = _serialize_keras_model(self._keras_model)
+        with self._keras_session():
+            model_b64 = _serialize_keras_model(self._keras_model)
+
+        # Keep a sample of the trained windows to replay them later
+        is_abnormal = np.zeros(len(dataset), dtype=bool)
+        nb_abnormal = min(len(abnormal), len(dataset))
+        is_abnormal[:nb_abnormal] = abnormal[:nb_abnormal]
+        windows = _sliding_window(
+            np.where(is_abnormal, np.nan, dataset)[:last_index + 1],
+            self.W,
+        )[max(0, first_new - self.W + 1):]
+        windows = windows[~np.isnan(windows).all(axis=1)]
+        if replay is None or replay.shape[1:] != (self.W,):
+            replay = np.empty((0, self.W))
+        replay, seen = _reservoir_sample(replay, seen, windows)
 
         self._state = {
             'h5py': model_b64,
@@ -989,7 +2638,17 @@ class DonutModel(Model):
             'means': self.means.tolist(),
             'stds': self.stds.tolist(),
             'loss': score,
+            'last_ts': period.from_ts + last_index * self.bucket_interval,
+            'moments': moments,
+            'replay': {
+                'seen': seen,
+                'windows': [list_from_np(window) for window in replay],
+            },
         }
+        if self.inference_cost is not None:
+            self._state['inference_cost'] = self.inference_cost
+        if self.job_key is not None:
+            self._state['job_key'] = self.job_key
         self.unload()
         #prediction = self.predict(
         #    datasource,
@@ -1000,8 +2659,22 @@ class DonutModel(Model):
         #)
         #prediction.stat()
 
-        return {
+        result = {
             'loss': score,
+            'nb_new_buckets': max(0, last_index + 1 - first_new),
+        }
+        if self.span_candidates:
+            result['span_candidates'] = self.span_candidates
+        return result
+
+    def _no_new_data(self):
+        """
+        Result of an incremental training without new data
+        """
+        logging.info("train(%s): no new data since last training", self.name)
+        return {
+            'loss': self._state['loss'],
+            'nb_new_buckets': 0,
         }
 
     def unload(self):
@@ -1011,29 +2684,34 @@ class DonutModel(Model):
         self._keras_model = None
         self._encoder_model = None
         self._decoder_model = None
-        K.clear_session()
+        self._imputer = None
+        self._network = None
+        self._session_size = 0
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+            self._graph = None
+        elif K is not None:
+            K.clear_session()
+
+    def get_inference_backend(self, default=None):
+        """
+        Return the inference backend, model settings take precedence over
+        the running configuration
+        """
+        return self.inference_backend or default or 'keras'
 
-    def load(self, num_cpus, num_gpus):
+    def load(self, num_cpus, num_gpus, backend='keras'):
         """
         Load current model
         """
         if not self.is_trained:
             raise errors.ModelNotTrained()
-        if self._keras_model:
-            # Already loaded
-            return
 
-        K.clear_session()
-        self._set_xpu_config(num_cpus, num_gpus)
-
-        if self._state.get('h5py', None) is not None:
-            self._keras_model = _load_keras_model(self._state.get('h5py'))
-            # instantiate encoder model
-            self._encoder_model = _get_encoder(self._keras_model)
-            # instantiate decoder model
-            self._decoder_model = _get_decoder(self._keras_model)
+        if backend == 'numpy':
+            self._load_numpy()
         else:
-            raise errors.ModelNotTrained()
+            self._load_keras(num_cpus, num_gpus)
 
         if 'means' in self._state:
             self.means = np.array(self._state['means'])
@@ -1049,12 +2727,198 @@ class DonutModel(Model):
                 self.max_threshold,
             )
 
+    def _weights_file(self):
+        """
+        Return the path of the Keras model file, decompressed from the
+        `h5py_blob` of lazily loaded states on first use
+        """
+        path = self._state['h5py_path']
+        blob_path = self._state.get('h5py_blob')
+        if blob_path is not None:
+            try:
+                gunzip_file(blob_path, path)
+            except OSError as exn:
+                raise errors.LoudMLException(
+                    "cannot read model weights: {}: {}".format(
+                        blob_path,
+                        str(exn),
+                    )
+                )
+        return path
+
+    def _load_keras(self, num_cpus, num_gpus):
+        """
+        Load Keras model
+        """
+        self._network = None
+        if self._keras_model:
+            # Already loaded
+            return
+
+        if self._state.get('h5py_path') is None and \
+           self._state.get('h5py') is None:
+            raise errors.ModelNotTrained()
+
+        # Each model lives in its own graph and session, so that loading
+        # a model does not destroy the other ones
+        _import_keras()
+        memory_usage = get_memory_usage()
+        self._graph = tf.Graph()
+        self._session = self._set_xpu_config(num_cpus, num_gpus, self._graph)
+
+        with self._keras_session():
+            if self._state.get('h5py_path') is not None:
+                self._keras_model = _load_keras_model_file(self._weights_file())
+            else:
+                self._keras_model = _load_keras_model(self._state['h5py'])
+            # instantiate encoder model
+            self._encoder_model = _get_encoder(self._keras_model)
+            # instantiate decoder model
+            self._decoder_model = _get_decoder(self._keras_model)
+            self._imputer = _get_imputer(
+                self._encoder_model,
+                self._decoder_model,
+                g_mcmc_count,
+            )
+        self._session_size = max(0, get_memory_usage() - memory_usage)
+
+    def _load_numpy(self):
+        """
+        Load NumPy network
+        """
+        if self._network is not None:
+            # Already loaded
+            return
+
+        if self._state.get('h5py_path') is None and \
+           self._state.get('h5py') is None:
+            raise errors.ModelNotTrained()
+
+        if self._state.get('h5py_path') is not None:
+            weights = _export_weights_file(self._weights_file())
+        else:
+            weights = _export_weights(self._state['h5py'])
+        self._network = NumpyNetwork(weights)
+
+    @property
+    def network_size(self):
+        """
+        Approximate memory used by the loaded network, in bytes
+        """
+        if self._network is not None:
+            return sum(
+                array.nbytes
+                for layer in [
+                    self._network.hidden,
+                    self._network.z_mean,
+                    self._network.z_log_var,
+                    self._network.dense_1,
+                    self._network.dense_2,
+                ]
+                for array in layer
+            )
+        if self._keras_model is not None:
+            # weights + Adam moments, or the graph and session if bigger
+            itemsize = np.dtype(K.floatx()).itemsize
+            return max(
+                3 * self._keras_model.count_params() * itemsize,
+                self._session_size,
+            )
+        return 0
+
+    def _encode(self, x, missing):
+        """
+        Return mean and log of variance of Q(z|X)
+        """
+        if self._network is not None:
+            return self._network.encode(x)
+
+        with self._keras_session():
+            z_mean, z_log_var, _ = self._encoder_model.predict(
+                [x, missing],
+                batch_size=g_mc_batch_size,
+            )
+        return z_mean, z_log_var
+
+    def _decode(self, z, batch_size=g_mc_batch_size):
+        """
+        Reconstruct windows from latent vectors
+        """
+        if self._network is not None:
+            return self._network.decode(z)
+
+        with self._keras_session():
+            return self._decoder_model.predict(z, batch_size=batch_size)
+
+    def _impute(self, x, missing):
+        """
+        Replace missing points by their MCMC reconstruction
+        """
+        if self._network is not None:
+            x_imputed = self._network.impute(x, missing, g_mcmc_count)
+        else:
+            with self._keras_session():
+                x_imputed, = self._imputer([x, missing])
+        return x_imputed.astype(x.dtype)
+
+    def _compute_mc_std(self, x, missing, memory_limit=None):
+        """
+        Estimate the reconstruction std of the last bucket of each window
+        using Monte Carlo integration.
+
+        Windows are encoded once, then latent vectors are drawn per window
+        and decoded in chunks that fit into `memory_limit` MB. If the model
+        has a `mc_tolerance`, between `mc_min_count` and `mc_max_count`
+        samples are drawn per window, otherwise `mc_max_count`.
+        """
+        if self.mc_tolerance:
+            batch_count = self.mc_min_count
+        else:
+            batch_count = self.mc_max_count
+        if memory_limit is None:
+            memory_limit = g_mc_memory_limit
+
+        z_mean, z_log_var = self._encode(x, missing)
+        z_std = np.exp(0.5 * z_log_var)
+        nb_windows, latent_dim = z_mean.shape
+        if self._network is not None:
+            intermediate_dim = self._network.intermediate_dim
+            itemsize = self._network.dtype.itemsize
+        else:
+            intermediate_dim = self._decoder_model.get_layer('dense_1').units
+            itemsize = np.dtype(K.floatx()).itemsize
+
+        chunk_size = _get_mc_chunk_size(
+            batch_count,
+            latent_dim + intermediate_dim + x.shape[1],
+            memory_limit,
+            itemsize,
+        )
+
+        epsilon = _get_mc_epsilon(self.mc_sampling, self.mc_max_count, latent_dim)
+
+        std = np.empty((nb_windows,), dtype=float)
+        for i in range(0, nb_windows, chunk_size):
+            j = min(nb_windows, i + chunk_size)
+            std[i:j] = _mc_integrate(
+                lambda z: self._decode(z, batch_size=len(z)),
+                z_mean[i:j],
+                z_std[i:j],
+                batch_count,
+                self.mc_max_count,
+                self.mc_tolerance,
+                epsilon,
+                self.mc_min_count,
+            )
+
+        return std
+
     @property
     def is_trained(self):
         """
         Tells if model is trained
         """
-        return self._state is not None and ('weights' in self._state or 'h5py' in self._state)
+        return is_trained_state(self._state)
 
     @property
     def _span(self):
@@ -1074,6 +2938,8 @@ class DonutModel(Model):
         to_date,
         num_cpus=1,
         num_gpus=0,
+        mc_memory_limit=None,
+        backend=None,
     ):
         global g_mcmc_count
         global g_mc_count
@@ -1086,7 +2952,7 @@ class DonutModel(Model):
 
         logging.info("predict(%s) range=%s", self.name, period)
 
-        self.load(num_cpus, num_gpus)
+        self.load(num_cpus, num_gpus, self.get_inference_backend(backend))
 
         # Build history time range
         # Extra data are required to predict first buckets
@@ -1138,31 +3004,27 @@ class DonutModel(Model):
             raise errors.LoudMLException("not enough data for prediction")
 
         # force last col to missing
+        missing = np.array(missing)
         missing[:, -1] = True
 
         logging.info("generating prediction")
-        x_ = X_test.copy()
         # MCMC
-        for _ in range(g_mcmc_count):
-            z_mean, _, _ = self._encoder_model.predict([x_, missing], batch_size=g_mc_batch_size)
-            x_decoded = self._decoder_model.predict(z_mean, batch_size=g_mc_batch_size)
-            x_[missing] = x_decoded[missing]
+        x_ = self._impute(X_test, missing)
 
         y = np.full((predict_len,), np.nan, dtype=float)
         y_low = np.full((predict_len,), np.nan, dtype=float)
         y_high = np.full((predict_len,), np.nan, dtype=float)
-        no_missing_point = np.full((g_mc_count, self.W), False, dtype=bool)
-        for j, x in enumerate(x_):
-            y[j] = x[-1]
-            # MC integration
-            _, _, Z = self._encoder_model.predict(
-                [np.tile(x, [g_mc_count, 1]), no_missing_point],
-                batch_size=g_mc_batch_size,
-            )
-            x_decoded = self._decoder_model.predict(Z, batch_size=g_mc_batch_size)
-            std = np.std(x_decoded[:, -1])
-            y_low[j] = x[-1] - 3 * std
-            y_high[j] = x[-1] + 3 * std
+        no_missing_point = np.full(x_.shape, False, dtype=bool)
+        # MC integration
+        std = self._compute_mc_std(
+            x_,
+            no_missing_point,
+            memory_limit=mc_memory_limit,
+        )
+        nb_windows = len(x_)
+        y[:nb_windows] = x_[:, -1]
+        y_low[:nb_windows] = x_[:, -1] - 3 * std
+        y_high[:nb_windows] = x_[:, -1] + 3 * std
 
         y = self.unscale_dataset(y)
         y_low = self.unscale_dataset(y_low)
@@ -1212,6 +3074,8 @@ class DonutModel(Model):
         percent_noise=0,
         num_cpus=1,
         num_gpus=0,
+        mc_memory_limit=None,
+        backend=None,
     ):
         global g_mcmc_count
         global g_mc_count
@@ -1224,7 +3088,7 @@ class DonutModel(Model):
 
         logging.info("forecast(%s) range=%s", self.name, period)
 
-        self.load(num_cpus, num_gpus)
+        self.load(num_cpus, num_gpus, self.get_inference_backend(backend))
 
         # Build history time range
         # Extra data are required to predict first buckets
@@ -1289,25 +3153,18 @@ class DonutModel(Model):
         noise = percent_noise * float(self.bucket_interval) / (24*3600)
         for j, _ in enumerate(x_):
             # MCMC
-            for _ in range(g_mcmc_count):
-                z_mean, _, _ = self._encoder_model.predict(
-                    [np.array([x]), np.array([missing])],
-                    batch_size=g_mc_batch_size,
-                )
-                x_decoded = self._decoder_model.predict(z_mean, batch_size=g_mc_batch_size)
-                x[missing] = x_decoded[0][missing]
+            x = self._impute(np.array([x]), np.array([missing]))[0]
 
             # uncertainty is modeled using a random uniform noise distribution
             # that increases over time
             expand = np.random.uniform(-noise * j, noise * j, len(x))
             x *= 1 + expand
             # MC integration
-            _, _, Z = self._encoder_model.predict(
-                [np.tile(x, [g_mc_count, 1]), np.tile(missing, [g_mc_count, 1])],
-                batch_size=g_mc_batch_size,
-            )
-            x_decoded = self._decoder_model.predict(Z, batch_size=g_mc_batch_size)
-            std = np.std(x_decoded[:, -1])
+            std = self._compute_mc_std(
+                np.array([x]),
+                np.array([missing]),
+                memory_limit=mc_memory_limit,
+            )[0]
             y_low[j] = x[-1] - p * std
             y_high[j] = x[-1] + p * std
             y[j] = x[-1]
@@ -1449,6 +3306,8 @@ class DonutModel(Model):
         _state={},
         num_cpus=1,
         num_gpus=0,
+        mc_memory_limit=None,
+        backend=None,
     ):
         return self.predict(
             datasource,
@@ -1456,6 +3315,8 @@ class DonutModel(Model):
             to_date,
             num_cpus=num_cpus,
             num_gpus=num_gpus,
+            mc_memory_limit=mc_memory_limit,
+            backend=backend,
         )
 
     def plot_results(
@@ -1488,7 +3349,6 @@ class DonutModel(Model):
         logging.info("plot_results(%s) range=%s", self.name, period)
 
         self.load(num_cpus, num_gpus)
-        _, latent_dim = self._encoder_model.outputs[0].get_shape()
 
         # Build history time range
         # Extra data are required to predict first buckets
@@ -1536,8 +3396,8 @@ class DonutModel(Model):
             raise errors.LoudMLException("not enough data for prediction")
 
         # display a 2D plot of the digit classes in the latent space
-        z_mean, _, _ = self._encoder_model.predict([X_test, X_miss_val],
-                                                   batch_size=g_mc_batch_size)
+        z_mean, _ = self._encode(X_test, X_miss_val)
+        latent_dim = z_mean.shape[1]
 
         if x_dim < 0 or y_dim < 0:
             mses = []
@@ -39,7 +39,7 @@ class DummyStorage(Storage):
     def set_current_ckpt(self, model_name, ckpt_name):
         pass
 
-    def load_model(self, name, ckpt_name=None):
+    def load_model(self, name, ckpt_name=None, lazy=False):
         return None
 
     def load_template(self, _name, *args, **kwargs):
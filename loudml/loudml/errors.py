@@ -123,6 +123,18 @@ class UnsupportedModel(LoudMLException):
         return "{} (type = '{}')".format(self.error, self.model_type)
 
 
+class UnsupportedStorage(LoudMLException):
+    """Unsupported storage"""
+    code = 501
+
+    def __init__(self, storage_type, error=None):
+        self.storage_type = storage_type
+        self.error = error or self.__doc__
+
+    def __str__(self):
+        return "{} (type = '{}')".format(self.error, self.storage_type)
+
+
 class Forbidden(LoudMLException):
     """Forbidden"""
     code = 403
@@ -4,13 +4,19 @@ Loud ML file storage
 
 import loudml.vendor
 
+import base64
+import contextlib
 import copy
 import glob
+import gzip
+import hashlib
 import json
 import logging
 import os
 import shutil
+import sqlite3
 import tempfile
+import time
 
 from voluptuous import (
     All,
@@ -23,8 +29,17 @@ from . import (
     schemas,
 )
 
+from .misc import (
+    gunzip_file,
+)
+from .model import (
+    is_trained_state,
+    split_runtime_state,
+)
 from .storage import (
+    RETENTION_SCHEMA,
     Storage,
+    find_expired_ckpts,
 )
 
 from dictdiffer import diff
@@ -35,15 +50,83 @@ OBJECT_KEY_SCHEMA = schemas.All(
    Match("^[a-zA-Z0-9-_@.]+$"),
 )
 
+# State values bigger than this (in JSON bytes) are not checkpoint metadata
+g_meta_value_size = 1024
+
+# Seconds to wait for the model catalog lock
+g_catalog_timeout = 30
+
+# Size of the runtime state log that triggers its compaction
+g_runtime_log_size = 64 * 1024
+
+# Seconds during which unused blobs are kept, for the writes in progress
+g_blob_grace_period = 600
+
+# Seconds during which the models directory may still change within the
+# resolution of its mtime, see _sync_catalog()
+g_catalog_mtime_delay = 2
+
+CATALOG_TABLES = [
+    """CREATE TABLE IF NOT EXISTS models (
+        name TEXT PRIMARY KEY,
+        type TEXT,
+        trained INTEGER NOT NULL DEFAULT 0,
+        ckpt TEXT,
+        loss REAL,
+        run TEXT,
+        mtime INTEGER NOT NULL,
+        version TEXT
+    )""",
+    "CREATE INDEX IF NOT EXISTS models_type ON models (type)",
+    """CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )""",
+]
+
 class FileStorage(Storage):
     """
     File storage
+
+    The Keras model and the big state values of a checkpoint `NN.ckpt` are
+    saved compressed in the `blobs` directory of the model, in files named
+    after the hash of their content. Checkpoints share them and they are
+    only written when they change. The Keras model is given to models as
+    the `h5py_path` state key, a decompressed copy of the blob in the
+    `cache` directory of the model. States loaded lazily give the blob as
+    the `h5py_blob` key as well, the copy is only made once the model
+    reads its weights. Big state values are left out of them, they keep a
+    `data_path` reference instead. Old
+    checkpoints embedding the base64 `h5py` model are read as they are,
+    their model is moved to a blob when it is saved again.
+
+    Checkpoint names are allocated from the `ckpt.seq` file of the model.
+    Once a checkpoint is saved, those that the retention policy does not
+    keep are deleted. The blobs that no checkpoint uses, and their cached
+    copies, are only deleted by prune_checkpoints(), as finding them reads
+    all the checkpoints.
+
+    The values of the state updated by the prediction jobs are appended to
+    the `runtime.log` file of the model rather than saved in a checkpoint,
+    the last line overrides the values of the current checkpoint.
+
+    Models are listed from a SQLite catalog `catalog.db`, updated whenever
+    a model is written through the storage. When the mtime of the models
+    directory changes, catalog entries are checked against the version of
+    the models, see get_model_version(), so that models changed behind its
+    back are indexed again.
     """
 
-    def __init__(self, path):
+    def __init__(self, path, retention=None):
         self.path = path
+        self.retention = schemas.validate(
+            RETENTION_SCHEMA,
+            retention or {},
+            name='retention',
+        )
         self.model_dir = os.path.join(path, 'models')
         self.template_dir = os.path.join(path, 'templates')
+        self.catalog_path = os.path.join(path, 'catalog.db')
 
         try:
             os.makedirs(self.model_dir, exist_ok=True)
@@ -54,20 +137,161 @@ class FileStorage(Storage):
         except OSError as exn:
             raise errors.LoudMLException(str(exn))
 
+        with self._catalog() as db:
+            for table in CATALOG_TABLES:
+                db.execute(table)
+
         self._convert_models()
 
+    @contextlib.contextmanager
+    def _catalog(self):
+        """
+        Open the model catalog in a transaction
+
+        The connection is not kept, so that forked workers do not share it.
+        """
+        try:
+            db = sqlite3.connect(self.catalog_path, timeout=g_catalog_timeout)
+        except sqlite3.Error as exn:
+            raise errors.LoudMLException(
+                "cannot open model catalog: {}".format(str(exn))
+            )
+
+        try:
+            with db:
+                yield db
+        except sqlite3.Error as exn:
+            raise errors.LoudMLException(
+                "model catalog error: {}".format(str(exn))
+            )
+        finally:
+            db.close()
+
+    def _index_model(self, db, name):
+        """
+        Update the catalog entry of a model
+        """
+        model_path = self.model_path(name, validate=False)
+
+        try:
+            mtime = os.stat(model_path).st_mtime_ns
+        except FileNotFoundError:
+            db.execute("DELETE FROM models WHERE name = ?", (name,))
+            return
+
+        # Read before the model files, a later change will be noticed
+        version = self._catalog_version(model_path)
+
+        try:
+            settings = self._get_model_settings(model_path, name)
+            state = self._get_model_state(model_path, lazy=True)
+        except errors.LoudMLException as exn:
+            logging.warning("cannot index model '%s': %s", name, str(exn))
+            settings = {}
+            state = None
+
+        try:
+            ckpt_path = os.readlink(os.path.join(model_path, "state.json"))
+            ckpt_name = os.path.splitext(os.path.basename(ckpt_path))[0]
+        except OSError:
+            ckpt_name = None
+
+        run = settings.get('run')
+        db.execute(
+            "INSERT OR REPLACE INTO models VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                name,
+                settings.get('type'),
+                int(is_trained_state(state)),
+                ckpt_name,
+                (state or {}).get('loss'),
+                None if run is None else json.dumps(run),
+                mtime,
+                version,
+            ),
+        )
+
+    def _catalog_version(self, model_path):
+        """
+        Return the version of a model as stored in the catalog
+        """
+        try:
+            return json.dumps(self._get_model_version(model_path))
+        except FileNotFoundError:
+            return None
+
+    def _sync_catalog(self, db):
+        """
+        Index the models that changed since the last synchronization
+
+        Models are only checked when the models directory changed since
+        then.
+        """
+        try:
+            mtime = os.stat(self.model_dir).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+
+        row = db.execute(
+            "SELECT value FROM meta WHERE key = 'model_dir_mtime'"
+        ).fetchone()
+        if mtime is not None and row is not None and row[0] == str(mtime):
+            return
+
+        indexed = dict(db.execute("SELECT name, version FROM models"))
+        for name in os.listdir(self.model_dir):
+            model_path = os.path.join(self.model_dir, name)
+            if not os.path.isdir(model_path):
+                continue
+            if name not in indexed \
+               or indexed.pop(name) != self._catalog_version(model_path):
+                self._index_model(db, name)
+
+        db.executemany(
+            "DELETE FROM models WHERE name = ?",
+            [(name,) for name in indexed],
+        )
+
+        # A change within the resolution of the mtime would go unnoticed
+        if mtime is not None \
+           and mtime / 1e9 > time.time() - g_catalog_mtime_delay:
+            mtime = None
+
+        db.execute(
+            "INSERT OR REPLACE INTO meta VALUES ('model_dir_mtime', ?)",
+            (None if mtime is None else str(mtime),),
+        )
+
     def get_ckpt_name(self, i):
         return "{:02d}".format(i)
 
+    def _seq_path(self, model_path):
+        return os.path.join(model_path, "ckpt.seq")
+
     def get_next_ckpt_name(self, model_path):
-        path = next(iter(sorted(glob.glob(os.path.join(model_path, '*.ckpt')),
-            key=lambda f: os.stat(f).st_mtime, reverse=True)), None)
+        """
+        Allocate a checkpoint name
+        """
+        seq_path = self._seq_path(model_path)
+        try:
+            with open(seq_path) as fd:
+                i = int(fd.read())
+        except (FileNotFoundError, ValueError):
+            # Model saved before the sequence file existed
+            i = 1 + max([
+                int(ckpt_name)
+                for ckpt_name in self._list_ckpts(model_path)
+                if ckpt_name.isdigit()
+            ], default=-1)
+
+        while os.path.exists(os.path.join(
+            model_path,
+            "{}.ckpt".format(self.get_ckpt_name(i)),
+        )):
+            i += 1
 
-        if path is None:
-            return self.get_ckpt_name(0)
-        else:
-            ckpt = os.path.splitext(os.path.basename(path))[0]
-            return self.get_ckpt_name(int(ckpt)+1)
+        self._write_file(seq_path, str(i + 1).encode('utf-8'))
+        return self.get_ckpt_name(i)
 
     def _convert_models(self):
         """
@@ -110,10 +334,226 @@ class FileStorage(Storage):
         os.rename(tmp_path, path)
         os.close(tmp_fd)
 
+    def _write_file(self, path, data):
+        tmp_fd, tmp_path = tempfile.mkstemp(prefix=path + ".")
+        with os.fdopen(tmp_fd, 'wb') as fd:
+            fd.write(data)
+            fd.flush()
+            os.fsync(fd)
+        os.chmod(tmp_path, 0o660)
+        os.rename(tmp_path, path)
+
     def _load_json(self, path):
         with open(path) as fd:
             return json.load(fd)
 
+    def _load_data(self, path):
+        if path.endswith(".gz"):
+            with gzip.open(path, 'rt') as fd:
+                return json.load(fd)
+        return self._load_json(path)
+
+    def _weights_path(self, state_path):
+        """
+        Build the path of the side-car weights file of an old checkpoint
+        """
+        return os.path.splitext(state_path)[0] + ".h5"
+
+    def _data_path(self, state_path):
+        """
+        Build the path of the side-car data file of an old checkpoint
+        """
+        return os.path.splitext(state_path)[0] + ".data"
+
+    def _blob_dir(self, model_path):
+        return os.path.join(model_path, "blobs")
+
+    def _cache_dir(self, model_path):
+        return os.path.join(model_path, "cache")
+
+    def _find_blob(self, model_path, path):
+        """
+        Return the path of a blob relative to the model directory, None if
+        `path` is not a blob of the model or the cached copy of one
+        """
+        blob_dir = self._blob_dir(model_path)
+        dirname = os.path.dirname(os.path.realpath(path))
+        name = os.path.basename(path)
+        if dirname == os.path.realpath(self._cache_dir(model_path)):
+            name += ".gz"
+        elif dirname != os.path.realpath(blob_dir):
+            return None
+
+        try:
+            # Keep it from the garbage collector
+            os.utime(os.path.join(blob_dir, name), None)
+        except FileNotFoundError:
+            return None
+        return os.path.join("blobs", name)
+
+    def _write_blob(self, model_path, data, ext):
+        """
+        Write a blob named after the hash of its content, return its path
+        relative to the model directory
+        """
+        blob_dir = self._blob_dir(model_path)
+        name = hashlib.sha1(data).hexdigest() + ext
+        path = os.path.join(blob_dir, name)
+
+        try:
+            os.utime(path, None)
+        except FileNotFoundError:
+            os.makedirs(blob_dir, exist_ok=True)
+            if ext.endswith(".gz"):
+                data = gzip.compress(data)
+            self._write_file(path, data)
+
+        return os.path.join("blobs", name)
+
+    def _cache_path(self, model_path, weights_path):
+        """
+        Build the path of the decompressed copy of a weights blob
+        """
+        name = os.path.basename(weights_path)[:-len(".gz")]
+        return os.path.join(self._cache_dir(model_path), name)
+
+    def _get_weights_file(self, model_path, weights_path):
+        """
+        Return the path of the decompressed copy of a weights blob
+        """
+        if not weights_path.endswith(".gz"):
+            # Side-car file or uncompressed blob of an old checkpoint
+            return os.path.join(model_path, weights_path)
+
+        path = self._cache_path(model_path, weights_path)
+        try:
+            gunzip_file(os.path.join(model_path, weights_path), path)
+        except OSError as exn:
+            raise errors.LoudMLException(
+                "cannot read model weights: {}: {}".format(
+                    weights_path,
+                    str(exn),
+                )
+            )
+        return path
+
+    def _write_weights(self, model_path, state):
+        """
+        Write the weights of a model state to a blob, return the state to
+        write into the checkpoint
+        """
+        weights_path = None
+
+        if state.get('h5py') is not None:
+            weights = base64.b64decode(state['h5py'].encode('utf-8'))
+        elif state.get('h5py_path') is not None:
+            weights_path = self._find_blob(model_path, state['h5py_path'])
+            if weights_path is None:
+                with open(state['h5py_path'], 'rb') as fd:
+                    weights = fd.read()
+        else:
+            return state
+
+        if weights_path is None:
+            weights_path = self._write_blob(model_path, weights, ".h5.gz")
+
+        state = dict(state)
+        state.pop('h5py', None)
+        state.pop('h5py_blob', None)
+        state['h5py_path'] = weights_path
+        return state
+
+    def _write_data(self, model_path, state):
+        """
+        Write the big values of a model state to a compressed blob, return
+        the metadata to write into the checkpoint
+        """
+        data_path = state.get('data_path')
+        data = {
+            key: value
+            for key, value in state.items()
+            if key not in ['h5py', 'h5py_path', 'h5py_blob', 'data_path']
+            and len(json.dumps(value)) > g_meta_value_size
+        }
+
+        if data:
+            if data_path is not None:
+                data = dict(self._load_data(data_path), **data)
+            data_path = None
+        elif data_path is not None:
+            blob_path = self._find_blob(model_path, data_path)
+            if blob_path is None:
+                data = self._load_data(data_path)
+            data_path = blob_path
+        else:
+            return state
+
+        if data_path is None:
+            data_path = self._write_blob(
+                model_path,
+                json.dumps(data).encode('utf-8'),
+                ".json.gz",
+            )
+
+        state = {
+            key: value
+            for key, value in state.items()
+            if key not in data
+        }
+        state['data_path'] = data_path
+        return state
+
+    def _write_checkpoint(self, state_path, state):
+        """
+        Write a model state, blobs first so that a checkpoint never refers
+        to missing ones
+        """
+        model_path = os.path.dirname(state_path)
+        state = self._write_weights(model_path, state)
+        state = self._write_data(model_path, state)
+        self._write_json(state_path, state)
+        return state
+
+    def _runtime_path(self, model_path):
+        return os.path.join(model_path, "runtime.log")
+
+    def _read_runtime_state(self, model_path):
+        """
+        Read the last runtime state of a model, None if there is none
+        """
+        try:
+            with open(self._runtime_path(model_path), 'rb') as fd:
+                lines = fd.read().splitlines()
+        except FileNotFoundError:
+            return None
+
+        for line in reversed(lines):
+            try:
+                return json.loads(line.decode('utf-8'))
+            except ValueError:
+                # Interrupted write
+                continue
+        return None
+
+    def _write_runtime_state(self, model_path, runtime_state):
+        """
+        Append the runtime state of a model to its log, the log is rewritten
+        with this entry only once it is big enough
+        """
+        path = self._runtime_path(model_path)
+        line = (json.dumps(runtime_state) + "\n").encode('utf-8')
+
+        try:
+            size = os.stat(path).st_size
+        except FileNotFoundError:
+            size = 0
+
+        if size + len(line) > g_runtime_log_size:
+            self._write_file(path, line)
+        else:
+            with open(path, 'ab') as fd:
+                fd.write(line)
+
     def _write_model_settings(self, model_path, settings):
         settings = copy.deepcopy(settings)
         settings.pop('name', None)
@@ -132,12 +572,126 @@ class FileStorage(Storage):
             state_path = os.path.join(model_path, "{}.ckpt".format(ckpt_name))
 
         if state is None:
+            runtime_state = {}
+            self._delete_ckpt(state_path)
+        else:
+            state, runtime_state = split_runtime_state(state)
+            self._write_checkpoint(state_path, state)
+
+        self._write_runtime_state(model_path, runtime_state)
+
+    def _delete_ckpt(self, state_path):
+        """
+        Delete a checkpoint, its blobs are left to the garbage collector
+        """
+        for path in [
+            state_path,
+            self._weights_path(state_path),
+            self._data_path(state_path),
+        ]:
             try:
-                os.unlink(state_path)
+                os.unlink(path)
             except FileNotFoundError:
                 pass
-        else:
-            self._write_json(state_path, state)
+
+    def _list_ckpts(self, model_path):
+        return [
+            os.path.splitext(os.path.basename(path))[0]
+            for path in glob.glob(os.path.join(model_path, '*.ckpt'))
+        ]
+
+    def _collect_blobs(self, model_path):
+        """
+        Delete the blobs that no checkpoint uses, unless they were used
+        recently, and their cached copies
+        """
+        blob_dir = self._blob_dir(model_path)
+        try:
+            names = os.listdir(blob_dir)
+        except FileNotFoundError:
+            return
+
+        used = set()
+        for ckpt_name in self._list_ckpts(model_path):
+            state_path = os.path.join(model_path, "{}.ckpt".format(ckpt_name))
+            try:
+                state = self._load_json(state_path)
+            except FileNotFoundError:
+                continue
+            except ValueError as exn:
+                logging.error(
+                    "invalid model state file: %s: %s",
+                    state_path,
+                    str(exn),
+                )
+                return
+
+            for key in ['h5py_path', 'data_path']:
+                if state.get(key) is not None:
+                    used.add(os.path.basename(state[key]))
+
+        min_mtime = time.time() - g_blob_grace_period
+        for name in names:
+            if name in used:
+                continue
+            path = os.path.join(blob_dir, name)
+            try:
+                if os.stat(path).st_mtime >= min_mtime:
+                    continue
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+        # Models decompress the blobs again if they need them
+        cache_dir = self._cache_dir(model_path)
+        try:
+            names = os.listdir(cache_dir)
+        except FileNotFoundError:
+            return
+
+        for name in names:
+            # Temporary files being written have no .h5 extension
+            if name.endswith(".h5") and name + ".gz" not in used:
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(os.path.join(cache_dir, name))
+
+    def _prune_checkpoints(self, model_path):
+        """
+        Delete the checkpoints that the retention policy does not keep
+        """
+        try:
+            current = os.path.splitext(os.path.basename(
+                os.readlink(os.path.join(model_path, "state.json"))
+            ))[0]
+        except OSError:
+            current = None
+
+        ckpts = []
+        for ckpt_name in self._list_ckpts(model_path):
+            state_path = os.path.join(model_path, "{}.ckpt".format(ckpt_name))
+            try:
+                ckpts.append((ckpt_name, os.stat(state_path).st_mtime))
+            except FileNotFoundError:
+                continue
+
+        expired = find_expired_ckpts(ckpts, self.retention, current)
+        for ckpt_name in expired:
+            self._delete_ckpt(
+                os.path.join(model_path, "{}.ckpt".format(ckpt_name)),
+            )
+        return sorted(expired)
+
+    def prune_checkpoints(self, name):
+        model_path = self.model_path(name)
+        if not os.path.exists(model_path):
+            raise errors.ModelNotFound(name=name)
+
+        expired = self._prune_checkpoints(model_path)
+        self._collect_blobs(model_path)
+
+        with self._catalog() as db:
+            self._index_model(db, name)
+        return expired
 
     def _write_model(self, path, settings, state=None, save_state=True, save_ckpt=True):
         try:
@@ -154,6 +708,10 @@ class FileStorage(Storage):
             self._write_model_state(path, state, ckpt_name)
             if save_ckpt:
                 self._set_current_ckpt(path, ckpt_name)
+            self._prune_checkpoints(path)
+
+        with self._catalog() as db:
+            self._index_model(db, os.path.basename(path))
 
     def create_model(self, model, config=None):
         model_path = self.model_path(model.name)
@@ -182,7 +740,19 @@ class FileStorage(Storage):
         return diff(old_settings, model.settings, expand=True)
 
     def save_state(self, model, ckpt_name=None):
-        self._write_model_state(self.model_path(model.name), model.state, ckpt_name)
+        model_path = self.model_path(model.name)
+        self._write_model_state(model_path, model.state, ckpt_name)
+        self._prune_checkpoints(model_path)
+
+        with self._catalog() as db:
+            self._index_model(db, model.name)
+
+    def save_runtime_state(self, model):
+        model_path = self.model_path(model.name)
+        try:
+            self._write_runtime_state(model_path, model.runtime_state)
+        except FileNotFoundError:
+            raise errors.ModelNotFound(name=model.name)
 
     def _set_current_ckpt(self, model_path, ckpt_name):
         state_path = os.path.join(model_path, "state.json")
@@ -201,11 +771,62 @@ class FileStorage(Storage):
         model_path = self.model_path(model_name)
         self._set_current_ckpt(model_path, ckpt_name)
 
+        with self._catalog() as db:
+            self._index_model(db, model_name)
+
+    def get_current_ckpt(self, model_name):
+        state_path = os.path.join(self.model_path(model_name), "state.json")
+        try:
+            return os.path.splitext(os.path.basename(os.readlink(state_path)))[0]
+        except OSError:
+            return None
+
+    def get_model_version(self, name):
+        """
+        Return an identifier that changes whenever the model settings or
+        its current checkpoint are written
+        """
+        try:
+            return self._get_model_version(self.model_path(name))
+        except FileNotFoundError:
+            raise errors.ModelNotFound(name=name)
+
+    def _get_model_version(self, model_path):
+        settings_st = os.stat(os.path.join(model_path, "settings.json"))
+
+        state_path = os.path.join(model_path, "state.json")
+        try:
+            ckpt_name = os.path.basename(os.readlink(state_path))
+        except OSError:
+            ckpt_name = None
+        try:
+            # Files are replaced on write, see _write_json()
+            state_st = os.stat(state_path)
+            state_id = (state_st.st_ino, state_st.st_mtime_ns, state_st.st_size)
+        except FileNotFoundError:
+            state_id = None
+        try:
+            # The runtime state log is appended to, or replaced
+            runtime_st = os.stat(self._runtime_path(model_path))
+            runtime_id = (runtime_st.st_ino, runtime_st.st_size)
+        except FileNotFoundError:
+            runtime_id = None
+
+        return (
+            (settings_st.st_ino, settings_st.st_mtime_ns, settings_st.st_size),
+            ckpt_name,
+            state_id,
+            runtime_id,
+        )
+
     def delete_model(self, name):
         try:
             shutil.rmtree(self.model_path(name))
         except FileNotFoundError:
             raise errors.ModelNotFound(name=name)
+        finally:
+            with self._catalog() as db:
+                db.execute("DELETE FROM models WHERE name = ?", (name,))
 
     def model_exists(self, name):
         return os.path.exists(self.model_path(name))
@@ -242,14 +863,14 @@ class FileStorage(Storage):
         except OSError as exn:
             raise errors.LoudMLException(str(exn))
 
-    def _get_model_state(self, model_path, ckpt_name=None):
+    def _get_model_state(self, model_path, ckpt_name=None, lazy=False):
         if ckpt_name is None:
             state_path = os.path.join(model_path, "state.json")
         else:
             state_path = os.path.join(model_path, "{}.ckpt".format(ckpt_name))
 
         try:
-            return self._load_json(state_path)
+            state = self._load_json(state_path)
         except ValueError as exn:
             raise errors.Invalid(
                 "invalid model state file: {}: {}".format(
@@ -261,7 +882,36 @@ class FileStorage(Storage):
             # Model is not trained yet
             return None
 
-    def get_model_data(self, name, ckpt_name=None):
+        weights_path = state.get('h5py_path')
+        if weights_path is not None and lazy and weights_path.endswith(".gz"):
+            # Decompressed on first use
+            state['h5py_blob'] = os.path.join(model_path, weights_path)
+            state['h5py_path'] = self._cache_path(model_path, weights_path)
+        elif weights_path is not None:
+            state['h5py_path'] = self._get_weights_file(model_path, weights_path)
+        if state.get('data_path') is not None:
+            state['data_path'] = os.path.join(model_path, state['data_path'])
+
+        if ckpt_name is None:
+            runtime_state = self._read_runtime_state(model_path)
+            if runtime_state is not None:
+                state, _ = split_runtime_state(state)
+                state.update(runtime_state)
+
+        if not lazy and state.get('data_path') is not None:
+            data_path = state.pop('data_path')
+            try:
+                state.update(self._load_data(data_path))
+            except ValueError as exn:
+                raise errors.Invalid(
+                    "invalid model data file: {}: {}".format(
+                        data_path,
+                        str(exn),
+                    )
+                )
+        return state
+
+    def get_model_data(self, name, ckpt_name=None, lazy=False):
         model_path = self.model_path(name)
         settings = self._get_model_settings(model_path, name)
         settings['name'] = name
@@ -271,7 +921,7 @@ class FileStorage(Storage):
         }
 
         try:
-            state = self._get_model_state(model_path, ckpt_name)
+            state = self._get_model_state(model_path, ckpt_name, lazy)
             if state is not None:
                 data['state'] = state
         except errors.Invalid as exn:
@@ -283,6 +933,9 @@ class FileStorage(Storage):
 
         return data
 
+    def get_model_meta(self, name, ckpt_name=None):
+        return self.get_model_data(name, ckpt_name, lazy=True)
+
     def get_template_data(self, name):
         model_path = self.template_path(name)
         settings = self._get_model_settings(model_path, name)
@@ -297,16 +950,66 @@ class FileStorage(Storage):
         return data
 
     def list_checkpoints(self, name):
-        return sorted([
-            os.path.splitext(os.path.basename(path))[0]
-            for path in glob.glob(os.path.join(self.model_dir, name, '*.ckpt'))
-        ])
+        return sorted(self._list_ckpts(os.path.join(self.model_dir, name)))
 
     def list_models(self):
-        return sorted([
-            os.path.splitext(os.path.basename(path))[0]
-            for path in glob.glob(self.model_path('*', validate=False))
-        ])
+        with self._catalog() as db:
+            self._sync_catalog(db)
+            return [
+                name for name, in db.execute(
+                    "SELECT name FROM models ORDER BY name"
+                )
+            ]
+
+    def _query_catalog(self, db, pattern, model_type, trained, running,
+                       offset, limit):
+        conditions = []
+        args = []
+
+        if pattern is not None:
+            conditions.append("name GLOB ?")
+            args.append(pattern)
+        if model_type is not None:
+            conditions.append("type = ?")
+            args.append(model_type)
+        if trained is not None:
+            conditions.append("trained = ?")
+            args.append(int(trained))
+        if running is not None:
+            conditions.append(
+                "run IS NOT NULL" if running else "run IS NULL"
+            )
+
+        query = "SELECT name, type, trained, ckpt, loss, run, mtime FROM models"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY name LIMIT ? OFFSET ?"
+        args += [-1 if limit is None else limit, offset]
+
+        return db.execute(query, args).fetchall()
+
+    def find_models(self, pattern=None, model_type=None, trained=None,
+                    running=None, offset=0, limit=None):
+        if offset < 0 or (limit is not None and limit < 0):
+            raise errors.Invalid("invalid model range")
+
+        with self._catalog() as db:
+            self._sync_catalog(db)
+            query = (pattern, model_type, trained, running, offset, limit)
+            rows = self._query_catalog(db, *query)
+
+        return [
+            {
+                'name': name,
+                'type': model_type,
+                'trained': bool(trained),
+                'ckpt': ckpt_name,
+                'loss': loss,
+                'run': None if run is None else json.loads(run),
+                'mtime': mtime / 1e9,
+            }
+            for name, model_type, trained, ckpt_name, loss, run, mtime in rows
+        ]
 
     def list_templates(self):
         return sorted([
@@ -424,6 +1127,16 @@ class FileStorage(Storage):
         except FileNotFoundError:
             raise KeyError("model object not found")
 
+    def list_model_objects(self, model_name):
+        """List model object keys"""
+
+        objects_dir = os.path.join(self.model_path(model_name), "objects")
+
+        return sorted([
+            os.path.splitext(os.path.basename(path))[0]
+            for path in glob.glob(os.path.join(objects_dir, '*.json'))
+        ])
+
 
 class TempStorage(FileStorage):
     """
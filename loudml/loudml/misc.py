@@ -4,12 +4,15 @@ Miscelaneous Loud ML helpers
 
 import datetime
 import dateutil.parser
+import gzip
 import hashlib
 import json
 import numpy as np
 import pkg_resources
+import resource
 import sys
 import os
+import tempfile
 
 import itertools
 import multiprocessing
@@ -274,6 +277,19 @@ def deepsizeof(obj_0):
     return inner(obj_0)
 
 
+def get_memory_usage():
+    """
+    Return the resident memory of the current process, in bytes
+    """
+    try:
+        with open('/proc/self/statm') as fd:
+            return int(fd.read().split()[1]) * resource.getpagesize()
+    except (OSError, ValueError, IndexError):
+        # Peak usage, where procfs is missing
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return usage if sys.platform == 'darwin' else usage * 1024
+
+
 def load_entry_point(namespace, name):
     """
     Load pkg_resource entry point
@@ -461,6 +477,29 @@ def hash_dict(data):
     return ctx.hexdigest()
 
 
+def gunzip_file(path, dest_path):
+    """
+    Decompress a gzip file to `dest_path`, unless it exists already
+
+    The copy is written to a temporary file first, so that concurrent
+    readers never see it partially written.
+    """
+    if os.path.exists(dest_path):
+        return
+
+    with gzip.open(path) as fd:
+        data = fd.read()
+
+    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+    tmp_fd, tmp_path = tempfile.mkstemp(prefix=dest_path + ".")
+    with os.fdopen(tmp_fd, 'wb') as fd:
+        fd.write(data)
+        fd.flush()
+        os.fsync(fd)
+    os.chmod(tmp_path, 0o660)
+    os.rename(tmp_path, dest_path)
+
+
 class NoDaemonProcess(multiprocessing.Process):
     # make 'daemon' attribute always return False
     def _get_daemon(self):
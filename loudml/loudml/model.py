@@ -27,6 +27,12 @@ import json
 from jinja2 import Template
 from jinja2 import Environment, meta
 
+# State values updated by the prediction jobs
+RUNTIME_STATE_KEYS = ['run', 'anomaly', 'last_anomaly_ts']
+
+# State values holding a trained network
+TRAINED_STATE_KEYS = ['weights', 'h5py', 'h5py_path']
+
 
 def _convert_features_dict(features):
     """
@@ -197,6 +203,7 @@ class Model:
         ),
         'timestamp_field': schemas.key,
         'routing': Any(None, schemas.key),
+        'template': Any(None, str),
         'threshold': schemas.score,
         'max_threshold': schemas.score,
         'min_threshold': schemas.score,
@@ -329,6 +336,14 @@ class Model:
     def state(self):
         return self._state
 
+    @property
+    def runtime_state(self):
+        """
+        State values updated by the prediction jobs, that storages save
+        apart from the checkpoints
+        """
+        return split_runtime_state(self._state)[1]
+
     @property
     def preview(self):
         state = {
@@ -350,6 +365,34 @@ class Model:
         return NotImplemented()
 
 
+def is_trained_state(state):
+    """
+    Tell if a model state holds a trained network, without loading it
+    """
+    return state is not None and any(
+        key in state for key in TRAINED_STATE_KEYS
+    )
+
+
+def split_runtime_state(state):
+    """
+    Split a model state into its checkpoint and runtime values
+    """
+    state = state or {}
+    return (
+        {
+            key: value
+            for key, value in state.items()
+            if key not in RUNTIME_STATE_KEYS
+        },
+        {
+            key: value
+            for key, value in state.items()
+            if key in RUNTIME_STATE_KEYS
+        },
+    )
+
+
 def load_model(settings, state=None, config=None):
     """
     Load model
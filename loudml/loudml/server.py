@@ -45,9 +45,6 @@ from . import (
 from .datasource import (
     load_datasource,
 )
-from .filestorage import (
-    FileStorage,
-)
 from .metrics import (
     send_metrics,
 )
@@ -58,6 +55,9 @@ from .misc import (
     parse_timedelta,
     parse_constraint,
 )
+from .storage import (
+    load_storage,
+)
 
 app = Flask(__name__, static_url_path='/static', template_folder='templates')
 api = Api(app)
@@ -326,7 +326,7 @@ def get_model_info(name):
     global g_storage
     global g_training
 
-    model = g_storage.load_model(name)
+    model = g_storage.load_model(name, lazy=True)
     info = model.preview
 
     job = g_training.get(name)
@@ -397,9 +397,19 @@ class ModelsResource(Resource):
     def get(self):
         models = []
 
-        for name in g_storage.list_models():
+        trained = request.args.get('trained')
+        if trained is not None:
+            trained = get_bool_arg('trained')
+
+        for entry in g_storage.find_models(
+            pattern=request.args.get('match'),
+            model_type=request.args.get('type'),
+            trained=trained,
+            offset=get_int_arg('from', default=0),
+            limit=get_int_arg('size'),
+        ):
             try:
-                models.append(get_model_info(name))
+                models.append(get_model_info(entry['name']))
             except errors.UnsupportedModel:
                 continue
 
@@ -703,16 +713,16 @@ class TrainingJob(Job):
         super()._done_cb(result)
         if self.state == 'done' and self.autostart:
             logging.info("scheduling autostart for model '%s'", self.model_name)
-            model = g_storage.load_model(self.model_name)
+            model = g_storage.load_model(self.model_name, lazy=True)
             params = self._kwargs_start.copy()
             params.pop('from_date')
             model.set_run_params(params)
-            g_storage.save_model(model)
+            g_storage.save_model(model, save_state=False)
             try:
                 _model_start(model, self._kwargs_start)
             except errors.LoudMLException:
                 model.set_run_params(None)
-                g_storage.save_model(model)
+                g_storage.save_model(model, save_state=False)
 
     @property
     def args(self):
@@ -895,20 +905,21 @@ def model_start(model_name):
         'detect_anomalies': get_bool_arg('detect_anomalies'),
     }
 
-    model = g_storage.load_model(model_name)
+    model = g_storage.load_model(model_name, lazy=True)
     if not model.is_trained:
         raise errors.ModelNotTrained()
 
     model.set_run_params(params)
     model.set_run_state(None)
-    g_storage.save_model(model)
+    g_storage.save_model(model, save_state=False)
+    g_storage.save_runtime_state(model)
 
     params['from_date'] = get_date_arg('from')
     try:
         _model_start(model, params)
     except errors.LoudMLException as exn:
         model.set_run_params(None)
-        g_storage.save_model(model)
+        g_storage.save_model(model, save_state=False)
         raise(exn)
 
     return "real-time prediction started", 200
@@ -931,10 +942,11 @@ def model_stop(model_name):
     g_lock.release()
     logging.info("model '%s' deactivated", model_name)
 
-    model = g_storage.load_model(model_name)
+    model = g_storage.load_model(model_name, lazy=True)
     model.set_run_params(None)
     model.set_run_state(None)
-    g_storage.save_model(model)
+    g_storage.save_model(model, save_state=False)
+    g_storage.save_runtime_state(model)
 
     return "model deactivated"
 
@@ -1031,9 +1043,10 @@ def restart_predict_jobs():
 
     global g_storage
 
-    for name in g_storage.list_models():
+    for entry in g_storage.find_models(running=True):
+        name = entry['name']
         try:
-            model = g_storage.load_model(name)
+            model = g_storage.load_model(name, lazy=True)
         except errors.LoudMLException as exn:
             logging.error("exception loading model '%s':%s", name, exn)
             continue
@@ -1081,7 +1094,7 @@ def main():
 
     try:
         g_config = loudml.config.load_config(args.config)
-        g_storage = FileStorage(g_config.storage['path'])
+        g_storage = load_storage(g_config.storage)
         loudml.config.load_plugins(args.config)
     except errors.LoudMLException as exn:
         logging.error(exn)
@@ -0,0 +1,843 @@
+"""
+Loud ML SQLite storage
+"""
+
+import loudml.vendor
+
+import base64
+import contextlib
+import copy
+import glob
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from . import (
+    errors,
+    schemas,
+)
+
+from .filestorage import (
+    OBJECT_KEY_SCHEMA,
+)
+from .model import (
+    is_trained_state,
+    split_runtime_state,
+)
+from .storage import (
+    RETENTION_SCHEMA,
+    Storage,
+    find_expired_ckpts,
+)
+
+from dictdiffer import diff
+
+# State values bigger than this (in JSON bytes) are not checkpoint metadata
+g_meta_value_size = 1024
+
+# Seconds to wait for the database lock
+g_sqlite_timeout = 30
+
+TABLES = [
+    """CREATE TABLE IF NOT EXISTS models (
+        name TEXT PRIMARY KEY,
+        settings TEXT NOT NULL,
+        type TEXT,
+        run TEXT,
+        ckpt TEXT,
+        next_ckpt INTEGER NOT NULL DEFAULT 0,
+        version INTEGER NOT NULL DEFAULT 0,
+        mtime REAL NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS models_type ON models (type)",
+    """CREATE TABLE IF NOT EXISTS checkpoints (
+        model TEXT NOT NULL REFERENCES models (name) ON DELETE CASCADE,
+        name TEXT NOT NULL,
+        state TEXT NOT NULL,
+        trained INTEGER NOT NULL DEFAULT 0,
+        loss REAL,
+        mtime REAL NOT NULL,
+        weights_hash TEXT,
+        data_hash TEXT,
+        PRIMARY KEY (model, name)
+    )""",
+    """CREATE INDEX IF NOT EXISTS checkpoints_weights
+        ON checkpoints (weights_hash)""",
+    "CREATE INDEX IF NOT EXISTS checkpoints_data ON checkpoints (data_hash)",
+    """CREATE TABLE IF NOT EXISTS blobs (
+        hash TEXT PRIMARY KEY,
+        data BLOB NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS runtime (
+        model TEXT PRIMARY KEY REFERENCES models (name) ON DELETE CASCADE,
+        state TEXT NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS hooks (
+        model TEXT NOT NULL REFERENCES models (name) ON DELETE CASCADE,
+        name TEXT NOT NULL,
+        type TEXT,
+        config TEXT,
+        PRIMARY KEY (model, name)
+    )""",
+    """CREATE TABLE IF NOT EXISTS objects (
+        model TEXT NOT NULL REFERENCES models (name) ON DELETE CASCADE,
+        key TEXT NOT NULL,
+        data TEXT NOT NULL,
+        PRIMARY KEY (model, key)
+    )""",
+]
+
+
+class SQLiteStorage(Storage):
+    """
+    SQLite storage
+
+    Models, checkpoints, hooks and objects are rows of the `loudml.db`
+    database, in WAL mode so that readers never wait for the writers.
+    Commits are not synced to disk, a power loss may lose the last ones
+    but never corrupts the database.
+
+    The Keras model and the big state values of a checkpoint are saved in
+    blobs addressed by their hash, shared by the checkpoints and only
+    written when they change. The Keras model is given to models as the
+    `h5py_path` state key, a copy of the blob in the `cache` directory. Big
+    state values are left out of the states loaded lazily, which keep a
+    `data_hash` reference instead.
+
+    The values of the state updated by the prediction jobs are saved in the
+    `runtime` table rather than in a checkpoint, and override the values of
+    the current checkpoint.
+
+    Once a checkpoint is saved, those that the retention policy does not
+    keep are deleted in the same transaction.
+
+    Templates are read from the `templates` directory, like in FileStorage.
+    """
+
+    def __init__(self, path, retention=None):
+        self.path = path
+        self.retention = schemas.validate(
+            RETENTION_SCHEMA,
+            retention or {},
+            name='retention',
+        )
+        self.db_path = os.path.join(path, 'loudml.db')
+        self.cache_dir = os.path.join(path, 'cache')
+        self.template_dir = os.path.join(path, 'templates')
+
+        for dir_path in [self.cache_dir, self.template_dir]:
+            try:
+                os.makedirs(dir_path, exist_ok=True)
+            except OSError as exn:
+                raise errors.LoudMLException(str(exn))
+
+        self._lock = threading.RLock()
+        self._pid = None
+        self._db = None
+        self._depth = 0
+        self._released = set()
+        self._unlinked = set()
+
+        with self.transaction() as db:
+            for table in TABLES:
+                db.execute(table)
+
+    def _connect(self):
+        """
+        Get the database connection of this process
+        """
+        if self._pid != os.getpid():
+            # Connections must not be shared with forked processes
+            try:
+                db = sqlite3.connect(
+                    self.db_path,
+                    timeout=g_sqlite_timeout,
+                    isolation_level=None,
+                    check_same_thread=False,
+                )
+                db.execute("PRAGMA journal_mode = WAL")
+                db.execute("PRAGMA synchronous = NORMAL")
+                db.execute("PRAGMA foreign_keys = ON")
+            except sqlite3.Error as exn:
+                raise errors.LoudMLException(
+                    "cannot open database: {}".format(str(exn))
+                )
+            self._db = db
+            self._pid = os.getpid()
+            self._depth = 0
+
+        return self._db
+
+    @contextlib.contextmanager
+    def transaction(self, write=True):
+        """
+        Run the statements of the block in one transaction
+
+        Nested blocks are part of the outermost transaction, which lets
+        callers batch several writes.
+        """
+        with self._lock:
+            db = self._connect()
+
+            if self._depth > 0:
+                self._depth += 1
+                try:
+                    yield db
+                finally:
+                    self._depth -= 1
+                return
+
+            self._depth = 1
+            try:
+                db.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+                yield db
+                self._delete_blobs(db)
+                db.execute("COMMIT")
+            except sqlite3.Error as exn:
+                self._rollback(db)
+                raise errors.LoudMLException(
+                    "database error: {}".format(str(exn))
+                )
+            except BaseException:
+                self._rollback(db)
+                raise
+            finally:
+                self._depth = 0
+
+            self._clean_cache(db)
+
+    def _rollback(self, db):
+        self._released.clear()
+        self._unlinked.clear()
+        if db.in_transaction:
+            db.execute("ROLLBACK")
+
+    def _release_blobs(self, db, where, args):
+        """
+        Note the blobs of checkpoints about to be written or deleted
+        """
+        for row in db.execute(
+            "SELECT weights_hash, data_hash FROM checkpoints WHERE " + where,
+            args,
+        ):
+            self._released.update(
+                blob_hash for blob_hash in row if blob_hash is not None
+            )
+
+    def _delete_blobs(self, db):
+        """
+        Delete the released blobs that no checkpoint uses anymore
+        """
+        released = self._released
+        self._released = set()
+
+        for blob_hash in released:
+            row = db.execute(
+                """SELECT 1 FROM checkpoints
+                   WHERE weights_hash = ? OR data_hash = ? LIMIT 1""",
+                (blob_hash, blob_hash),
+            ).fetchone()
+            if row is None:
+                db.execute("DELETE FROM blobs WHERE hash = ?", (blob_hash,))
+                self._unlinked.add(blob_hash)
+
+    def _clean_cache(self, db):
+        """
+        Remove the cached weights of the deleted blobs
+        """
+        unlinked = self._unlinked
+        self._unlinked = set()
+
+        for blob_hash in unlinked:
+            try:
+                os.unlink(self._weights_path(blob_hash))
+            except FileNotFoundError:
+                pass
+
+    def _write_blob(self, db, data):
+        blob_hash = hashlib.sha1(data).hexdigest()
+        db.execute(
+            "INSERT OR IGNORE INTO blobs VALUES (?, ?)",
+            (blob_hash, data),
+        )
+        return blob_hash
+
+    def _read_blob(self, db, blob_hash):
+        row = db.execute(
+            "SELECT data FROM blobs WHERE hash = ?",
+            (blob_hash,),
+        ).fetchone()
+        if row is None:
+            raise errors.Invalid("missing blob {}".format(blob_hash))
+        return row[0]
+
+    def _weights_path(self, weights_hash):
+        return os.path.join(self.cache_dir, weights_hash + ".h5")
+
+    def _get_weights_file(self, db, weights_hash):
+        """
+        Return the path of the cached weights of a checkpoint
+        """
+        path = self._weights_path(weights_hash)
+        if os.path.exists(path):
+            return path
+
+        weights = self._read_blob(db, weights_hash)
+
+        tmp_fd, tmp_path = tempfile.mkstemp(prefix=path + ".")
+        with os.fdopen(tmp_fd, 'wb') as fd:
+            fd.write(weights)
+            fd.flush()
+            os.fsync(fd)
+        os.chmod(tmp_path, 0o660)
+        os.rename(tmp_path, path)
+        return path
+
+    def get_ckpt_name(self, i):
+        return "{:02d}".format(i)
+
+    def _get_model_row(self, db, name):
+        row = db.execute(
+            "SELECT settings, ckpt, next_ckpt FROM models WHERE name = ?",
+            (name,),
+        ).fetchone()
+        if row is None:
+            raise errors.ModelNotFound(name=name)
+
+        settings = json.loads(row[0])
+        settings['name'] = name
+        return settings, row[1], row[2]
+
+    def _next_ckpt_name(self, db, model_name, next_ckpt):
+        """
+        Allocate a checkpoint name
+        """
+        while True:
+            ckpt_name = self.get_ckpt_name(next_ckpt)
+            next_ckpt += 1
+            row = db.execute(
+                "SELECT 1 FROM checkpoints WHERE model = ? AND name = ?",
+                (model_name, ckpt_name),
+            ).fetchone()
+            if row is None:
+                break
+
+        db.execute(
+            "UPDATE models SET next_ckpt = ? WHERE name = ?",
+            (next_ckpt, model_name),
+        )
+        return ckpt_name
+
+    def _write_settings(self, db, name, settings):
+        settings = copy.deepcopy(settings)
+        settings.pop('name', None)
+        run = settings.get('run')
+        values = (
+            json.dumps(settings),
+            settings.get('type'),
+            None if run is None else json.dumps(run),
+            time.time(),
+        )
+
+        # No UPSERT, it requires SQLite 3.24
+        cursor = db.execute(
+            """INSERT OR IGNORE INTO models (settings, type, run, mtime, name)
+               VALUES (?, ?, ?, ?, ?)""",
+            values + (name,),
+        )
+        if cursor.rowcount == 0:
+            db.execute(
+                """UPDATE models SET settings = ?, type = ?, run = ?,
+                       mtime = ?, version = version + 1
+                   WHERE name = ?""",
+                values + (name,),
+            )
+
+    def _write_checkpoint(self, db, settings, ckpt_name, state):
+        """
+        Write a model state, the weights and big values apart from the
+        metadata
+        """
+        model_name = settings['name']
+        trained = is_trained_state(state)
+
+        state, _ = split_runtime_state(state)
+        weights_path = state.pop('h5py_path', None)
+        weights_b64 = state.pop('h5py', None)
+        data_hash = state.pop('data_hash', None)
+
+        weights_hash = None
+        if weights_b64 is not None:
+            weights = base64.b64decode(weights_b64.encode('utf-8'))
+            weights_hash = self._write_blob(db, weights)
+        elif weights_path is not None:
+            if os.path.dirname(weights_path) == self.cache_dir:
+                # Content-addressed copy of a blob
+                weights_hash = os.path.splitext(
+                    os.path.basename(weights_path))[0]
+                row = db.execute(
+                    "SELECT 1 FROM blobs WHERE hash = ?",
+                    (weights_hash,),
+                ).fetchone()
+                if row is None:
+                    weights_hash = None
+            if weights_hash is None:
+                with open(weights_path, 'rb') as fd:
+                    weights_hash = self._write_blob(db, fd.read())
+
+        data = {
+            key: value
+            for key, value in state.items()
+            if len(json.dumps(value)) > g_meta_value_size
+        }
+
+        if data:
+            for key in data:
+                del state[key]
+            if data_hash is not None:
+                old_data = self._read_blob(db, data_hash).decode('utf-8')
+                data = dict(json.loads(old_data), **data)
+            data_hash = self._write_blob(db, json.dumps(data).encode('utf-8'))
+
+        self._release_blobs(
+            db,
+            "model = ? AND name = ?",
+            (model_name, ckpt_name),
+        )
+        db.execute(
+            "INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                model_name,
+                ckpt_name,
+                json.dumps(state),
+                int(trained),
+                state.get('loss'),
+                time.time(),
+                weights_hash,
+                data_hash,
+            ),
+        )
+
+    def _delete_checkpoint(self, db, model_name, ckpt_name):
+        where = "model = ? AND name = ?"
+        self._release_blobs(db, where, (model_name, ckpt_name))
+        db.execute("DELETE FROM checkpoints WHERE " + where,
+                   (model_name, ckpt_name))
+
+    def _write_runtime_state(self, db, model_name, runtime_state):
+        db.execute(
+            "INSERT OR REPLACE INTO runtime VALUES (?, ?)",
+            (model_name, json.dumps(runtime_state)),
+        )
+        db.execute(
+            "UPDATE models SET version = version + 1 WHERE name = ?",
+            (model_name,),
+        )
+
+    def _set_current_ckpt(self, db, model_name, ckpt_name):
+        db.execute(
+            "UPDATE models SET ckpt = ?, version = version + 1 WHERE name = ?",
+            (ckpt_name, model_name),
+        )
+        # The retention policy keeps the checkpoints used last
+        db.execute(
+            "UPDATE checkpoints SET mtime = ? WHERE model = ? AND name = ?",
+            (time.time(), model_name, ckpt_name),
+        )
+
+    def _prune_checkpoints(self, db, model_name, current):
+        ckpts = db.execute(
+            "SELECT name, mtime FROM checkpoints WHERE model = ?",
+            (model_name,),
+        ).fetchall()
+
+        expired = find_expired_ckpts(ckpts, self.retention, current)
+        for ckpt_name in expired:
+            self._delete_checkpoint(db, model_name, ckpt_name)
+        return sorted(expired)
+
+    def create_model(self, model, config=None):
+        schemas.validate(schemas.key, model.name, name='model_name')
+
+        with self.transaction() as db:
+            if self._model_exists(db, model.name):
+                raise errors.ModelExists()
+
+            self._write_settings(db, model.name, model.settings)
+
+    def save_model(self, model, save_state=True, save_ckpt=True):
+        schemas.validate(schemas.key, model.name, name='model_name')
+
+        with self.transaction() as db:
+            try:
+                old_settings, ckpt_name, next_ckpt = self._get_model_row(
+                    db,
+                    model.name,
+                )
+            except errors.ModelNotFound:
+                old_settings = {'name': model.name}
+                ckpt_name = None
+                next_ckpt = 0
+
+            self._write_settings(db, model.name, model.settings)
+
+            if save_state:
+                if save_ckpt or ckpt_name is None:
+                    ckpt_name = self._next_ckpt_name(db, model.name, next_ckpt)
+
+                settings = dict(model.settings, name=model.name)
+                if model.state is None:
+                    self._delete_checkpoint(db, model.name, ckpt_name)
+                    ckpt_name = None
+                else:
+                    self._write_checkpoint(db, settings, ckpt_name, model.state)
+                self._set_current_ckpt(db, model.name, ckpt_name)
+                self._write_runtime_state(db, model.name, model.runtime_state)
+                self._prune_checkpoints(db, model.name, ckpt_name)
+
+        return diff(old_settings, model.settings, expand=True)
+
+    def save_state(self, model, ckpt_name=None):
+        with self.transaction() as db:
+            settings, current, next_ckpt = self._get_model_row(db, model.name)
+
+            if ckpt_name is None:
+                ckpt_name = current
+                if ckpt_name is None:
+                    ckpt_name = self._next_ckpt_name(db, model.name, next_ckpt)
+                    self._set_current_ckpt(db, model.name, ckpt_name)
+                    current = ckpt_name
+
+            if model.state is None:
+                self._delete_checkpoint(db, model.name, ckpt_name)
+                if ckpt_name == current:
+                    self._set_current_ckpt(db, model.name, None)
+                    current = None
+            else:
+                self._write_checkpoint(db, settings, ckpt_name, model.state)
+            self._write_runtime_state(db, model.name, model.runtime_state)
+            self._prune_checkpoints(db, model.name, current)
+
+    def prune_checkpoints(self, name):
+        with self.transaction() as db:
+            _, current, _ = self._get_model_row(db, name)
+            return self._prune_checkpoints(db, name, current)
+
+    def save_runtime_state(self, model):
+        with self.transaction() as db:
+            if not self._model_exists(db, model.name):
+                raise errors.ModelNotFound(name=model.name)
+
+            self._write_runtime_state(db, model.name, model.runtime_state)
+
+    def set_current_ckpt(self, model_name, ckpt_name):
+        with self.transaction() as db:
+            self._get_model_row(db, model_name)
+
+            row = db.execute(
+                "SELECT 1 FROM checkpoints WHERE model = ? AND name = ?",
+                (model_name, ckpt_name),
+            ).fetchone()
+            if row is None:
+                raise errors.NotFound("checkpoint not found")
+
+            self._set_current_ckpt(db, model_name, ckpt_name)
+
+    def get_current_ckpt(self, model_name):
+        with self.transaction(write=False) as db:
+            _, ckpt_name, _ = self._get_model_row(db, model_name)
+        return ckpt_name
+
+    def get_model_version(self, name):
+        with self.transaction(write=False) as db:
+            row = db.execute(
+                "SELECT version FROM models WHERE name = ?",
+                (name,),
+            ).fetchone()
+        if row is None:
+            raise errors.ModelNotFound(name=name)
+        return row[0]
+
+    def delete_model(self, name):
+        with self.transaction() as db:
+            self._release_blobs(db, "model = ?", (name,))
+            cursor = db.execute("DELETE FROM models WHERE name = ?", (name,))
+            if cursor.rowcount == 0:
+                raise errors.ModelNotFound(name=name)
+
+    def _model_exists(self, db, name):
+        row = db.execute(
+            "SELECT 1 FROM models WHERE name = ?",
+            (name,),
+        ).fetchone()
+        return row is not None
+
+    def model_exists(self, name):
+        with self.transaction(write=False) as db:
+            return self._model_exists(db, name)
+
+    def get_model_data(self, name, ckpt_name=None, lazy=False):
+        with self.transaction(write=False) as db:
+            settings, current, _ = self._get_model_row(db, name)
+
+            data = {
+                'settings': settings,
+            }
+
+            if ckpt_name is None:
+                ckpt_name = current
+            if ckpt_name is None:
+                return data
+
+            row = db.execute(
+                """SELECT state, weights_hash, data_hash
+                   FROM checkpoints WHERE model = ? AND name = ?""",
+                (name, ckpt_name),
+            ).fetchone()
+            if row is None:
+                # Model is not trained yet
+                return data
+
+            state_json, weights_hash, data_hash = row
+            state = json.loads(state_json)
+            if weights_hash is not None:
+                state['h5py_path'] = self._get_weights_file(db, weights_hash)
+            if data_hash is not None:
+                if lazy:
+                    state['data_hash'] = data_hash
+                else:
+                    state.update(json.loads(
+                        self._read_blob(db, data_hash).decode('utf-8')
+                    ))
+
+            if ckpt_name == current:
+                row = db.execute(
+                    "SELECT state FROM runtime WHERE model = ?",
+                    (name,),
+                ).fetchone()
+                if row is not None:
+                    state, _ = split_runtime_state(state)
+                    state.update(json.loads(row[0]))
+
+            data['state'] = state
+
+        return data
+
+    def get_model_meta(self, name, ckpt_name=None):
+        return self.get_model_data(name, ckpt_name, lazy=True)
+
+    def list_models(self):
+        with self.transaction(write=False) as db:
+            return [
+                name for name, in db.execute(
+                    "SELECT name FROM models ORDER BY name"
+                )
+            ]
+
+    def find_models(self, pattern=None, model_type=None, trained=None,
+                    running=None, offset=0, limit=None):
+        if offset < 0 or (limit is not None and limit < 0):
+            raise errors.Invalid("invalid model range")
+
+        conditions = []
+        args = []
+
+        if pattern is not None:
+            conditions.append("m.name GLOB ?")
+            args.append(pattern)
+        if model_type is not None:
+            conditions.append("m.type = ?")
+            args.append(model_type)
+        if trained is not None:
+            conditions.append("COALESCE(c.trained, 0) = ?")
+            args.append(int(trained))
+        if running is not None:
+            conditions.append(
+                "m.run IS NOT NULL" if running else "m.run IS NULL"
+            )
+
+        query = """SELECT m.name, m.type, COALESCE(c.trained, 0), m.ckpt,
+                          c.loss, m.run, MAX(m.mtime, COALESCE(c.mtime, 0))
+                   FROM models AS m
+                   LEFT JOIN checkpoints AS c
+                   ON c.model = m.name AND c.name = m.ckpt"""
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY m.name LIMIT ? OFFSET ?"
+        args += [-1 if limit is None else limit, offset]
+
+        with self.transaction(write=False) as db:
+            rows = db.execute(query, args).fetchall()
+
+        return [
+            {
+                'name': row[0],
+                'type': row[1],
+                'trained': bool(row[2]),
+                'ckpt': row[3],
+                'loss': row[4],
+                'run': None if row[5] is None else json.loads(row[5]),
+                'mtime': row[6],
+            }
+            for row in rows
+        ]
+
+    def list_checkpoints(self, name):
+        with self.transaction(write=False) as db:
+            return [
+                ckpt_name for ckpt_name, in db.execute(
+                    "SELECT name FROM checkpoints WHERE model = ? ORDER BY name",
+                    (name,),
+                )
+            ]
+
+    def import_model(self, storage, name):
+        with self.transaction():
+            super().import_model(storage, name)
+
+    def template_path(self, template_name):
+        return os.path.join(self.template_dir, template_name)
+
+    def _load_template_json(self, path, name):
+        try:
+            with open(path) as fd:
+                return json.load(fd)
+        except ValueError as exn:
+            raise errors.Invalid(
+                "invalid template file: {}: {}".format(path, str(exn))
+            )
+        except FileNotFoundError:
+            raise errors.NotFound("template '{}' not found".format(name))
+        except OSError as exn:
+            raise errors.LoudMLException(str(exn))
+
+    def get_template_data(self, name):
+        template_path = self.template_path(name)
+        settings = self._load_template_json(
+            os.path.join(template_path, "settings.json"),
+            name,
+        )
+        meta = self._load_template_json(
+            os.path.join(template_path, "meta.json"),
+            name,
+        )
+
+        data = {
+            'settings': settings,
+            'name': name,
+        }
+        data.update(meta)
+
+        return data
+
+    def list_templates(self):
+        return sorted([
+            os.path.basename(path)
+            for path in glob.glob(self.template_path('*'))
+        ])
+
+    def list_model_hooks(self, model_name):
+        """List model hooks"""
+
+        with self.transaction(write=False) as db:
+            return [
+                hook_name for hook_name, in db.execute(
+                    "SELECT name FROM hooks WHERE model = ? ORDER BY name",
+                    (model_name,),
+                )
+            ]
+
+    def get_model_hook(self, model_name, hook_name):
+        """Get model hook"""
+
+        with self.transaction(write=False) as db:
+            row = db.execute(
+                "SELECT type, config FROM hooks WHERE model = ? AND name = ?",
+                (model_name, hook_name),
+            ).fetchone()
+
+        if row is None:
+            raise errors.NotFound("hook not found")
+
+        return {
+            'type': row[0],
+            'config': json.loads(row[1]),
+        }
+
+    def set_model_hook(self, model_name, hook_name, hook_type, config=None):
+        """Set model hook"""
+
+        schemas.validate(schemas.key, hook_name)
+
+        with self.transaction() as db:
+            if not self._model_exists(db, model_name):
+                raise errors.ModelNotFound(name=model_name)
+
+            db.execute(
+                "INSERT OR REPLACE INTO hooks VALUES (?, ?, ?, ?)",
+                (model_name, hook_name, hook_type, json.dumps(config)),
+            )
+
+    def delete_model_hook(self, model_name, hook_name):
+        """Delete model hook"""
+
+        with self.transaction() as db:
+            cursor = db.execute(
+                "DELETE FROM hooks WHERE model = ? AND name = ?",
+                (model_name, hook_name),
+            )
+            if cursor.rowcount == 0:
+                raise errors.NotFound("hook not found")
+
+    def set_model_object(self, model_name, key, data):
+        """Save model object"""
+
+        schemas.validate(OBJECT_KEY_SCHEMA, key)
+
+        with self.transaction() as db:
+            if not self._model_exists(db, model_name):
+                raise errors.ModelNotFound(name=model_name)
+
+            db.execute(
+                "INSERT OR REPLACE INTO objects VALUES (?, ?, ?)",
+                (model_name, key, json.dumps(data)),
+            )
+
+    def get_model_object(self, model_name, key):
+        """Get model object"""
+
+        with self.transaction(write=False) as db:
+            row = db.execute(
+                "SELECT data FROM objects WHERE model = ? AND key = ?",
+                (model_name, key),
+            ).fetchone()
+
+        if row is None:
+            raise KeyError("model object not found")
+        return json.loads(row[0])
+
+    def delete_model_object(self, model_name, key):
+        """Delete model object"""
+
+        with self.transaction() as db:
+            cursor = db.execute(
+                "DELETE FROM objects WHERE model = ? AND key = ?",
+                (model_name, key),
+            )
+            if cursor.rowcount == 0:
+                raise KeyError("model object not found")
+
+    def list_model_objects(self, model_name):
+        """List model object keys"""
+
+        with self.transaction(write=False) as db:
+            return [
+                key for key, in db.execute(
+                    "SELECT key FROM objects WHERE model = ? ORDER BY key",
+                    (model_name,),
+                )
+            ]
@@ -2,15 +2,27 @@
 Base interface for Loud ML storage
 """
 
+import fnmatch
 import logging
+import time
 
 from abc import (
     ABCMeta,
     abstractmethod,
 )
 
+from voluptuous import (
+    All,
+    Any,
+    Optional,
+    Range,
+    Schema,
+)
+
 from .misc import (
+    load_entry_point,
     load_hook,
+    parse_timedelta,
 )
 from .model import (
     load_model,
@@ -19,8 +31,50 @@ from .model import (
 )
 from . import (
     errors,
+    schemas,
 )
 
+RETENTION_SCHEMA = Schema({
+    Optional('keep_last'): Any(None, All(int, Range(min=1))),
+    Optional('max_age'): Any(
+        None,
+        schemas.TimeDelta(min=0, min_included=False),
+    ),
+})
+
+def find_expired_ckpts(ckpts, retention=None, current=None, now=None):
+    """
+    Return the names of the checkpoints that the retention policy does not
+    keep
+
+    `ckpts` are (name, mtime) pairs. A checkpoint is kept if it is one of
+    the `keep_last` most recent ones, or if it is younger than `max_age`.
+    The current checkpoint is always kept.
+    """
+    retention = retention or {}
+    keep_last = retention.get('keep_last')
+    max_age = retention.get('max_age')
+
+    if keep_last is None and max_age is None:
+        return []
+
+    if max_age is not None:
+        if now is None:
+            now = time.time()
+        min_mtime = now - parse_timedelta(max_age).total_seconds()
+
+    expired = []
+    ckpts = sorted(ckpts, key=lambda ckpt: ckpt[1], reverse=True)
+    for i, (name, mtime) in enumerate(ckpts):
+        if name == current:
+            continue
+        if keep_last is not None and i < keep_last:
+            continue
+        if max_age is not None and mtime >= min_mtime:
+            continue
+        expired.append(name)
+    return expired
+
 class Storage(metaclass=ABCMeta):
     """
     Abstract class for Loud ML storage
@@ -42,6 +96,50 @@ class Storage(metaclass=ABCMeta):
     def list_models(self):
         """List models"""
 
+    def find_models(self, pattern=None, model_type=None, trained=None,
+                    running=None, offset=0, limit=None):
+        """
+        Find models
+
+        Return the catalog entries of the models whose name matches the
+        shell-style `pattern`, sorted by name. `running` selects the models
+        with periodic inference parameters.
+        """
+        if offset < 0 or (limit is not None and limit < 0):
+            raise errors.Invalid("invalid model range")
+
+        models = []
+        for name in self.list_models():
+            if pattern is not None and not fnmatch.fnmatchcase(name, pattern):
+                continue
+            try:
+                model = self.load_model(name, lazy=True)
+            except errors.LoudMLException as exn:
+                logging.error("cannot load model '%s': %s", name, str(exn))
+                continue
+
+            run = model.settings.get('run')
+            if model_type is not None and model.type != model_type:
+                continue
+            if trained is not None and model.is_trained != trained:
+                continue
+            if running is not None and (run is not None) != running:
+                continue
+
+            models.append({
+                'name': name,
+                'type': model.type,
+                'trained': model.is_trained,
+                'ckpt': None,
+                'loss': (model.state or {}).get('loss'),
+                'run': run,
+                'mtime': None,
+            })
+
+        if limit is None:
+            return models[offset:]
+        return models[offset:offset + limit]
+
     @abstractmethod
     def list_checkpoints(self, name):
         """List model checkpoints"""
@@ -74,19 +172,59 @@ class Storage(metaclass=ABCMeta):
     def save_state(self, model, ckpt_name=None):
         """Save model state"""
 
+    def save_runtime_state(self, model):
+        """
+        Save the state values updated by the prediction jobs, by default
+        along with the whole model state
+        """
+        self.save_state(model)
+
     @abstractmethod
     def set_current_ckpt(self, model_name, ckpt_name):
         """Set active checkpoint"""
 
-    def load_model(self, name, ckpt_name=None):
-        """Load model"""
-        model_data = self.get_model_data(name, ckpt_name)
+    def prune_checkpoints(self, name):
+        """
+        Delete the checkpoints that the retention policy does not keep,
+        return their names. By default all checkpoints are kept.
+        """
+        return []
+
+    def get_current_ckpt(self, model_name):
+        """Get active checkpoint name, None if unknown"""
+        return None
+
+    def get_model_version(self, name):
+        """
+        Return an identifier of the current model settings and checkpoint,
+        or None if the storage cannot tell when they change
+        """
+        return None
+
+    def get_model_meta(self, name, ckpt_name=None):
+        """
+        Get model settings and state metadata, the state values that are
+        only needed to train the model may be missing
+        """
+        return self.get_model_data(name, ckpt_name)
+
+    def load_model(self, name, ckpt_name=None, lazy=False):
+        """
+        Load model
+
+        If `lazy`, only the state metadata is read. Such a model can be
+        previewed, used for inference and saved, but not trained.
+        """
+        if lazy:
+            model_data = self.get_model_meta(name, ckpt_name)
+        else:
+            model_data = self.get_model_data(name, ckpt_name)
         return load_model(**model_data)
 
     def load_template(self, _name, *args, **kwargs):
         """Load template"""
         model_data = self.get_template_data(_name)
-        settings = model_data['settings']
+        settings = dict(model_data['settings'], template=_name)
         return load_template(settings=settings, *args, **kwargs)
 
     def find_undeclared_variables(self, name):
@@ -147,3 +285,49 @@ class Storage(metaclass=ABCMeta):
     def delete_model_object(self, model_name, key):
         """Delete model object"""
         raise NotImplemented()
+
+    def list_model_objects(self, model_name):
+        """List model object keys"""
+        raise NotImplementedError()
+
+    def import_model(self, storage, name):
+        """
+        Copy a model from another storage, with its checkpoints, hooks and
+        objects
+        """
+        model = storage.load_model(name)
+        self.create_model(model)
+
+        for ckpt_name in storage.list_checkpoints(name):
+            self.save_state(storage.load_model(name, ckpt_name), ckpt_name)
+
+        ckpt_name = storage.get_current_ckpt(name)
+        if ckpt_name is not None:
+            self.set_current_ckpt(name, ckpt_name)
+            self.save_runtime_state(model)
+        elif model.is_trained:
+            self.save_model(model)
+
+        for hook_name in storage.list_model_hooks(name):
+            hook = storage.get_model_hook(name, hook_name)
+            self.set_model_hook(
+                name,
+                hook_name,
+                hook['type'],
+                hook.get('config'),
+            )
+
+        for key in storage.list_model_objects(name):
+            self.set_model_object(name, key, storage.get_model_object(name, key))
+
+
+def load_storage(settings):
+    """
+    Load storage from the `storage` configuration section
+    """
+    storage_type = settings.get('type', 'file')
+
+    storage_cls = load_entry_point('loudml.storages', storage_type)
+    if storage_cls is None:
+        raise errors.UnsupportedStorage(storage_type)
+    return storage_cls(settings['path'], retention=settings.get('retention'))
@@ -2,6 +2,7 @@
 Loud ML worker
 """
 
+import collections
 import logging
 import signal
 import math
@@ -9,23 +10,101 @@ import os
 
 import loudml.config
 import loudml.datasource
+import loudml.donut
 import loudml.model
 
 from loudml import (
     errors,
 )
 from loudml.misc import (
+    deepsizeof,
     load_nab,
     make_ts,
 )
 
-from loudml.filestorage import (
-    FileStorage,
+from loudml.storage import (
+    load_storage,
 )
 
 g_worker = None
 
 
+def _get_model_size(model):
+    """
+    Approximate memory used by a loaded model, in bytes
+    """
+    size = deepsizeof(model.settings) + deepsizeof(model.state)
+    return size + getattr(model, 'network_size', 0)
+
+
+class ModelCache:
+    """
+    LRU cache of loaded models, bounded by count and memory usage
+
+    The size of a model is computed once, when it is added.
+    """
+
+    def __init__(self, max_models, memory_limit):
+        self.max_models = max_models
+        self.memory_limit = memory_limit * 1024 * 1024
+        # name -> (version, model, size)
+        self._models = collections.OrderedDict()
+        self.size = 0
+
+    def __len__(self):
+        return len(self._models)
+
+    def get(self, name, version):
+        """
+        Return cached model, or None if it is missing or outdated
+        """
+        entry = self._models.get(name)
+        if entry is None:
+            return None
+
+        cached_version, model, _ = entry
+        if version is None or cached_version != version:
+            self.pop(name)
+            return None
+
+        self._models.move_to_end(name)
+        return model
+
+    def put(self, name, version, model):
+        """
+        Add or refresh model, evicting the least recently used ones
+        """
+        self.pop(name, unload=False)
+        if version is None or self.max_models <= 0:
+            return
+
+        size = _get_model_size(model)
+        self._models[name] = (version, model, size)
+        self.size += size
+        self._evict()
+
+    def pop(self, name, unload=True):
+        """
+        Remove model from the cache
+        """
+        entry = self._models.pop(name, None)
+        if entry is None:
+            return
+
+        _, model, size = entry
+        self.size -= size
+        if unload and hasattr(model, 'unload'):
+            model.unload()
+
+    def _evict(self):
+        while len(self._models) > self.max_models:
+            self.pop(next(iter(self._models)))
+
+        # Keep at least the most recently used model
+        while self.size > self.memory_limit and len(self._models) > 1:
+            self.pop(next(iter(self._models)))
+
+
 class Worker:
     """
     Loud ML worker
@@ -33,7 +112,11 @@ class Worker:
 
     def __init__(self, config_path, msg_queue):
         self.config = loudml.config.load_config(config_path)
-        self.storage = FileStorage(self.config.storage['path'])
+        self.storage = load_storage(self.config.storage)
+        self._models = ModelCache(
+            self.config.inference['model_cache_size'],
+            self.config.inference['model_cache_memory'],
+        )
         self._msg_queue = msg_queue
         self.job_id = None
         signal.signal(signal.SIGINT, signal.SIG_IGN)
@@ -65,11 +148,44 @@ class Worker:
 
         return res
 
+    def _load_model(self, model_name):
+        """
+        Load model for inference, from the cache if it is still up-to-date
+
+        Return the model and the version it was loaded at.
+        """
+        version = self.storage.get_model_version(model_name)
+        model = self._models.get(model_name, version)
+        if model is None:
+            model = self.storage.load_model(model_name, lazy=True)
+        return model, version
+
+    def _cache_model(self, model, version):
+        """
+        Keep model loaded for the next jobs, unless it was written since it
+        was loaded at `version`
+        """
+        if version != self.storage.get_model_version(model.name):
+            version = None
+        self._models.put(model.name, version, model)
+
+    def _save_runtime_state(self, model, version):
+        """
+        Save the runtime state of a model loaded at `version`, return its
+        new version, None if it was written since
+        """
+        stale = version != self.storage.get_model_version(model.name)
+        self.storage.save_runtime_state(model)
+        if stale:
+            return None
+        return self.storage.get_model_version(model.name)
+
     def train(self, model_name, datasource=None, **kwargs):
         """
         Train model
         """
 
+        self._models.pop(model_name)
         model = self.storage.load_model(model_name)
 
         src_name = datasource or model.default_datasource
@@ -86,22 +202,42 @@ class Worker:
                     'max_evals': max_evals,
                 },
             })
+        def trials_cb(trials):
+            self.storage.set_model_object(model_name, 'trials', trials)
+
+        try:
+            trials = self.storage.get_model_object(model_name, 'trials')
+        except KeyError:
+            trials = None
+
         windows = source.list_anomalies(
             kwargs['from_date'],
             kwargs['to_date'],
             tags={ 'model': model_name },
         )
-        model.train(
+
+        # Only hyperparameter searches start from similar models
+        priors = None
+        if model.type == 'donut' and not kwargs.get('incremental'):
+            priors = loudml.donut.find_priors(self.storage, model)
+
+        result = model.train(
             source,
             batch_size=self.config.training['batch_size'],
             num_epochs=self.config.training['epochs'],
             num_cpus=self.config.training['num_cpus'],
             num_gpus=self.config.training['num_gpus'],
+            parallel_trials=self.config.training['parallel_trials'],
+            window_cache_memory=self.config.training['window_cache_memory'],
             progress_cb=progress_cb,
+            trials=trials,
+            trials_cb=trials_cb,
+            priors=priors,
             windows=windows,
             **kwargs
         )
         self.storage.save_model(model)
+        return result
 
     def _save_timeseries_prediction(
         self,
@@ -140,7 +276,39 @@ class Worker:
         Ask model for a prediction
         """
 
-        model = self.storage.load_model(model_name)
+        model, version = self._load_model(model_name)
+        try:
+            res, version = self._predict(
+                model,
+                version,
+                save_run_state,
+                save_prediction,
+                detect_anomalies,
+                datasink,
+                **kwargs
+            )
+        except Exception:
+            self._models.pop(model_name)
+            raise
+
+        if detect_anomalies and not save_run_state:
+            # Anomaly state has changed but is not persisted
+            self._models.pop(model_name)
+        else:
+            self._cache_model(model, version)
+
+        return res
+
+    def _predict(
+        self,
+        model,
+        version,
+        save_run_state,
+        save_prediction,
+        detect_anomalies,
+        datasink,
+        **kwargs
+    ):
         src_settings = self.config.get_datasource(model.default_datasource)
         source = loudml.datasource.load_datasource(src_settings)
 
@@ -154,6 +322,8 @@ class Worker:
                     _state=_state,
                     num_cpus=self.config.inference['num_cpus'],
                     num_gpus=self.config.inference['num_gpus'],
+                    mc_memory_limit=self.config.inference['mc_memory_limit'],
+                    backend=self.config.inference['backend'],
                     **kwargs
                 )
             else:
@@ -161,6 +331,8 @@ class Worker:
                     source,
                     num_cpus=self.config.inference['num_cpus'],
                     num_gpus=self.config.inference['num_gpus'],
+                    mc_memory_limit=self.config.inference['mc_memory_limit'],
+                    backend=self.config.inference['backend'],
                     **kwargs
                 )
 
@@ -174,7 +346,7 @@ class Worker:
                 model.detect_anomalies(prediction, hooks)
             if save_run_state:
                 model.set_run_state(_state)
-                self.storage.save_state(model)
+                version = self._save_runtime_state(model, version)
             if save_prediction:
                 self._save_timeseries_prediction(
                     model,
@@ -186,14 +358,15 @@ class Worker:
             fmt = kwargs.get('format', 'series')
 
             if fmt == 'buckets':
-                return prediction.format_buckets()
+                return prediction.format_buckets(), version
             elif fmt == 'series':
-                return prediction.format_series()
+                return prediction.format_series(), version
             else:
                 raise errors.Invalid('unknown requested format')
 
         else:
             logging.info("job[%s] prediction done", self.job_id)
+            return None, version
 
     def forecast(
         self,
@@ -206,7 +379,7 @@ class Worker:
         Ask model for a forecast
         """
 
-        model = self.storage.load_model(model_name)
+        model, version = self._load_model(model_name)
         src_settings = self.config.get_datasource(model.default_datasource)
         source = loudml.datasource.load_datasource(src_settings)
 
@@ -216,8 +389,11 @@ class Worker:
             source,
             num_cpus=self.config.inference['num_cpus'],
             num_gpus=self.config.inference['num_gpus'],
+            mc_memory_limit=self.config.inference['mc_memory_limit'],
+            backend=self.config.inference['backend'],
             **kwargs
         )
+        self._cache_model(model, version)
 
         if model.type in ['timeseries', 'donut']:
             logging.info("job[%s] forecasted values for %d time buckets",
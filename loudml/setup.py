@@ -68,6 +68,7 @@ setup(
         ],
         'loudml.commands': [
             'list-checkpoints=loudml.cli:ListCheckpointsCommand',
+            'prune-checkpoints=loudml.cli:PruneCheckpointsCommand',
             'save-checkpoint=loudml.cli:SaveCheckpointCommand',
             'load-checkpoint=loudml.cli:LoadCheckpointCommand',
             'create-model=loudml.cli:CreateModelCommand',
@@ -80,10 +81,15 @@ setup(
             'predict=loudml.cli:PredictCommand',
             'forecast=loudml.cli:ForecastCommand',
             'plot=loudml.cli:PlotCommand',
+            'migrate-storage=loudml.cli:MigrateStorageCommand',
         ],
         'loudml.models': [
             'donut=loudml.donut:DonutModel',
         ],
+        'loudml.storages': [
+            'file=loudml.filestorage:FileStorage',
+            'sqlite=loudml.sqlitestorage:SQLiteStorage',
+        ],
         'loudml.hooks': [
             'annotations=loudml.annotations:AnnotationHook',
         ],
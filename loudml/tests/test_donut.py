@@ -6,6 +6,7 @@ import math
 import os
 import random
 import unittest
+from unittest import mock
 
 import numpy as np
 
@@ -25,10 +26,18 @@ from loudml.randevents import (
     SinEventGenerator,
     TriangleEventGenerator,
 )
+from loudml import donut
 from loudml.donut import (
     DonutModel,
     TimeSeriesPrediction,
+    TrialPool,
+    WindowCache,
+    _fmin,
     _format_windows,
+    _get_mc_chunk_size,
+    _get_mc_epsilon,
+    _halton,
+    _mc_integrate,
 )
 from loudml.model import Feature
 
@@ -65,6 +74,15 @@ FEATURE_AVG_FOO = {
 
 FEATURES = [FEATURE_COUNT_FOO]
 
+# Model settings of the tests that override only the keys they need
+SETTINGS = dict(
+    offset=30,
+    span=3,
+    bucket_interval=20 * 60,
+    interval=60,
+    features=[FEATURE_COUNT_FOO],
+)
+
 class TestHook(Hook):
     def __init__(self, model, storage, *args, **kwargs):
         super().__init__(
@@ -158,6 +176,117 @@ class TestTimes(unittest.TestCase):
         self._require_training()
         self.assertTrue(self.model.is_trained)
 
+    def test_train_incremental(self):
+        self._require_training()
+        state = self.model.state
+        self.assertEqual(
+            state['last_ts'],
+            self.to_date - self.model.bucket_interval,
+        )
+        count, mean, m2 = state['moments']
+        self.assertAlmostEqual(state['means'][0], mean)
+        self.assertAlmostEqual(state['stds'][0], math.sqrt(m2 / count))
+        windows = state['replay']['windows']
+        self.assertEqual(len(windows), donut.g_replay_size)
+        self.assertEqual(len(windows[0]), self.model.W)
+
+        # Nothing new to train on
+        result = self.model.train(
+            self.source,
+            self.from_date,
+            self.to_date,
+            incremental=True,
+        )
+        self.assertEqual(result['nb_new_buckets'], 0)
+        self.assertEqual(result['loss'], state['loss'])
+        self.assertEqual(self.model.state, state)
+
+    def test_export_weights_file(self):
+        import base64
+        import h5py
+        import tempfile
+
+        layers = {
+            'input_1': [],
+            'dense_3': [np.ones((4, 3)), np.zeros(3)],
+            'z_mean': [np.full((3, 2), 2.0), np.ones(2)],
+            'z_log_var': [np.full((3, 2), 3.0), np.ones(2)],
+            'dense_1': [np.full((2, 3), 4.0), np.ones(3)],
+            'dense_2': [np.full((3, 4), 5.0), np.ones(4)],
+        }
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'model.h5')
+            with h5py.File(path, mode='w') as f:
+                model_weights = f.create_group('model_weights')
+                model_weights.attrs['layer_names'] = [
+                    name.encode('utf-8') for name in layers
+                ]
+                for name, arrays in layers.items():
+                    group = model_weights.create_group(name)
+                    weight_names = [
+                        '{}/w{}'.format(name, i).encode('utf-8')
+                        for i in range(len(arrays))
+                    ]
+                    group.attrs['weight_names'] = weight_names
+                    for weight_name, array in zip(weight_names, arrays):
+                        group.create_dataset(weight_name.decode('utf-8'), data=array)
+
+            weights = donut._export_weights_file(path)
+            self.assertIsInstance(weights['hidden'][0], np.memmap)
+            with open(path, 'rb') as model_file:
+                model_b64 = base64.b64encode(model_file.read()).decode('utf-8')
+            copies = donut._export_weights(model_b64)
+
+        self.assertEqual(set(weights), {
+            'hidden', 'z_mean', 'z_log_var', 'dense_1', 'dense_2',
+        })
+        for name in weights:
+            for array, copy in zip(weights[name], copies[name]):
+                np.testing.assert_array_equal(array, copy)
+        np.testing.assert_array_equal(weights['hidden'][0], layers['dense_3'][0])
+
+    def test_moments(self):
+        x = np.random.normal(3, 2, size=1000)
+        x[::10] = np.nan
+        count, mean, m2 = donut._merge_moments(
+            donut._moments(x[:300]),
+            donut._merge_moments(
+                donut._moments(x[300:]),
+                donut._moments(x[:0]),
+            ),
+        )
+        self.assertEqual(count, 900)
+        self.assertAlmostEqual(mean, np.nanmean(x))
+        self.assertAlmostEqual(math.sqrt(m2 / count), np.nanstd(x))
+
+        self.model.stat_moments([count, mean, m2])
+        self.assertAlmostEqual(self.model.means[0], np.nanmean(x))
+        self.assertAlmostEqual(self.model.stds[0], np.nanstd(x))
+        self.model.stat_moments(donut._moments(x[:0]))
+        self.assertEqual(self.model.stds[0], 1.0)
+
+    def test_reservoir_sample(self):
+        windows = np.arange(300, dtype=float).reshape(100, 3)
+        reservoir, seen = donut._reservoir_sample(
+            np.empty((0, 3)),
+            0,
+            windows[:4],
+            size=10,
+        )
+        self.assertEqual(seen, 4)
+        np.testing.assert_array_equal(reservoir, windows[:4])
+
+        reservoir, seen = donut._reservoir_sample(
+            reservoir,
+            seen,
+            windows[4:],
+            size=10,
+        )
+        self.assertEqual(seen, 100)
+        self.assertEqual(reservoir.shape, (10, 3))
+        self.assertEqual(len({tuple(window) for window in reservoir}), 10)
+        self.assertTrue(np.all(reservoir[:, 0] % 3 == 0))
+
     def test_format_windows(self):
         from_date = 100
         to_date = 200
@@ -217,6 +346,840 @@ class TestTimes(unittest.TestCase):
             True, False, False, False, False, False, False, False, False, True,
         ])
 
+    def test_fmin(self):
+        from hyperopt import base, hp, space_eval, Trials, STATUS_OK, STATUS_FAIL
+
+        space = hp.choice('case', [
+            {
+                'span': hp.quniform('span', 5, 50, 1),
+                'latent_dim': hp.choice('latent_dim', [3, 5, 8]),
+            }
+        ])
+        batches = []
+
+        def evaluate(params_list):
+            batches.append(len(params_list))
+            keys = [repr(sorted(params.items())) for params in params_list]
+            self.assertEqual(len(set(keys)), len(keys))
+            for params in params_list:
+                if params['latent_dim'] == 8:
+                    yield {'loss': None, 'status': STATUS_FAIL}
+                else:
+                    loss = (params['span'] - 20) ** 2
+                    yield {
+                        'loss': loss,
+                        'status': STATUS_OK,
+                        # pruned trials are never the best ones
+                        'pruned': params['latent_dim'] == 5,
+                    }
+
+        trials = Trials()
+        best = _fmin(evaluate, space, max_evals=30, trials=trials, batch_size=7)
+        self.assertEqual(len(batches), 5)
+        self.assertLessEqual(sum(batches), 30)
+        self.assertEqual(len(trials), 30)
+        best_params = space_eval(space, base.spec_from_misc(best['misc']))
+        self.assertEqual(best_params['latent_dim'], 3)
+        self.assertEqual(best['result']['loss'], min(
+            trial['result']['loss'] for trial in trials.trials
+            if trial['result']['status'] == STATUS_OK
+            and not trial['result']['pruned']
+        ))
+
+        def fail(params_list):
+            for _ in params_list:
+                yield {'loss': None, 'status': STATUS_FAIL}
+
+        with self.assertRaises(ValueError):
+            _fmin(fail, space, max_evals=4, trials=Trials(), batch_size=2)
+
+        # Duplicated suggestions are evaluated once
+        batches.clear()
+        space = hp.choice('case', [
+            {
+                'span': 20,
+                'latent_dim': hp.choice('latent_dim', [3, 5]),
+            }
+        ])
+        trials = Trials()
+        _fmin(evaluate, space, max_evals=4, trials=trials, batch_size=4)
+        self.assertEqual(len(batches), 1)
+        self.assertLessEqual(batches[0], 2)
+        self.assertEqual(len(trials), 4)
+        self.assertTrue(all(
+            trial['result']['status'] == STATUS_OK
+            for trial in trials.trials
+        ))
+
+    def test_trial_pool(self):
+        from hyperopt import STATUS_FAIL
+
+        dataset = np.zeros(10)
+        with TrialPool(2, self.model.settings, dataset, {}) as pool:
+            # Invalid parameters, trials fail without training
+            results = list(pool.imap([({}, {})] * 3))
+        self.assertEqual(len(results), 3)
+        for result in results:
+            self.assertEqual(result['status'], STATUS_FAIL)
+
+    def test_generator(self):
+        x = np.arange(30, dtype=float).reshape(10, 3)
+        missing = np.zeros((10, 3), dtype=bool)
+        missing[:, 1] = True
+        calls = []
+
+        def imputer(inputs):
+            batch_x, batch_missing = inputs
+            calls.append(len(batch_x))
+            return [np.where(batch_missing, -1.0, batch_x)]
+
+        gen = donut.generator(x, missing, 64, imputer)
+        for _ in range(3):
+            (batch_x, batch_missing), y = next(gen)
+            self.assertIsNone(y)
+            self.assertEqual(batch_x.shape, (64, 3))
+            self.assertEqual(batch_missing.shape, (64, 3))
+            self.assertTrue(np.all(batch_missing[:, 1] == 1.0))
+            self.assertTrue(np.all(batch_x[batch_missing > 0] == -1.0))
+            # Other points are left as is
+            kept = batch_missing == 0
+            columns = np.tile(np.arange(3), (64, 1))
+            self.assertTrue(np.all(batch_x[kept] % 3 == columns[kept]))
+        self.assertEqual(calls, [64, 64, 64])
+
+        # Windows are drawn according to their weights
+        weights = np.zeros(10)
+        weights[[2, 7]] = 0.5
+        gen = donut.generator(x, missing, 64, imputer, weights)
+        (batch_x, batch_missing), _ = next(gen)
+        # Some points are randomly flagged as missing
+        kept = batch_missing[:, 0] == 0
+        self.assertEqual(set(batch_x[kept, 0]), {6.0, 21.0})
+
+    def test_trials_persistence(self):
+        import json
+        from hyperopt import hp, STATUS_OK
+
+        space = hp.choice('case', [
+            {
+                'span': 5 + hp.randint('span', 20),
+                'latent_dim': hp.choice('latent_dim', [3, 5, 8]),
+            }
+        ])
+        evaluated = []
+
+        def evaluate(params_list):
+            for params in params_list:
+                evaluated.append(params)
+                yield {
+                    'loss': np.float32((params['span'] - 20) ** 2),
+                    'status': STATUS_OK,
+                    'rung_losses': [np.float32(1.0)],
+                    'model_path': "/tmp/foo.h5",
+                }
+
+        saved = []
+
+        def checkpoint(docs):
+            saved.append(json.loads(json.dumps(
+                donut._dump_trials(docs, 'space', 'job'),
+            )))
+
+        donut._fmin(
+            evaluate,
+            space,
+            max_evals=5,
+            trials=donut._load_trials(None, 'space', 'job'),
+            checkpoint=checkpoint,
+        )
+        self.assertEqual(len(saved), 5)
+        self.assertEqual(len(saved[-1]['trials']), 5)
+        self.assertNotIn('model_path', saved[-1]['trials'][0]['result'])
+
+        # Resume an interrupted job
+        trials = donut._load_trials(saved[2], 'space', 'job')
+        self.assertEqual(len(trials), 3)
+        del evaluated[:]
+        best = donut._fmin(evaluate, space, max_evals=5, trials=trials)
+        self.assertEqual(len(evaluated), 2)
+        self.assertEqual(len(trials), 5)
+        self.assertFalse(best['result'].get('prior'))
+
+        # Another job only uses previous trials as prior knowledge
+        trials = donut._load_trials(saved[-1], 'space', 'other_job')
+        self.assertEqual(len(trials), 5)
+        for trial in trials.trials:
+            self.assertTrue(trial['result']['prior'])
+        with self.assertRaises(ValueError):
+            donut._best_trial(trials)
+
+        # The search space changed
+        trials = donut._load_trials(saved[-1], 'other_space', 'job')
+        self.assertEqual(len(trials), 0)
+
+    def test_resume_search(self):
+        from hyperopt import STATUS_OK
+
+        settings = dict(
+            SETTINGS,
+            name='test_resume',
+            span='auto',
+            min_span=5,
+            max_span=20,
+        )
+        dataset = np.sin(np.arange(200) / 4)
+        evaluated = []
+
+        def evaluate_params(dataset, params, **kwargs):
+            evaluated.append(params)
+            return {'loss': float(params['span']), 'status': STATUS_OK}
+
+        saved = []
+        model = DonutModel(settings)
+        model.span_candidates = [6, 12]
+        with mock.patch.object(
+            DonutModel,
+            '_evaluate_params',
+            side_effect=evaluate_params,
+        ), mock.patch.object(
+            DonutModel,
+            '_cross_val_model',
+            return_value=(1.0, None),
+        ) as cross_val_model, mock.patch.object(
+            DonutModel,
+            '_load_keras',
+        ) as load_keras:
+            best_params, _ = model._train_on_dataset(
+                dataset,
+                max_evals=3,
+                trials_cb=saved.append,
+            )
+            self.assertEqual(len(evaluated), 3)
+            self.assertEqual(saved[-1]['span_candidates'], [6, 12])
+            self.assertEqual(cross_val_model.call_count, 1)
+            job_key = model.job_key
+
+            # Re-run of a complete job, with other span candidates
+            del evaluated[:]
+            model = DonutModel(settings)
+            model.span_candidates = [7]
+            _, score = model._train_on_dataset(
+                dataset,
+                max_evals=3,
+                trials=saved[-1],
+            )
+            self.assertEqual(evaluated, [])
+            self.assertEqual(model.span_candidates, [6, 12])
+            self.assertEqual(model.job_key, job_key)
+            self.assertEqual(cross_val_model.call_count, 2)
+
+            # The network of the current state was trained by this job
+            model = DonutModel(settings, state={
+                'h5py': "",
+                'loss': 0.5,
+                'job_key': job_key,
+            })
+            _, score = model._train_on_dataset(
+                dataset,
+                max_evals=3,
+                trials=saved[-1],
+            )
+            self.assertEqual(score, 0.5)
+            self.assertEqual(cross_val_model.call_count, 2)
+            load_keras.assert_called_once()
+
+    def test_warm_start(self):
+        from hyperopt import STATUS_OK, Trials
+
+        settings = dict(
+            SETTINGS,
+            name='test_priors',
+            span='auto',
+            min_span=5,
+            max_span=20,
+            template='tmpl',
+        )
+        model = DonutModel(settings)
+
+        def other(name, state=None, **kwargs):
+            other_settings = dict(settings, name=name, **kwargs)
+            data = {'settings': other_settings}
+            if state is not None:
+                data['state'] = state
+            return data
+
+        def best_params(span, latent_dim):
+            return {
+                'span': span,
+                'latent_dim': latent_dim,
+                'intermediate_dim': 34,
+                'optimizer': 'adam',
+            }
+
+        class Storage:
+            models = {
+                'test_priors': other('test_priors', {
+                    'best_params': best_params(6, 3),
+                }),
+                'a': other('a', {'best_params': best_params(7, 3)}, template=None),
+                'b': other('b', {'best_params': best_params(8, 5)}),
+                'c': other('c', {'best_params': best_params(9, 8)},
+                           template=None, bucket_interval=60),
+                'd': other('d'),
+                'e': other('e', {'best_params': best_params(8, 5)}),
+                # Malformed models are skipped
+                'f': other('f', {'best_params': best_params(10, 3)},
+                           bucket_interval='bad'),
+            }
+            read = []
+
+            def find_models(self, model_type=None, trained=None):
+                return [
+                    {'name': name, 'type': data['settings']['type']}
+                    for name, data in sorted(self.models.items())
+                    if data['settings']['type'] == model_type
+                    and ('state' in data) == trained
+                ]
+
+            def get_model_meta(self, name):
+                self.read.append(name)
+                return self.models[name]
+
+        storage = Storage()
+        priors = donut.find_priors(storage, model)
+        self.assertEqual(priors, [best_params(8, 5), best_params(7, 3)])
+        # Models not trained are not read
+        self.assertNotIn('d', storage.read)
+
+        space = model.get_hp_space()
+        evaluated = []
+
+        def evaluate(params_list):
+            for params in params_list:
+                evaluated.append(params)
+                yield {'loss': 1.0, 'status': STATUS_OK}
+
+        points = [model.get_hp_vals(params) for params in priors]
+        _fmin(evaluate, space, max_evals=4, trials=Trials(), points=points)
+        self.assertEqual(evaluated[:2], priors)
+        self.assertEqual(len(evaluated), 4)
+
+        with self.assertRaises(ValueError):
+            model.get_hp_vals(best_params(30, 3))
+        with self.assertRaises(ValueError):
+            model.get_hp_vals(best_params(10, 4))
+
+    def test_find_spans(self):
+        rng = np.random.RandomState(0)
+        t = np.arange(2000)
+        x = np.sin(2 * np.pi * t / 24) + 0.3 * rng.normal(size=len(t))
+        x[rng.rand(len(t)) < 0.1] = np.nan
+
+        spans = donut._find_spans(x, 10, 100)
+        self.assertIn(24, spans)
+        self.assertLessEqual(len(spans), 3)
+        for span in spans:
+            self.assertEqual(span % 24, 0)
+
+        self.assertEqual(donut._find_spans(x, 10, 40), [24])
+        self.assertIsNone(donut._find_spans(rng.normal(size=2000), 10, 100))
+        self.assertIsNone(donut._find_spans(np.ones(2000), 10, 100))
+        self.assertIsNone(donut._find_spans(x[:15], 10, 100))
+
+        model = DonutModel(dict(SETTINGS, name='test_spans', span='auto'))
+        model.span_candidates = [24, 48]
+        vals = model.get_hp_vals({
+            'span': 48,
+            'latent_dim': 5,
+            'intermediate_dim': 34,
+            'optimizer': 'adam',
+        })
+        self.assertEqual(vals['span'], [1])
+
+        # Other spans map to the nearest candidate
+        vals = model.get_hp_vals({
+            'span': 30,
+            'latent_dim': 5,
+            'intermediate_dim': 34,
+            'optimizer': 'adam',
+        })
+        self.assertEqual(vals['span'], [0])
+
+        # Prior trials searched other candidates
+        from hyperopt import STATUS_OK
+        data = {
+            'space': 'space',
+            'key': 'other_job',
+            'span_candidates': [12, 24, 45],
+            'trials': [
+                {
+                    'vals': {
+                        'case': [0],
+                        'span': [i],
+                        'latent_dim': [0],
+                        'i1': [0],
+                        'optimizer': [0],
+                    },
+                    'result': {'loss': 1.0, 'status': STATUS_OK},
+                }
+                for i in range(3)
+            ],
+        }
+        trials = donut._load_trials(data, 'space', 'job', model)
+        self.assertEqual(
+            [trial['misc']['vals']['span'] for trial in trials.trials],
+            [[0], [0], [1]],
+        )
+
+    def test_successive_halving(self):
+        scheduler = donut.SuccessiveHalving(5, 3)
+        self.assertEqual(scheduler.budgets(100), [5, 15, 45, 100])
+        self.assertEqual(scheduler.budgets(45), [5, 15, 45])
+        self.assertEqual(scheduler.budgets(3), [3])
+
+        # Not enough trials to compare with
+        scheduler = donut.SuccessiveHalving(5, 3, {0: [1.0]})
+        self.assertTrue(scheduler.promote(2.0))
+        self.assertTrue(scheduler.promote(2.0))
+        self.assertFalse(scheduler.pruned)
+
+        rungs = {0: [1.0, 2.0, 3.0, 4.0, 5.0]}
+        scheduler = donut.SuccessiveHalving(5, 3, rungs)
+        self.assertTrue(scheduler.promote(1.5))
+        # No other trial reached the next rung
+        self.assertTrue(scheduler.promote(3.0))
+        self.assertFalse(scheduler.pruned)
+        self.assertEqual(scheduler.losses, [1.5, 3.0])
+
+        scheduler = donut.SuccessiveHalving(5, 3, rungs)
+        self.assertFalse(scheduler.promote(2.5))
+        self.assertTrue(scheduler.pruned)
+
+    def test_mc_chunk_size(self):
+        # 1000 samples * 256 values * 4 bytes = 1MB per window
+        self.assertEqual(_get_mc_chunk_size(1000, 256, 64), 65)
+        self.assertEqual(_get_mc_chunk_size(1000, 256, 1), 1)
+        # Never less than one window per chunk
+        self.assertEqual(_get_mc_chunk_size(1000, 256, 0), 1)
+
+    def test_mc_integrate(self):
+        decoded = []
+
+        def decode(z):
+            decoded.append(len(z))
+            return z
+
+        z_mean = np.zeros((4, 3))
+        z_std = np.full((4, 3), 2.0)
+
+        # Fixed sample count
+        std = _mc_integrate(decode, z_mean, z_std, 1000, 1000)
+        self.assertEqual(sum(decoded), 4 * 1000)
+        np.testing.assert_allclose(std, 2.0, rtol=0.2)
+
+        # Adaptive sample count
+        decoded.clear()
+        std = _mc_integrate(
+            decode,
+            z_mean,
+            z_std,
+            100,
+            100000,
+            tolerance=0.05,
+            min_count=400,
+        )
+        self.assertGreaterEqual(sum(decoded), 4 * 400)
+        self.assertLess(sum(decoded), 4 * 100000)
+        np.testing.assert_allclose(std, 2.0, rtol=0.2)
+
+        # Converged estimates stop as soon as min_count samples are drawn
+        z_std = np.zeros((4, 3))
+        decoded.clear()
+        _mc_integrate(decode, z_mean, z_std, 100, 1000, tolerance=0.05)
+        self.assertEqual(decoded, [4 * 100])
+        decoded.clear()
+        _mc_integrate(
+            decode,
+            z_mean,
+            z_std,
+            30,
+            1000,
+            tolerance=0.05,
+            min_count=100,
+        )
+        self.assertEqual(decoded, [4 * 30] * 4)
+
+    def test_mc_sampling(self):
+        self.assertEqual(_halton(4, 2).tolist(), [
+            [1/2, 1/3],
+            [1/4, 2/3],
+            [3/4, 1/9],
+            [1/8, 4/9],
+        ])
+
+        self.assertIsNone(_get_mc_epsilon('random', 100, 3))
+
+        epsilon = _get_mc_epsilon('antithetic', 100, 3)
+        self.assertEqual(epsilon.shape, (100, 3))
+        np.testing.assert_equal(epsilon[0::2], -epsilon[1::2])
+        # Precomputed once
+        self.assertIs(_get_mc_epsilon('antithetic', 100, 3), epsilon)
+
+        epsilon = _get_mc_epsilon('halton', 200, 3)
+        self.assertEqual(epsilon.shape, (200, 3))
+        self.assertTrue(np.all(np.isfinite(epsilon)))
+
+        z_mean = np.zeros((4, 3))
+        z_std = np.full((4, 3), 2.0)
+        std = _mc_integrate(lambda z: z, z_mean, z_std, 200, 200, epsilon=epsilon)
+        # Same samples for all windows
+        self.assertEqual(len(set(std.tolist())), 1)
+        np.testing.assert_allclose(std, 2.0, rtol=0.1)
+
+    def test_mc_settings(self):
+        settings = dict(SETTINGS, name='test_mc')
+        model = DonutModel(settings)
+        self.assertEqual(model.mc_max_count, 1000)
+        self.assertEqual(model.mc_min_count, 100)
+        self.assertIsNone(model.mc_tolerance)
+
+        settings['mc_max_count'] = 50
+        model = DonutModel(settings)
+        self.assertEqual(model.mc_min_count, 50)
+
+        settings['mc_min_count'] = 100
+        with self.assertRaises(errors.Invalid):
+            DonutModel(settings)
+
+    def test_trial_settings(self):
+        settings = dict(SETTINGS, name='test_trials')
+        model = DonutModel(settings)
+        self.assertIsNone(model.trial_epochs)
+        self.assertEqual(model.trial_reduction_factor, 3)
+
+        settings['trial_epochs'] = 5
+        settings['trial_reduction_factor'] = 4
+        model = DonutModel(settings)
+        self.assertEqual(model.trial_epochs, 5)
+        self.assertEqual(model.trial_reduction_factor, 4)
+
+        settings['trial_reduction_factor'] = 1
+        with self.assertRaises(errors.Invalid):
+            DonutModel(settings)
+
+    def test_latency_objective(self):
+        settings = dict(SETTINGS, name='test_latency')
+        model = DonutModel(settings)
+        self.assertEqual(model.latency_weight, 0)
+
+        params = {
+            'span': 3,
+            'latent_dim': 3,
+            'intermediate_dim': 21,
+            'optimizer': 'adam',
+        }
+        with mock.patch.object(
+            DonutModel,
+            '_cross_val_model',
+            return_value=(0.5, None),
+        ), mock.patch.object(
+            DonutModel,
+            '_measure_inference_cost',
+            return_value=2.0,
+        ) as measure:
+            result = model._evaluate_params(np.zeros(10), params)
+            self.assertEqual(result['loss'], 0.5)
+            self.assertNotIn('inference_cost', result)
+            measure.assert_not_called()
+
+            settings['latency_weight'] = 0.1
+            model = DonutModel(settings)
+            result = model._evaluate_params(np.zeros(10), params)
+            self.assertEqual(result['val_loss'], 0.5)
+            self.assertEqual(result['inference_cost'], 2.0)
+            self.assertAlmostEqual(result['loss'], 0.7)
+
+        # The cost measured by successive halving is reused
+        def cross_val(dataset, params, scheduler=None, **kwargs):
+            scheduler.inference_cost = 3.0
+            return 0.5, None
+
+        settings['trial_epochs'] = 5
+        model = DonutModel(settings)
+        with mock.patch.object(
+            DonutModel,
+            '_cross_val_model',
+            side_effect=cross_val,
+        ), mock.patch.object(
+            DonutModel,
+            '_measure_inference_cost',
+            return_value=2.0,
+        ) as measure:
+            result = model._evaluate_params(np.zeros(10), params)
+            self.assertEqual(result['inference_cost'], 3.0)
+            self.assertAlmostEqual(result['loss'], 0.8)
+            measure.assert_not_called()
+
+        settings['latency_weight'] = -1
+        with self.assertRaises(errors.Invalid):
+            DonutModel(settings)
+
+    def test_pruned_trial(self):
+        from hyperopt import STATUS_OK
+
+        model = DonutModel(dict(SETTINGS, name='test_pruned', trial_epochs=5))
+        params = {
+            'span': 3,
+            'latent_dim': 3,
+            'intermediate_dim': 21,
+            'optimizer': 'adam',
+        }
+
+        def cross_val_model(dataset, params, scheduler=None, **kwargs):
+            scheduler.promote(2.0)
+            return 2.0, None
+
+        rungs = {0: [1.0, 1.0, 1.0]}
+        with mock.patch.object(
+            DonutModel,
+            '_cross_val_model',
+            side_effect=cross_val_model,
+        ):
+            result = model._evaluate_params(np.zeros(10), params, rungs=rungs)
+
+        # TPE learns from the loss of the last rung
+        self.assertEqual(result['status'], STATUS_OK)
+        self.assertEqual(result['loss'], 2.0)
+        self.assertTrue(result['pruned'])
+        self.assertEqual(result['rung_losses'], [2.0])
+
+    def test_window_cache(self):
+        model = DonutModel(dict(SETTINGS, name='test_window_cache'))
+        dataset = np.arange(100, dtype=float)
+        dataset[[10, 80]] = np.nan
+
+        cache = WindowCache(dataset, train_size=0.5)
+        split = cache.split(model)
+        (X_miss, X_train, weights), (X_miss_val, X_test) = split
+        self.assertIsNone(weights)
+        (miss, train), (miss_val, test) = model.train_test_split(
+            dataset,
+            train_size=0.5,
+        )
+        np.testing.assert_array_equal(X_train, train)
+        np.testing.assert_array_equal(X_miss, miss)
+        np.testing.assert_array_equal(X_test, test)
+        np.testing.assert_array_equal(X_miss_val, miss_val)
+        self.assertTrue(X_test.flags['C_CONTIGUOUS'])
+        self.assertIs(cache.split(model), split)
+
+        model.span = 5
+        (_, X_train, _), _ = cache.split(model)
+        self.assertEqual(X_train.shape, (46, 5))
+        self.assertEqual(len(cache._splits), 2)
+
+        # Least recently used spans are evicted
+        cache = WindowCache(dataset, train_size=0.5, memory_limit=4e-3)
+        split = cache.split(model)
+        model.span = 3
+        cache.split(model)
+        self.assertLessEqual(cache.size, cache.memory_limit)
+        self.assertEqual(list(cache._splits), [3])
+        model.span = 5
+        self.assertIsNot(cache.split(model), split)
+
+    def test_split_windows(self):
+        settings = dict(SETTINGS, name='test_split_windows')
+        model = DonutModel(settings)
+        self.assertIsNone(model.max_train_windows)
+
+        # Two weeks of flatline with a few spikes
+        dataset = np.zeros(2 * 7 * 72)
+        dataset[::50] = np.arange(len(dataset[::50])) + 1.0
+        dataset[100] = np.nan
+
+        settings['max_train_windows'] = 10000
+        model = DonutModel(settings)
+        (X_miss, X_train, weights), (X_miss_val, X_test) = model.split_windows(
+            dataset,
+            train_size=1.0,
+            from_ts=0,
+        )
+        self.assertEqual(len(X_test), 0)
+        self.assertEqual(X_train.shape[1], 3)
+        self.assertEqual(len(X_train), len(weights))
+        self.assertAlmostEqual(weights.sum(), 1.0)
+        # Identical windows of the same hour of the week are merged
+        (miss, train), _ = model.train_test_split(dataset, train_size=1.0)
+        hours = (np.arange(len(train)) + 2) * 20 // 60 % (7 * 24)
+        keys = {
+            (hour, tuple(window), tuple(flags))
+            for hour, window, flags in zip(hours, train, miss)
+        }
+        self.assertEqual(len(X_train), len(keys))
+        flat = ~X_train.any(axis=1) & ~X_miss.any(axis=1)
+        self.assertEqual(flat.sum(), 7 * 24)
+        np.testing.assert_allclose(
+            weights[flat].sum(),
+            (~train.any(axis=1) & ~miss.any(axis=1)).mean(),
+        )
+
+        settings['max_train_windows'] = 100
+        model = DonutModel(settings)
+        (X_miss, X_train, weights), _ = model.split_windows(
+            dataset,
+            train_size=1.0,
+            from_ts=0,
+        )
+        self.assertEqual(len(X_train), 100)
+        self.assertAlmostEqual(weights.sum(), 1.0)
+
+        settings['max_train_windows'] = 0
+        with self.assertRaises(errors.Invalid):
+            DonutModel(settings)
+
+    def test_format_dataset(self):
+        model = DonutModel(dict(SETTINGS, name='test_format_dataset'))
+        x = np.array([1.0, np.nan, 3.0, 4.0, 5.0, 6.0])
+        abnormal = np.array([False, False, False, False, True, False, False])
+
+        missing, data_x = model._format_dataset(x, abnormal=abnormal)
+        self.assertEqual(data_x.shape, (4, 3))
+        self.assertFalse(data_x.flags.writeable)
+        self.assertEqual(data_x.tolist(), [
+            [1.0, 0.0, 3.0],
+            [0.0, 3.0, 4.0],
+            [3.0, 4.0, 0.0],
+            [4.0, 0.0, 6.0],
+        ])
+        self.assertEqual(missing.tolist(), [
+            [False, True, False],
+            [True, False, False],
+            [False, False, True],
+            [False, True, False],
+        ])
+        # Input data is left untouched
+        self.assertTrue(np.isnan(x[1]))
+
+        missing, data_x = model._format_dataset(
+            x,
+            accept_missing=False,
+            abnormal=abnormal,
+        )
+        self.assertEqual(data_x.tolist(), [
+            [3.0, 4.0, 0.0],
+            [4.0, 0.0, 6.0],
+        ])
+
+        missing, data_x = model._format_dataset(x[:2])
+        self.assertEqual(len(data_x), 0)
+
+    def test_apply_defaults(self):
+        feature = dict(FEATURE_COUNT_FOO)
+        feature['default'] = 'previous'
+        model = DonutModel(dict(
+            SETTINGS,
+            name='test_defaults',
+            features=[feature],
+        ))
+        x = np.array([np.nan, 1.0, np.nan, np.nan, 4.0, np.nan])
+        model.apply_defaults(x)
+        np.testing.assert_array_equal(x, [np.nan, 1.0, 1.0, 1.0, 4.0, 4.0])
+
+    def test_compute_scores(self):
+        observed = np.array([10.0, 0.0, np.nan, 5.0])
+        predicted = np.full(4, 5.0)
+        low = np.full(4, 2.0)
+        high = np.full(4, 8.0)
+        expected = {
+            'low': [0.0, 100.0, 100.0, 0.0],
+            'high': [100.0, 0.0, 100.0, 0.0],
+            'low_high': [100.0, 100.0, 100.0, 0.0],
+        }
+
+        for anomaly_type, expected_scores in expected.items():
+            feature = dict(FEATURE_COUNT_FOO)
+            feature['anomaly_type'] = anomaly_type
+            model = DonutModel(dict(
+                SETTINGS,
+                name='test_scores',
+                features=[feature],
+            ))
+            scores, mses = model.compute_scores(observed, predicted, low, high)
+            np.testing.assert_allclose(scores, expected_scores, atol=1e-3)
+            np.testing.assert_allclose(mses, [25.0, 25.0, np.nan, 0.0])
+
+            for i in range(len(observed)):
+                score, mse = model.compute_bucket_scores(
+                    observed[i], predicted[i], low[i], high[i])
+                self.assertAlmostEqual(score, scores[i])
+
+    def test_mc_std(self):
+        self._require_training()
+        self.model.load(num_cpus=1, num_gpus=0)
+
+        x = np.zeros((10, self.model.W))
+        missing = np.full(x.shape, False, dtype=bool)
+        std = self.model._compute_mc_std(x, missing, memory_limit=1)
+        self.assertEqual(std.shape, (10,))
+        self.assertTrue(np.all(std >= 0))
+        # Identical windows must get similar bounds
+        np.testing.assert_allclose(std, std[0], rtol=0.2)
+
+    def test_impute(self):
+        self._require_training()
+        self.model.load(num_cpus=1, num_gpus=0)
+
+        x = np.random.normal(size=(5, self.model.W))
+        missing = np.full(x.shape, False, dtype=bool)
+        missing[:, -1] = True
+        missing[2, :3] = True
+
+        # Reference implementation, one Keras call per iteration
+        expected = x.copy()
+        for _ in range(donut.g_mcmc_count):
+            z_mean, _, _ = self.model._encoder_model.predict([expected, missing])
+            x_decoded = self.model._decoder_model.predict(z_mean)
+            expected[missing] = x_decoded[missing]
+
+        x_imputed = self.model._impute(x, missing)
+        np.testing.assert_allclose(x_imputed, expected, rtol=1e-4, atol=1e-5)
+        # Observed points are left untouched
+        np.testing.assert_allclose(x_imputed[~missing], x[~missing], rtol=1e-6)
+
+    def test_numpy_backend(self):
+        self._require_training()
+
+        model = DonutModel(self.model.settings, state=self.model.state)
+        model.load(num_cpus=1, num_gpus=0, backend='numpy')
+        self.assertIsNone(model._keras_model)
+
+        x = np.random.normal(size=(5, self.model.W))
+        missing = np.full(x.shape, False, dtype=bool)
+        missing[:, -1] = True
+
+        self.model.load(num_cpus=1, num_gpus=0)
+        np.testing.assert_allclose(
+            model._encode(x, missing),
+            self.model._encode(x, missing),
+            rtol=1e-4,
+            atol=1e-5,
+        )
+        np.testing.assert_allclose(
+            model._impute(x, missing),
+            self.model._impute(x, missing),
+            rtol=1e-4,
+            atol=1e-5,
+        )
+
+        prediction = model.predict(
+            self.source,
+            self.to_date - 24 * 3600,
+            self.to_date,
+            backend='numpy',
+        )
+        self.assertEqual(len(prediction.timestamps), 72)
+
     def test_format(self):
         dataset = np.array([0, np.nan, 4, 6, 8, 10, 12, 14])
         abnormal = np.array([
@@ -1,11 +1,18 @@
+import base64
 import datetime
+import gzip
+import hashlib
+import json
 import logging
+import os
+import shutil
 import tempfile
 import unittest
 
 logging.getLogger('tensorflow').disabled = True
 
 import loudml.vendor
+import loudml.filestorage
 
 from loudml import (
     errors,
@@ -14,6 +21,12 @@ from loudml import (
 from loudml.donut import DonutModel
 from loudml.filestorage import FileStorage
 
+def blob_path(data, ext):
+    return os.path.join('blobs', hashlib.sha1(data).hexdigest() + ext)
+
+def cache_path(data):
+    return os.path.join('cache', hashlib.sha1(data).hexdigest() + '.h5')
+
 FEATURES = [
     {
         'name': 'avg_foo',
@@ -23,36 +36,36 @@ FEATURES = [
     },
 ]
 
+# Model settings of the tests that override only the keys they need
+SETTINGS = dict(
+    offset=30,
+    span=300,
+    bucket_interval=3,
+    interval=60,
+    features=FEATURES,
+    max_threshold=70,
+    min_threshold=60,
+)
+
 class TestFileStorage(unittest.TestCase):
     def test_create_and_list(self):
         with tempfile.TemporaryDirectory() as tmp:
             storage = FileStorage(tmp)
 
             # Create
-            model = DonutModel(dict(
-                name='test-1',
-                offset=30,
-                span=300,
-                bucket_interval=3,
-                interval=60,
-                features=FEATURES,
-                max_threshold=70,
-                min_threshold=60,
-            ))
+            model = DonutModel(dict(SETTINGS, name='test-1'))
             self.assertEqual(model.type, 'donut')
             storage.create_model(model)
             self.assertTrue(storage.model_exists(model.name))
 
             # Create
             model = DonutModel(dict(
+                SETTINGS,
                 name='test-2',
                 offset=56,
                 span=200,
                 bucket_interval=20,
                 interval=120,
-                features=FEATURES,
-                max_threshold=70,
-                min_threshold=60,
             ))
             storage.create_model(model)
 
@@ -72,3 +85,398 @@ class TestFileStorage(unittest.TestCase):
             self.assertEqual(model.type, 'donut')
             self.assertEqual(model.name, 'test-2')
             self.assertEqual(model.offset, 56)
+
+    def test_model_version(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            storage = FileStorage(tmp)
+
+            model = DonutModel(dict(SETTINGS, name='test-1'))
+            storage.create_model(model)
+
+            version = storage.get_model_version('test-1')
+            self.assertEqual(storage.get_model_version('test-1'), version)
+
+            # Settings change
+            storage.save_model(model, save_state=False)
+            self.assertNotEqual(storage.get_model_version('test-1'), version)
+
+            # State change
+            version = storage.get_model_version('test-1')
+            model._state = {'loss': 1.0}
+            storage.save_model(model)
+            self.assertNotEqual(storage.get_model_version('test-1'), version)
+
+            version = storage.get_model_version('test-1')
+            storage.save_state(model)
+            self.assertNotEqual(storage.get_model_version('test-1'), version)
+
+            with self.assertRaises(errors.ModelNotFound):
+                storage.get_model_version('test-2')
+
+    def test_weights_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            storage = FileStorage(tmp)
+
+            model = DonutModel(dict(SETTINGS, name='test-1'))
+            storage.create_model(model)
+            model_path = storage.model_path('test-1')
+
+            model._state = {
+                'h5py': base64.b64encode(b'weights').decode('utf-8'),
+                'loss': 1.0,
+            }
+            storage.save_model(model)
+            weights_path = blob_path(b'weights', '.h5.gz')
+            with open(os.path.join(model_path, '00.ckpt')) as fd:
+                self.assertEqual(json.load(fd), {
+                    'h5py_path': weights_path,
+                    'loss': 1.0,
+                })
+            with gzip.open(os.path.join(model_path, weights_path)) as fd:
+                self.assertEqual(fd.read(), b'weights')
+
+            # Models read a decompressed copy
+            model = storage.load_model('test-1')
+            self.assertTrue(model.is_trained)
+            self.assertEqual(
+                model.state['h5py_path'],
+                os.path.join(model_path, cache_path(b'weights')),
+            )
+            with open(model.state['h5py_path'], 'rb') as fd:
+                self.assertEqual(fd.read(), b'weights')
+
+            # New checkpoints share the weights blob
+            storage.save_model(model)
+            self.assertEqual(storage.list_checkpoints('test-1'), ['00', '01'])
+            storage.save_state(model)
+            state = storage.get_model_data('test-1')['state']
+            self.assertEqual(
+                state['h5py_path'],
+                os.path.join(model_path, cache_path(b'weights')),
+            )
+            self.assertEqual(
+                os.listdir(os.path.join(model_path, 'blobs')),
+                [os.path.basename(weights_path)],
+            )
+
+            # Old checkpoints are read as they are, and converted when saved
+            old_state = {
+                'h5py': base64.b64encode(b'old').decode('utf-8'),
+                'loss': 2.0,
+            }
+            with open(os.path.join(model_path, '02.ckpt'), 'w') as fd:
+                json.dump(old_state, fd)
+            storage.set_current_ckpt('test-1', '02')
+            model = storage.load_model('test-1')
+            self.assertEqual(model.state, old_state)
+            with open(os.path.join(model_path, '02.ckpt')) as fd:
+                self.assertEqual(json.load(fd), old_state)
+            storage.save_model(model)
+            self.assertEqual(storage.get_current_ckpt('test-1'), '03')
+            self.assertEqual(
+                storage.get_model_data('test-1')['state']['h5py_path'],
+                os.path.join(model_path, cache_path(b'old')),
+            )
+
+            # Side-car files of old checkpoints are moved to blobs when saved
+            with open(os.path.join(model_path, '04.ckpt'), 'w') as fd:
+                json.dump({'h5py_path': '04.h5', 'loss': 3.0}, fd)
+            with open(os.path.join(model_path, '04.h5'), 'wb') as fd:
+                fd.write(b'side-car')
+            storage.set_current_ckpt('test-1', '04')
+            model = storage.load_model('test-1')
+            with open(model.state['h5py_path'], 'rb') as fd:
+                self.assertEqual(fd.read(), b'side-car')
+            storage.save_model(model)
+            self.assertEqual(
+                storage.load_model('test-1').state['h5py_path'],
+                os.path.join(model_path, cache_path(b'side-car')),
+            )
+            self.assertTrue(os.path.exists(
+                os.path.join(model_path, blob_path(b'side-car', '.h5.gz')),
+            ))
+
+    def test_lazy_state(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            storage = FileStorage(tmp)
+
+            model = DonutModel(dict(SETTINGS, name='test-1'))
+            storage.create_model(model)
+            model_path = storage.model_path('test-1')
+
+            replay = {'seen': 1000, 'windows': [[1.0] * 300] * 10}
+            model._state = {
+                'h5py': base64.b64encode(b'weights').decode('utf-8'),
+                'loss': 1.0,
+                'replay': replay,
+            }
+            storage.save_model(model)
+            data_path = blob_path(
+                json.dumps({'replay': replay}).encode('utf-8'),
+                '.json.gz',
+            )
+            with open(os.path.join(model_path, '00.ckpt')) as fd:
+                self.assertEqual(json.load(fd), {
+                    'h5py_path': blob_path(b'weights', '.h5.gz'),
+                    'data_path': data_path,
+                    'loss': 1.0,
+                })
+            with gzip.open(os.path.join(model_path, data_path), 'rt') as fd:
+                self.assertEqual(json.load(fd), {'replay': replay})
+
+            # Metadata only
+            model = storage.load_model('test-1', lazy=True)
+            self.assertTrue(model.is_trained)
+            self.assertEqual(model.preview['state'], {
+                'trained': True,
+                'loss': 1.0,
+            })
+            self.assertNotIn('replay', model.state)
+            self.assertEqual(
+                storage.get_model_meta('test-1')['state']['data_path'],
+                os.path.join(model_path, data_path),
+            )
+
+            # Weights are decompressed on first use
+            weights_path = os.path.join(model_path, cache_path(b'weights'))
+            self.assertEqual(model.state['h5py_path'], weights_path)
+            self.assertFalse(os.path.exists(weights_path))
+            self.assertEqual(model._weights_file(), weights_path)
+            with open(weights_path, 'rb') as fd:
+                self.assertEqual(fd.read(), b'weights')
+
+            # Saving a lazy model keeps the data
+            storage.save_model(model)
+            with open(os.path.join(model_path, '01.ckpt')) as fd:
+                self.assertEqual(json.load(fd), {
+                    'h5py_path': blob_path(b'weights', '.h5.gz'),
+                    'data_path': data_path,
+                    'loss': 1.0,
+                })
+            model = storage.load_model('test-1')
+            self.assertEqual(model.state['replay'], replay)
+            self.assertNotIn('data_path', model.state)
+            self.assertEqual(
+                storage.get_model_data('test-1', '00')['state']['replay'],
+                replay,
+            )
+
+    def test_find_models(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            storage = FileStorage(tmp)
+
+            for i in range(5):
+                model = DonutModel(dict(SETTINGS, name='test-{}'.format(i)))
+                storage.create_model(model)
+
+            model._state = {
+                'h5py': base64.b64encode(b'weights').decode('utf-8'),
+                'loss': 1.0,
+            }
+            storage.save_model(model)
+
+            entries = storage.find_models(trained=True)
+            self.assertEqual(len(entries), 1)
+            self.assertEqual(entries[0]['name'], 'test-4')
+            self.assertEqual(entries[0]['type'], 'donut')
+            self.assertEqual(entries[0]['ckpt'], '00')
+            self.assertEqual(entries[0]['loss'], 1.0)
+            self.assertIsNone(entries[0]['run'])
+
+            # Pagination
+            names = [
+                entry['name']
+                for entry in storage.find_models(trained=False, offset=1, limit=2)
+            ]
+            self.assertEqual(names, ['test-1', 'test-2'])
+            self.assertEqual(len(storage.find_models(pattern='test-[13]')), 2)
+            self.assertEqual(storage.find_models(model_type='unknown'), [])
+
+            model.settings['run'] = {'output_bucket': 'foo'}
+            storage.save_model(model, save_state=False)
+            self.assertEqual(
+                storage.find_models(running=True)[0]['run'],
+                {'output_bucket': 'foo'},
+            )
+
+            # Changes made behind the catalog
+            storage.delete_model('test-0')
+            shutil.rmtree(storage.model_path('test-1'))
+            shutil.copytree(
+                storage.model_path('test-2'),
+                storage.model_path('test-5'),
+            )
+            os.unlink(os.path.join(storage.model_path('test-4'), 'state.json'))
+
+            self.assertEqual(
+                storage.list_models(),
+                ['test-2', 'test-3', 'test-4', 'test-5'],
+            )
+            self.assertEqual(storage.find_models(trained=True), [])
+
+            # Files rewritten in place, noticed once the models directory
+            # changes
+            os.utime(storage.model_dir, (1000, 1000))
+            self.assertEqual(len(storage.find_models(running=True)), 1)
+            settings_path = os.path.join(
+                storage.model_path('test-3'),
+                'settings.json',
+            )
+            with open(settings_path) as fd:
+                settings = json.load(fd)
+            settings['run'] = {'output_bucket': 'bar'}
+            with open(settings_path, 'w') as fd:
+                json.dump(settings, fd)
+            self.assertEqual(len(storage.find_models(running=True)), 1)
+            os.utime(storage.model_dir, (2000, 2000))
+            self.assertEqual(
+                [entry['name'] for entry in storage.find_models(running=True)],
+                ['test-3', 'test-4'],
+            )
+
+            # Another instance shares the catalog
+            storage = FileStorage(tmp)
+            self.assertEqual(len(storage.find_models(trained=False)), 4)
+
+            with self.assertRaises(errors.Invalid):
+                storage.find_models(offset=-1)
+
+    def test_runtime_state(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            storage = FileStorage(tmp)
+
+            model = DonutModel(dict(SETTINGS, name='test-1'))
+            storage.create_model(model)
+            model_path = storage.model_path('test-1')
+            ckpt_path = os.path.join(model_path, '00.ckpt')
+
+            model._state = {
+                'h5py': base64.b64encode(b'weights').decode('utf-8'),
+                'loss': 1.0,
+                'run': {'last_ts': 0},
+            }
+            storage.save_model(model)
+            with open(ckpt_path) as fd:
+                self.assertNotIn('run', json.load(fd))
+            self.assertEqual(
+                storage.load_model('test-1').state['run'],
+                {'last_ts': 0},
+            )
+            ckpt_st = os.stat(ckpt_path)
+
+            # The checkpoint is not written
+            model = storage.load_model('test-1', lazy=True)
+            version = storage.get_model_version('test-1')
+            model.set_run_state({'last_ts': 60})
+            model.state['anomaly'] = {'start_ts': 60, 'max_score': 90.0}
+            storage.save_runtime_state(model)
+            self.assertNotEqual(storage.get_model_version('test-1'), version)
+            self.assertEqual(os.stat(ckpt_path).st_mtime_ns, ckpt_st.st_mtime_ns)
+
+            model = storage.load_model('test-1')
+            self.assertEqual(model.get_run_state(), {'last_ts': 60})
+            self.assertEqual(model.state['anomaly']['start_ts'], 60)
+            self.assertEqual(model.state['loss'], 1.0)
+            self.assertNotIn('run', storage.load_model('test-1', '00').state)
+
+            # Interrupted write
+            with open(os.path.join(model_path, 'runtime.log'), 'ab') as fd:
+                fd.write(b'{"run": {"last_')
+            self.assertEqual(
+                storage.load_model('test-1').get_run_state(),
+                {'last_ts': 60},
+            )
+
+            # Compaction
+            runtime_log_size = loudml.filestorage.g_runtime_log_size
+            loudml.filestorage.g_runtime_log_size = 256
+            try:
+                for i in range(10):
+                    model.set_run_state({'last_ts': 120 + i})
+                    storage.save_runtime_state(model)
+            finally:
+                loudml.filestorage.g_runtime_log_size = runtime_log_size
+            self.assertLessEqual(
+                os.stat(os.path.join(model_path, 'runtime.log')).st_size,
+                256,
+            )
+            self.assertEqual(
+                storage.load_model('test-1').get_run_state(),
+                {'last_ts': 129},
+            )
+
+            # Saving the state resets the runtime state
+            model.set_run_state(None)
+            storage.save_state(model)
+            self.assertEqual(storage.load_model('test-1').get_run_state(), {})
+
+    def test_retention(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with self.assertRaises(errors.Invalid):
+                FileStorage(tmp, retention={'keep_last': 0})
+
+            storage = FileStorage(tmp, retention={'keep_last': 2})
+
+            model = DonutModel(dict(SETTINGS, name='test-1'))
+            storage.create_model(model)
+            model_path = storage.model_path('test-1')
+
+            blob_grace_period = loudml.filestorage.g_blob_grace_period
+            loudml.filestorage.g_blob_grace_period = -1
+            try:
+                for i in range(4):
+                    model._state = {
+                        'h5py': base64.b64encode(
+                            'weights-{}'.format(i).encode('utf-8'),
+                        ).decode('utf-8'),
+                        'loss': 1.0 / (i + 1),
+                    }
+                    storage.save_model(model)
+
+                # Names are not reused
+                self.assertEqual(storage.list_checkpoints('test-1'), ['02', '03'])
+                # Blobs are left to prune_checkpoints()
+                self.assertEqual(
+                    len(os.listdir(os.path.join(model_path, 'blobs'))),
+                    4,
+                )
+                storage.load_model('test-1')
+
+                # The current checkpoint is kept, with the cached copy of
+                # its weights only
+                storage.set_current_ckpt('test-1', '02')
+                storage.load_model('test-1')
+                for ckpt_name in ['02', '03']:
+                    os.utime(
+                        os.path.join(model_path, '{}.ckpt'.format(ckpt_name)),
+                        (0, 0),
+                    )
+                storage = FileStorage(tmp, retention={'max_age': '1h'})
+                self.assertEqual(storage.prune_checkpoints('test-1'), ['03'])
+                self.assertEqual(
+                    os.listdir(os.path.join(model_path, 'blobs')),
+                    [os.path.basename(blob_path(b'weights-2', '.h5.gz'))],
+                )
+                self.assertEqual(
+                    os.listdir(os.path.join(model_path, 'cache')),
+                    [os.path.basename(cache_path(b'weights-2'))],
+                )
+
+                # Models saved without sequence file
+                os.unlink(os.path.join(model_path, 'ckpt.seq'))
+                storage.save_model(model)
+                self.assertEqual(storage.get_current_ckpt('test-1'), '03')
+            finally:
+                loudml.filestorage.g_blob_grace_period = blob_grace_period
+
+            storage = FileStorage(tmp)
+            storage.save_model(model)
+            self.assertEqual(storage.prune_checkpoints('test-1'), [])
+            self.assertEqual(storage.list_checkpoints('test-1'), ['03', '04'])
+
+            storage = FileStorage(tmp, retention={'max_age': '1h'})
+            os.utime(os.path.join(model_path, '03.ckpt'), (0, 0))
+            self.assertEqual(storage.prune_checkpoints('test-1'), ['03'])
+            self.assertEqual(storage.list_checkpoints('test-1'), ['04'])
+            with self.assertRaises(errors.ModelNotFound):
+                storage.prune_checkpoints('test-2')
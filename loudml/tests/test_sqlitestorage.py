@@ -0,0 +1,281 @@
+import base64
+import logging
+import os
+import tempfile
+import unittest
+
+logging.getLogger('tensorflow').disabled = True
+
+import loudml.vendor
+
+from loudml import (
+    errors,
+)
+
+from loudml.donut import DonutModel
+from loudml.filestorage import FileStorage
+from loudml.sqlitestorage import SQLiteStorage
+from loudml.storage import load_storage
+
+FEATURES = [
+    {
+        'name': 'avg_foo',
+        'metric': 'avg',
+        'field': 'foo',
+        'default': 0,
+    },
+]
+
+def make_model(name):
+    return DonutModel(dict(
+        name=name,
+        offset=30,
+        span=300,
+        bucket_interval=3,
+        interval=60,
+        features=FEATURES,
+        max_threshold=70,
+        min_threshold=60,
+    ))
+
+class TestSQLiteStorage(unittest.TestCase):
+    def test_create_and_list(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            storage = load_storage({'type': 'sqlite', 'path': tmp})
+            self.assertIsInstance(storage, SQLiteStorage)
+
+            storage.create_model(make_model('test-1'))
+            storage.create_model(make_model('test-2'))
+            self.assertTrue(storage.model_exists('test-1'))
+            with self.assertRaises(errors.ModelExists):
+                storage.create_model(make_model('test-1'))
+
+            self.assertEqual(storage.list_models(), ["test-1", "test-2"])
+
+            storage.delete_model("test-1")
+            self.assertFalse(storage.model_exists("test-1"))
+            self.assertEqual(storage.list_models(), ["test-2"])
+            with self.assertRaises(errors.ModelNotFound):
+                storage.get_model_data("test-1")
+            with self.assertRaises(errors.ModelNotFound):
+                storage.delete_model("test-1")
+
+            model = storage.load_model("test-2")
+            self.assertEqual(model.type, 'donut')
+            self.assertEqual(model.name, 'test-2')
+            self.assertEqual(model.offset, 30)
+            self.assertFalse(model.is_trained)
+
+            with self.assertRaises(errors.UnsupportedStorage):
+                load_storage({'type': 'unknown', 'path': tmp})
+
+    def test_checkpoints(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            storage = SQLiteStorage(tmp)
+            model = make_model('test-1')
+            storage.create_model(model)
+            version = storage.get_model_version('test-1')
+
+            replay = {'seen': 1000, 'windows': [[1.0] * 300] * 10}
+            model._state = {
+                'h5py': base64.b64encode(b'weights').decode('utf-8'),
+                'loss': 1.0,
+                'replay': replay,
+            }
+            storage.save_model(model)
+            self.assertNotEqual(storage.get_model_version('test-1'), version)
+
+            model._state = dict(model._state, loss=0.5)
+            storage.save_model(model)
+            self.assertEqual(storage.list_checkpoints('test-1'), ['00', '01'])
+            self.assertEqual(storage.get_current_ckpt('test-1'), '01')
+
+            # Weights and data are shared
+            model = storage.load_model('test-1', lazy=True)
+            self.assertTrue(model.is_trained)
+            self.assertNotIn('replay', model.state)
+            with open(model.state['h5py_path'], 'rb') as fd:
+                self.assertEqual(fd.read(), b'weights')
+            db = storage._connect()
+            self.assertEqual(
+                db.execute("SELECT COUNT(*) FROM blobs").fetchone()[0],
+                2,
+            )
+
+            # Saving a lazy model keeps the data
+            model.state['loss'] = 0.25
+            version = storage.get_model_version('test-1')
+            storage.save_state(model)
+            self.assertNotEqual(storage.get_model_version('test-1'), version)
+            model = storage.load_model('test-1')
+            self.assertEqual(model.state['replay'], replay)
+            self.assertEqual(model.state['loss'], 0.25)
+
+            storage.set_current_ckpt('test-1', '00')
+            self.assertEqual(storage.load_model('test-1').state['loss'], 1.0)
+            with self.assertRaises(errors.NotFound):
+                storage.set_current_ckpt('test-1', '05')
+
+            # Next checkpoint does not overwrite existing ones
+            storage.save_model(model)
+            self.assertEqual(storage.get_current_ckpt('test-1'), '02')
+
+            entries = storage.find_models(trained=True)
+            self.assertEqual(entries[0]['name'], 'test-1')
+            self.assertEqual(entries[0]['ckpt'], '02')
+            self.assertEqual(entries[0]['loss'], 0.25)
+
+            # Clearing the state deletes the current checkpoint
+            weights_path = model.state['h5py_path']
+            model._state = None
+            storage.save_state(model)
+            self.assertIsNone(storage.get_current_ckpt('test-1'))
+            self.assertEqual(storage.list_checkpoints('test-1'), ['00', '01'])
+            self.assertFalse(storage.load_model('test-1').is_trained)
+            self.assertEqual(storage.find_models(trained=True), [])
+
+            # Unused blobs and cached files are deleted
+            storage.delete_model('test-1')
+            self.assertEqual(
+                db.execute("SELECT COUNT(*) FROM blobs").fetchone()[0],
+                0,
+            )
+            self.assertFalse(os.path.exists(weights_path))
+
+    def test_transaction(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            storage = SQLiteStorage(tmp)
+
+            with self.assertRaises(errors.ModelExists):
+                with storage.transaction():
+                    storage.create_model(make_model('test-1'))
+                    storage.create_model(make_model('test-1'))
+
+            self.assertEqual(storage.list_models(), [])
+
+    def test_hooks_and_objects(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            storage = SQLiteStorage(tmp)
+            storage.create_model(make_model('test-1'))
+
+            storage.set_model_hook('test-1', 'hook', 'annotations', {'id': 1})
+            self.assertEqual(storage.list_model_hooks('test-1'), ['hook'])
+            self.assertEqual(storage.get_model_hook('test-1', 'hook'), {
+                'type': 'annotations',
+                'config': {'id': 1},
+            })
+            storage.delete_model_hook('test-1', 'hook')
+            with self.assertRaises(errors.NotFound):
+                storage.get_model_hook('test-1', 'hook')
+            with self.assertRaises(errors.ModelNotFound):
+                storage.set_model_hook('test-2', 'hook', 'annotations')
+
+            storage.set_model_object('test-1', 'obj', {'foo': 'bar'})
+            self.assertEqual(storage.list_model_objects('test-1'), ['obj'])
+            self.assertEqual(
+                storage.get_model_object('test-1', 'obj'),
+                {'foo': 'bar'},
+            )
+            storage.delete_model_object('test-1', 'obj')
+            with self.assertRaises(KeyError):
+                storage.get_model_object('test-1', 'obj')
+
+    def test_import_model(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            src = FileStorage(os.path.join(tmp, 'file'))
+            model = make_model('test-1')
+            src.create_model(model)
+            model._state = {
+                'h5py': base64.b64encode(b'weights').decode('utf-8'),
+                'loss': 1.0,
+            }
+            src.save_model(model)
+            model._state = dict(model._state, loss=0.5)
+            src.save_model(model)
+            src.set_current_ckpt('test-1', '00')
+            model = src.load_model('test-1', lazy=True)
+            model.set_run_state({'last_ts': 60})
+            src.save_runtime_state(model)
+            src.set_model_hook('test-1', 'hook', 'annotations', {'id': 1})
+            src.set_model_object('test-1', 'obj', {'foo': 'bar'})
+
+            storage = SQLiteStorage(os.path.join(tmp, 'sqlite'))
+            storage.import_model(src, 'test-1')
+
+            self.assertEqual(storage.list_checkpoints('test-1'), ['00', '01'])
+            self.assertEqual(storage.get_current_ckpt('test-1'), '00')
+            model = storage.load_model('test-1')
+            self.assertEqual(model.state['loss'], 1.0)
+            self.assertEqual(model.get_run_state(), {'last_ts': 60})
+            with open(model.state['h5py_path'], 'rb') as fd:
+                self.assertEqual(fd.read(), b'weights')
+            self.assertEqual(storage.list_model_hooks('test-1'), ['hook'])
+            self.assertEqual(
+                storage.get_model_object('test-1', 'obj'),
+                {'foo': 'bar'},
+            )
+
+    def test_runtime_state(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            storage = SQLiteStorage(tmp)
+            model = make_model('test-1')
+            storage.create_model(model)
+            model._state = {
+                'h5py': base64.b64encode(b'weights').decode('utf-8'),
+                'loss': 1.0,
+                'run': {'last_ts': 0},
+            }
+            storage.save_model(model)
+
+            db = storage._connect()
+            state = db.execute("SELECT state FROM checkpoints").fetchone()[0]
+            self.assertNotIn('run', state)
+
+            model = storage.load_model('test-1', lazy=True)
+            version = storage.get_model_version('test-1')
+            model.set_run_state({'last_ts': 60})
+            storage.save_runtime_state(model)
+            self.assertNotEqual(storage.get_model_version('test-1'), version)
+            self.assertEqual(
+                db.execute("SELECT state FROM checkpoints").fetchone()[0],
+                state,
+            )
+
+            model = storage.load_model('test-1')
+            self.assertEqual(model.get_run_state(), {'last_ts': 60})
+            self.assertEqual(model.state['loss'], 1.0)
+
+            with self.assertRaises(errors.ModelNotFound):
+                storage.save_runtime_state(make_model('test-2'))
+
+    def test_retention(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            storage = SQLiteStorage(tmp, retention={'keep_last': 2})
+            model = make_model('test-1')
+            storage.create_model(model)
+
+            for i in range(4):
+                model._state = {
+                    'h5py': base64.b64encode(
+                        'weights-{}'.format(i).encode('utf-8'),
+                    ).decode('utf-8'),
+                    'loss': 1.0 / (i + 1),
+                }
+                storage.save_model(model)
+
+            self.assertEqual(storage.list_checkpoints('test-1'), ['02', '03'])
+            db = storage._connect()
+            self.assertEqual(
+                db.execute("SELECT COUNT(*) FROM blobs").fetchone()[0],
+                2,
+            )
+
+            # The current checkpoint is kept
+            storage.set_current_ckpt('test-1', '02')
+            db.execute("UPDATE checkpoints SET mtime = 0")
+            storage = SQLiteStorage(tmp, retention={'max_age': '1h'})
+            self.assertEqual(storage.prune_checkpoints('test-1'), ['03'])
+            self.assertEqual(storage.list_checkpoints('test-1'), ['02'])
+
+            with self.assertRaises(errors.ModelNotFound):
+                storage.prune_checkpoints('test-2')
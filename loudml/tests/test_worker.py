@@ -0,0 +1,131 @@
+import unittest
+
+from loudml.worker import (
+    ModelCache,
+    Worker,
+)
+
+
+class FakeModel:
+    def __init__(self, name, network_size=0):
+        self.name = name
+        self.settings = {'name': name}
+        self.state = None
+        self.network_size = network_size
+        self.loaded = True
+
+    def unload(self):
+        self.loaded = False
+
+
+class FakeStorage:
+    def __init__(self):
+        self.version = 1
+
+    def get_model_version(self, name):
+        return self.version
+
+    def load_model(self, name, lazy=False):
+        return FakeModel(name)
+
+    def save_runtime_state(self, model):
+        self.version += 1
+
+
+class TestModelCache(unittest.TestCase):
+    def test_lru(self):
+        cache = ModelCache(max_models=2, memory_limit=1024)
+
+        foo = FakeModel('foo')
+        bar = FakeModel('bar')
+        baz = FakeModel('baz')
+
+        cache.put('foo', 1, foo)
+        cache.put('bar', 1, bar)
+        self.assertIs(cache.get('foo', 1), foo)
+
+        # 'bar' is the least recently used model
+        cache.put('baz', 1, baz)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('bar', 1))
+        self.assertFalse(bar.loaded)
+        self.assertIs(cache.get('foo', 1), foo)
+        self.assertIs(cache.get('baz', 1), baz)
+
+    def test_version(self):
+        cache = ModelCache(max_models=2, memory_limit=1024)
+
+        foo = FakeModel('foo')
+        cache.put('foo', 1, foo)
+        self.assertIsNone(cache.get('foo', 2))
+        self.assertFalse(foo.loaded)
+        self.assertEqual(len(cache), 0)
+
+        # Unknown version, never cached
+        cache.put('foo', None, foo)
+        self.assertEqual(len(cache), 0)
+
+    def test_memory_limit(self):
+        cache = ModelCache(max_models=10, memory_limit=1)
+
+        foo = FakeModel('foo', network_size=600 * 1024)
+        bar = FakeModel('bar', network_size=600 * 1024)
+        cache.put('foo', 1, foo)
+        cache.put('bar', 1, bar)
+        self.assertEqual(len(cache), 1)
+        self.assertIs(cache.get('bar', 1), bar)
+
+        # The most recently used model is always kept
+        big = FakeModel('big', network_size=2 * 1024 * 1024)
+        cache.put('big', 1, big)
+        self.assertIs(cache.get('big', 1), big)
+        self.assertEqual(len(cache), 1)
+
+    def test_size_computed_once(self):
+        cache = ModelCache(max_models=10, memory_limit=1)
+
+        foo = FakeModel('foo', network_size=600 * 1024)
+        cache.put('foo', 1, foo)
+        self.assertGreaterEqual(cache.size, 600 * 1024)
+
+        # Sizes of cached models are not computed again on insert
+        foo.network_size = 2 * 1024 * 1024
+        bar = FakeModel('bar', network_size=100 * 1024)
+        cache.put('bar', 1, bar)
+        self.assertEqual(len(cache), 2)
+
+        cache.pop('foo')
+        cache.pop('bar')
+        self.assertEqual(cache.size, 0)
+
+
+class TestWorker(unittest.TestCase):
+    def setUp(self):
+        self.worker = Worker.__new__(Worker)
+        self.worker.storage = FakeStorage()
+        self.worker._models = ModelCache(max_models=2, memory_limit=1024)
+
+    def test_cache_model(self):
+        model, version = self.worker._load_model('foo')
+        self.worker._cache_model(model, version)
+        self.assertEqual(self.worker._load_model('foo'), (model, version))
+
+        # Own runtime state writes keep the model cached
+        version = self.worker._save_runtime_state(model, version)
+        self.assertEqual(version, 2)
+        self.worker._cache_model(model, version)
+        self.assertIs(self.worker._load_model('foo')[0], model)
+
+    def test_retrained_while_loaded(self):
+        model, version = self.worker._load_model('foo')
+
+        # Retrained during the job
+        self.worker.storage.version += 1
+        self.assertIsNone(self.worker._save_runtime_state(model, version))
+        self.worker._cache_model(model, None)
+        self.assertEqual(len(self.worker._models), 0)
+
+        model, version = self.worker._load_model('foo')
+        self.worker.storage.version += 1
+        self.worker._cache_model(model, version)
+        self.assertEqual(len(self.worker._models), 0)